@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .models import (
     User, Role, Authority, RoleAuthority, UserRole,
-    Category, Product, Inventory, Sale, SaleItem
+    Category, Product, Inventory, Sale, SaleItem, Refund, RefundItem
 )
 
 class UserRoleInline(admin.TabularInline):
@@ -77,6 +77,17 @@ class SaleAdmin(admin.ModelAdmin):
     readonly_fields = ('total_amount', 'created_at', 'updated_at')
     inlines = [SaleItemInline]
 
+class RefundItemInline(admin.TabularInline):
+    model = RefundItem
+    extra = 0
+    readonly_fields = ('sale_item', 'product', 'qty', 'amount')
+
+class RefundAdmin(admin.ModelAdmin):
+    list_display = ('id', 'sale', 'amount', 'created_by', 'created_at')
+    list_filter = ('created_at',)
+    readonly_fields = ('sale', 'amount', 'created_by', 'created_at')
+    inlines = [RefundItemInline]
+
 admin.site.register(User, CustomUserAdmin)
 admin.site.register(Role, RoleAdmin)
 admin.site.register(Authority, AuthorityAdmin)
@@ -87,3 +98,4 @@ admin.site.register(Product, ProductAdmin)
 admin.site.register(Inventory, InventoryAdmin)
 admin.site.register(Sale, SaleAdmin)
 admin.site.register(SaleItem)
+admin.site.register(Refund, RefundAdmin)
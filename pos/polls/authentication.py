@@ -0,0 +1,116 @@
+import copy
+
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject, empty
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from polls.models import User
+from polls.utils.bloom import blacklist_filter
+from polls.utils.lru import LRUCache
+
+# Full User rows, reused until they expire or polls.signals drops them on save/delete
+user_cache = LRUCache(max_size=10000, ttl=300)
+
+
+def get_cached_user(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.objects.filter(pk=user_id).first()
+        if user is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        user_cache.set(user_id, user)
+    # Copy so a view changing request.user never touches the shared instance
+    return copy.copy(user)
+
+
+def _state_key(user_id):
+    return f'user-state:{user_id}'
+
+
+def get_user_state(user_id):
+    """(is_active, role_version) of a user from the shared 'auth' cache, or None if deleted."""
+    cache = caches['auth']
+    state = cache.get(_state_key(user_id))
+    if state is None:
+        state = User.objects.filter(pk=user_id).values_list('is_active', 'role_version').first() or ()
+        cache.set(_state_key(user_id), tuple(state))
+    return tuple(state) or None
+
+
+def forget_user_state(user_ids):
+    """Drop the cached state of user_ids in every worker once the change is committed."""
+    keys = [_state_key(user_id) for user_id in user_ids]
+    transaction.on_commit(lambda: caches['auth'].delete_many(keys))
+
+
+class TokenClaimsUser(SimpleLazyObject):
+    """request.user built from JWT claims.
+
+    id, email, is_staff and role_version are answered from the token and
+    is_active from the shared user state. Anything else (saving it as a foreign key, reading user_name, ...)
+    loads the real User through user_cache on first use.
+    """
+
+    def __init__(self, user_id, claims):
+        super().__init__(lambda: get_cached_user(user_id))
+        self.__dict__['_claims'] = claims
+
+    def __getattr__(self, name):
+        if self._wrapped is empty and name in self._claims:
+            return self._claims[name]
+        return super().__getattr__(name)
+
+    def __copy__(self):
+        if self._wrapped is empty:
+            return TokenClaimsUser(self._claims['pk'], self._claims)
+        return copy.copy(self._wrapped)
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that does not query polls_user on every request."""
+
+    def get_user(self, validated_token):
+        # Tokens issued before the claims were added, and revoke checks that
+        # need the password hash, still take the DB path
+        if (jwt_settings.CHECK_REVOKE_TOKEN or 'role_version' not in validated_token
+                or 'is_staff' not in validated_token):
+            return super().get_user(validated_token)
+
+        try:
+            user_id = User._meta.pk.to_python(validated_token[jwt_settings.USER_ID_CLAIM])
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        # Deletion, deactivation and role changes are seen by every worker through
+        # the shared cache, so the token stops working as soon as they commit
+        state = get_user_state(user_id)
+        if state is None:
+            raise AuthenticationFailed("User not found", code="user_not_found")
+        is_active, role_version = state
+        if jwt_settings.CHECK_USER_IS_ACTIVE and not is_active:
+            raise AuthenticationFailed("User is inactive", code="user_inactive")
+        if role_version != validated_token['role_version']:
+            raise InvalidToken("Token roles are out of date; refresh it")
+
+        return TokenClaimsUser(user_id, {
+            'id': user_id,
+            'pk': user_id,
+            'email': validated_token.get('email'),
+            'is_staff': validated_token['is_staff'],
+            'is_active': is_active,
+            'is_authenticated': True,
+            'is_anonymous': False,
+            'role_version': validated_token['role_version'],
+        })
+
+
+class BloomRefreshToken(RefreshToken):
+    """RefreshToken that skips the blacklist query for JTIs the Bloom filter has never seen."""
+
+    def check_blacklist(self):
+        if blacklist_filter.might_contain(self.payload[jwt_settings.JTI_CLAIM]):
+            super().check_blacklist()
@@ -0,0 +1,58 @@
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from polls.models import Category, Inventory, Product, Sale, SaleItem
+from polls.utils.checkout import create_sale
+
+
+def per_line_checkout(items_data, **sale_fields):
+    """The checkout SaleSerializer.create did before create_sale(): one SaleItem.save() per line."""
+    with transaction.atomic():
+        sale = Sale.objects.create(**sale_fields)
+        for item_data in items_data:
+            SaleItem.objects.create(sale=sale, product=item_data['product'], qty=item_data.get('qty', 1))
+    return sale
+
+
+PATHS = [('per-line', per_line_checkout), ('batched', create_sale)]
+
+
+def measure(checkout, items_data, repeat):
+    """(queries per checkout, median seconds per checkout) over repeat checkouts."""
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            checkout(items_data)
+            timings.append(time.perf_counter() - started)
+    return len(queries.captured_queries), statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = "Compare query count and latency of batched checkout with the per-line path; nothing is kept"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, nargs='+', default=[1, 10, 100], help="Basket sizes to check out")
+        parser.add_argument('--repeat', type=int, default=5, help="Checkouts per basket size and path")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            category = Category.objects.create(name='Checkout benchmark')
+            products = []
+            for i in range(max(options['lines'])):
+                product = Product.objects.create(name=f'Checkout benchmark {i}', price=Decimal('2.50'), category=category)
+                Inventory.objects.create(product=product, qty=1000000)
+                products.append(product)
+
+            for lines in options['lines']:
+                items_data = [{'product': product, 'qty': 1} for product in products[:lines]]
+                for name, checkout in PATHS:
+                    queries, seconds = measure(checkout, items_data, options['repeat'])
+                    self.stdout.write(f"{lines:>4} lines  {name:<8}  {queries:>4} queries  {seconds * 1000:8.2f} ms")
+            transaction.set_rollback(True)
+        self.stdout.write(self.style.SUCCESS("Benchmark data rolled back."))
@@ -0,0 +1,54 @@
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from polls import messagepack
+from polls.messagepack import MessagePackRenderer
+from polls.models import Category, Product
+from polls.serializers import ProductSerializer
+from polls.utils.fast_serializers import ValuesSerializer
+
+FORMATS = [
+    ('json', JSONRenderer(), None),
+    ('msgpack', MessagePackRenderer(), messagepack.MEDIA_TYPE),
+    ('msgpack+intern', MessagePackRenderer(), messagepack.MEDIA_TYPE + '; intern=1'),
+]
+
+
+class Command(BaseCommand):
+    help = "Compare body size and encode time of a product list as JSON and MessagePack; nothing is kept"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000, help="Products in the list")
+        parser.add_argument('--repeat', type=int, default=5, help="Encodes per format")
+
+    def handle(self, *args, **options):
+        if messagepack.msgpack is None:
+            raise CommandError("msgpack is not installed.")
+
+        with transaction.atomic():
+            category = Category.objects.create(name='Format benchmark')
+            products = Product.objects.bulk_create([
+                Product(name=f'Format benchmark {i}', description='A product description', price=Decimal('2.25'),
+                        category=category)
+                for i in range(options['rows'])
+            ])
+            fast_serializer = ValuesSerializer(ProductSerializer)
+            queryset = Product.objects.filter(pk__gte=products[0].pk).order_by('pk')
+            data = fast_serializer.to_representation(fast_serializer.values(queryset))
+            transaction.set_rollback(True)
+
+        for name, renderer, media_type in FORMATS:
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                body = renderer.render(data, media_type)
+                timings.append(time.perf_counter() - started)
+            self.stdout.write(
+                f"{name:<15} {len(data):>6} products  {len(body):>9} bytes  {statistics.median(timings) * 1000:8.2f} ms"
+            )
+        self.stdout.write(self.style.SUCCESS("Benchmark data rolled back."))
@@ -0,0 +1,72 @@
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from polls.models import Category, Product, Sale, SaleItem
+from polls.serializers import ProductSerializer, SaleSerializer
+from polls.utils.fast_serializers import FastJSONRenderer, ValuesSerializer
+
+
+def render_serializer(serializer_class, queryset):
+    return JSONRenderer().render(serializer_class(queryset, many=True).data)
+
+
+def render_fast(serializer_class, queryset):
+    fast_serializer = ValuesSerializer(serializer_class)
+    return FastJSONRenderer().render(fast_serializer.to_representation(fast_serializer.values(queryset)))
+
+
+CASES = [
+    (ProductSerializer, lambda first: Product.objects.filter(pk__gte=first['product']).order_by('pk')),
+    (SaleSerializer,
+     lambda first: SaleSerializer.setup_eager_loading(Sale.objects.filter(pk__gte=first['sale']).order_by('pk'))),
+]
+
+
+def median_seconds(render, serializer_class, queryset, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = render(serializer_class, queryset.all())
+        timings.append(time.perf_counter() - started)
+    return body, statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = "Compare list rendering through the serializers with the values() fast path; nothing is kept"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help="Products and sales to render")
+        parser.add_argument('--repeat', type=int, default=3, help="Renders per serializer and path")
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        with transaction.atomic():
+            category = Category.objects.create(name='Serializer benchmark')
+            products = Product.objects.bulk_create([
+                Product(name=f'Serializer benchmark {i}', price=Decimal('2.25'), category=category)
+                for i in range(rows)
+            ])
+            sales = Sale.objects.bulk_create([Sale(total_amount=Decimal('4.50')) for _ in range(rows)])
+            sold = products[:100]  # Few enough distinct products for SQLite's expression limit in the prefetch
+            SaleItem.objects.bulk_create([
+                SaleItem(sale=sale, product=sold[i % len(sold)], qty=2, price=Decimal('2.25'), subtotal=Decimal('4.50'))
+                for i, sale in enumerate(sales)
+            ])
+
+            for serializer_class, queryset in CASES:
+                queryset = queryset({'product': products[0].pk, 'sale': sales[0].pk})
+                slow, slow_time = median_seconds(render_serializer, serializer_class, queryset, options['repeat'])
+                fast, fast_time = median_seconds(render_fast, serializer_class, queryset, options['repeat'])
+                if fast != slow:
+                    raise CommandError(f"{serializer_class.__name__}: the fast path renders different bytes")
+                self.stdout.write(
+                    f"{serializer_class.__name__:<18} {rows:>6} rows  serializer {slow_time * 1000:9.1f} ms  "
+                    f"fast path {fast_time * 1000:9.1f} ms"
+                )
+            transaction.set_rollback(True)
+        self.stdout.write(self.style.SUCCESS("Benchmark data rolled back."))
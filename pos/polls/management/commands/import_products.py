@@ -0,0 +1,37 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.utils.product_import import CHUNK_SIZE, csv_records, import_products, ndjson_records
+
+
+class Command(BaseCommand):
+    help = "Upsert products, categories and stock from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help="Defaults to the file extension")
+        parser.add_argument('--batch-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--user', help="Email recorded as created_by/updated_by")
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = get_user_model().objects.filter(email=options['user']).first()
+            if user is None:
+                raise CommandError(f"No user with email {options['user']}")
+
+        path = options['path']
+        fmt = options['format'] or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+        with open(path, 'rb') as f:
+            records = ndjson_records(f) if fmt == 'ndjson' else csv_records(f)
+            summary = import_products(records, user=user, chunk_size=options['batch_size'])
+
+        for error in summary.errors:
+            self.stdout.write(f"Line {error['line']}: {json.dumps(error['errors'])}")
+        if summary.rejected > len(summary.errors):
+            self.stdout.write(f"... and {summary.rejected - len(summary.errors)} more rejected rows")
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {summary.created}, updated {summary.updated}, rejected {summary.rejected} products."
+        ))
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from polls.models import Sale
+from polls.utils.rollups import parse_bound, rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the hourly and daily sales rollups from the sales and refunds, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help="First day to rebuild (default: the first sale)")
+        parser.add_argument('--to', dest='end', help="Last day to rebuild, included (default: today)")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        start = parse_bound(options['start']) if options['start'] else Sale.objects.aggregate(first=Min('created_at'))['first']
+        end = parse_bound(options['end'], end=True) if options['end'] else timezone.now() + timedelta(days=1)
+        if (options['start'] and start is None) or (options['end'] and end is None):
+            raise CommandError("--from and --to take dates such as 2026-01-31")
+        if start is None:
+            self.stdout.write("No sales to roll up.")
+            return
+
+        counts = rebuild(start, end, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {counts['days']} days from {counts['sales']} sales and {counts['refund_items']} refund lines."
+        ))
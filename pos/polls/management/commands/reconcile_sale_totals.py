@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from polls.models import Sale, SaleItem
+
+
+class Command(BaseCommand):
+    help = "Check Sale.total_amount against the sum of its items and repair drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help="Report mismatches without fixing them")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        checked = repaired = 0
+
+        while True:
+            with transaction.atomic():
+                # Lock one batch of sales so concurrent line edits wait for the repair
+                sales = list(
+                    Sale.objects.select_for_update()
+                    .filter(id__gt=last_id)
+                    .order_by('id')
+                    .only('id', 'total_amount')[:batch_size]
+                )
+                if not sales:
+                    break
+                last_id = sales[-1].id
+
+                totals = dict(
+                    SaleItem.objects.filter(sale__in=sales)
+                    .values_list('sale_id')
+                    .annotate(total=Sum('subtotal'))
+                )
+                wrong = []
+                for sale in sales:
+                    expected = totals.get(sale.id) or 0
+                    if sale.total_amount != expected:
+                        self.stdout.write(f"Sale #{sale.id}: stored {sale.total_amount}, items sum to {expected}")
+                        sale.total_amount = expected
+                        wrong.append(sale)
+
+                if wrong and not options['dry_run']:
+                    Sale.objects.bulk_update(wrong, ['total_amount'])
+                checked += len(sales)
+                repaired += len(wrong)
+
+        verb = "Found" if options['dry_run'] else "Repaired"
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} sales. {verb} {repaired} wrong totals."))
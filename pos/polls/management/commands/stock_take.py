@@ -0,0 +1,47 @@
+import csv
+import json
+from contextlib import ExitStack
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.utils.product_import import csv_records
+from polls.utils.stock_take import CHUNK_SIZE, stock_take
+
+
+class Command(BaseCommand):
+    help = "Apply a stock count from a CSV file with product and counted_qty (or delta) columns"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--user', help="Email recorded as last_updated_by")
+        parser.add_argument('--variance-report', help="Write product, system_qty, new_qty, variance to this CSV file")
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = get_user_model().objects.filter(email=options['user']).first()
+            if user is None:
+                raise CommandError(f"No user with email {options['user']}")
+
+        with ExitStack() as stack:
+            on_variance = None
+            if options['variance_report']:
+                # Written as the chunks commit, so a large count is never held in memory
+                writer = csv.DictWriter(stack.enter_context(open(options['variance_report'], 'w', newline='')),
+                                        fieldnames=['product', 'system_qty', 'new_qty', 'variance'])
+                writer.writeheader()
+                on_variance = writer.writerow
+            f = stack.enter_context(open(options['path'], 'rb'))
+            report = stock_take(csv_records(f), user=user, chunk_size=options['batch_size'], on_variance=on_variance)
+
+        for error in report.errors:
+            self.stdout.write(f"Line {error['row']}: {json.dumps(error['errors'])}")
+        if report.rejected > len(report.errors):
+            self.stdout.write(f"... and {report.rejected - len(report.errors)} more rejected rows")
+        self.stdout.write(self.style.SUCCESS(
+            f"Counted {report.counted} rows: {report.adjusted} inventory records updated, {report.created} created, "
+            f"{report.rejected} rejected; {report.varied} variances "
+            f"(shrinkage {report.shrinkage}, surplus {report.surplus})."
+        ))
@@ -0,0 +1,104 @@
+import datetime
+import decimal
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils import encoders
+
+try:
+    import msgpack
+except ImportError:  # Optional: settings only register these classes when it is installed
+    msgpack = None
+
+MEDIA_TYPE = 'application/msgpack'
+
+# Envelope of a key-interned body: every map key is replaced by its index in KEYS
+KEYS = '$keys'
+DATA = '$data'
+
+_json_default = encoders.JSONEncoder().default
+
+
+def encode_default(obj):
+    """MessagePack encoding of the types msgpack does not know.
+
+    Decimals are sent as their exact string, like JSON does with
+    COERCE_DECIMAL_TO_STRING. Timezone-aware datetimes use the standard
+    timestamp extension (type -1); naive ones, dates and times are ISO 8601
+    strings. Everything else is encoded like DRF's JSONEncoder would.
+    """
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, datetime.datetime) and obj.tzinfo is not None:
+        return msgpack.Timestamp.from_datetime(obj)
+    return _json_default(obj)
+
+
+def intern_keys(data):
+    """Replace every map key in data by its index into a key table sent alongside."""
+    table = {}
+
+    def walk(value):
+        if isinstance(value, dict):
+            return {table.setdefault(key, len(table)): walk(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [walk(item) for item in value]
+        return value
+
+    data = walk(data)
+    return {KEYS: list(table), DATA: data}
+
+
+def restore_keys(data):
+    """Undo intern_keys; any other payload is returned as it is."""
+    if not (isinstance(data, dict) and data.keys() == {KEYS, DATA}):
+        return data
+    keys = data[KEYS]
+
+    def walk(value):
+        if isinstance(value, dict):
+            return {keys[key]: walk(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [walk(item) for item in value]
+        return value
+
+    return walk(data[DATA])
+
+
+def packb(data):
+    return msgpack.packb(data, default=encode_default, use_bin_type=True)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """MessagePack bodies for terminals (Accept: application/msgpack or ?format=msgpack).
+
+    Adding `intern=1` to the Accept header (application/msgpack; intern=1)
+    sends each distinct map key once, see intern_keys.
+    """
+    media_type = MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if 'intern=1' in (accepted_media_type or '').replace(' ', ''):
+            data = intern_keys(data)
+        return packb(data)
+
+
+class MessagePackParser(BaseParser):
+    """Parses MessagePack request bodies, interned or not; timestamps become aware datetimes."""
+    media_type = MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            data = msgpack.unpackb(stream.read(), raw=False, timestamp=3, strict_map_key=False)
+        except (ValueError, TypeError) as exc:  # msgpack's unpack errors are ValueErrors
+            raise ParseError(f'MessagePack parse error - {exc or type(exc).__name__}')
+        try:
+            return restore_keys(data)
+        except (IndexError, TypeError) as exc:
+            raise ParseError(f'MessagePack parse error - bad interned key: {exc}')
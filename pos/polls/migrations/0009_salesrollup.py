@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0008_user_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('level', models.CharField(choices=[('total', 'Total'), ('category', 'Category'), ('product', 'Product')], max_length=8)),
+                ('period', models.DateTimeField()),
+                ('product_id', models.IntegerField(default=0)),
+                ('category_id', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('units', models.IntegerField(default=0)),
+                ('sale_count', models.IntegerField(default=0)),
+                ('refunded_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('refunded_units', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('granularity', 'level', 'period', 'product_id', 'category_id')},
+            },
+        ),
+    ]
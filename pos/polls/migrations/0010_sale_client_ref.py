@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0009_salesrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='client_ref',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='sale',
+            unique_together={('created_by', 'client_ref')},
+        ),
+    ]
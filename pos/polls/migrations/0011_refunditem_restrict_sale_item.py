@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0010_sale_client_ref'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='refunditem',
+            name='sale_item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, related_name='refund_items', to='polls.saleitem'),
+        ),
+    ]
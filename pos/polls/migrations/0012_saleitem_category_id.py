@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:30
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def snapshot_categories(apps, schema_editor):
+    # Lines sold before the snapshot take their product's current category
+    SaleItem = apps.get_model('polls', 'SaleItem')
+    Product = apps.get_model('polls', 'Product')
+    category = Product.objects.filter(pk=OuterRef('product_id')).values('category_id')[:1]
+    SaleItem.objects.update(category_id=Coalesce(Subquery(category), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0011_refunditem_restrict_sale_item'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='saleitem',
+            name='category_id',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(snapshot_categories, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,12 @@
-from django.db import models
+from django.db import connection, models
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.lookups import Exact, LessThan
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
+from django.utils import timezone
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
         if not email:
@@ -47,6 +52,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_staff = models.BooleanField(default=False)
     is_active = models.BooleanField(default=True)
     roles = models.ManyToManyField(Role, through='UserRole')
+    role_version = models.PositiveIntegerField(default=0, editable=False)  # Bumped when roles/authorities change
+    updated_at = models.DateTimeField(auto_now=True, editable=False)
 
     objects = CustomUserManager()
 
@@ -63,12 +70,16 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.roles.filter(name=role_name).exists()
 
     def get_authorities(self):
-        return Authority.objects.filter(
-            roleauthority__role__in=self.roles.all()
-        ).distinct()
+        return Authority.objects.filter(name__in=self.get_authority_names())
+
+    def get_authority_names(self):
+        from polls.utils.authorities import registry
+        return registry.authority_names(self)
 
     def has_authority(self, authority_name):
-        return self.get_authorities().filter(name=authority_name).exists()
+        # Bitmask lookup in the in-process registry; no query once cached
+        from polls.utils.authorities import registry
+        return registry.has_authority(self, authority_name)
 
 class UserRole(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -99,7 +110,7 @@ class Category(models.Model):
         related_name='updated_categories'
     )
     created_at = models.DateTimeField(auto_now_add=True, editable=False)  # Auto-filled on creation
-    updated_at = models.DateTimeField(auto_now=True, editable=False)      # Auto-filled on update
+    updated_at = models.DateTimeField(auto_now=True, editable=False, db_index=True)  # Auto-filled on update; indexed for catalog sync
 
     class Meta:
         verbose_name_plural = 'Categories'
@@ -108,6 +119,35 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+def value_case(model, field_name, values, output_field):
+    """CASE picking values[key] by the row's field_name column, for a per-row UPDATE.
+
+    Written out as raw SQL: for thousands of keys the equivalent
+    Case(When(...)) spends seconds in expression resolution.
+    """
+    column = connection.ops.quote_name(model._meta.get_field(field_name).column)
+    return RawSQL(
+        f"CASE {column}{' WHEN %s THEN %s' * len(values)} END",
+        [value for item in values.items() for value in item],
+        output_field=output_field,
+    )
+
+
+class ProductManager(models.Manager):
+    def set_prices(self, prices, updated_by=None):
+        """Set {product_id: price} in a single UPDATE; returns the number of rows updated.
+
+        updated_at is set explicitly, update() does not apply auto_now.
+        """
+        if not prices:
+            return 0
+        return self.filter(pk__in=prices).update(
+            price=value_case(Product, 'id', prices, models.DecimalField(max_digits=10, decimal_places=2)),
+            updated_by=updated_by,
+            updated_at=timezone.now(),
+        )
+
+
 class Product(models.Model):
     active = models.BooleanField(default=True)
     description = models.TextField(blank=True, null=True)
@@ -134,7 +174,9 @@ class Product(models.Model):
         related_name='updated_products'
     )
     created_at = models.DateTimeField(auto_now_add=True, editable=False)  # Auto-filled on creation
-    updated_at = models.DateTimeField(auto_now=True, editable=False)      # Auto-filled on update
+    updated_at = models.DateTimeField(auto_now=True, editable=False, db_index=True)  # Auto-filled on update; indexed for catalog sync
+
+    objects = ProductManager()
 
     class Meta:
         ordering = ['name']
@@ -142,7 +184,53 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
+class InventoryManager(models.Manager):
+    def adjust_stock(self, deltas):
+        """Apply {product_id: delta} to stock in a single guarded UPDATE.
+
+        Rows whose stock would drop below zero are left untouched, so the
+        caller can compare the returned row count with len(deltas).
+        """
+        deltas = {pid: delta for pid, delta in deltas.items() if delta}
+        if not deltas:
+            return 0
+        delta = Case(
+            *[When(product_id=pid, then=Value(d)) for pid, d in deltas.items()],
+            output_field=IntegerField(),
+        )
+        required = Case(
+            *[When(product_id=pid, then=Value(max(-d, 0))) for pid, d in deltas.items()],
+            output_field=IntegerField(),
+        )
+        new_qty = F('qty') + delta
+        # status is listed first: MySQL evaluates SET assignments left to right,
+        # so it must be computed before qty is overwritten.
+        return self.filter(product_id__in=deltas, qty__gte=required).update(
+            status=Inventory.status_expression(new_qty),
+            qty=new_qty,
+            last_updated=timezone.now(),
+        )
+
+    def set_stock(self, counts, updated_by=None):
+        """Set {product_id: qty} and the matching status in a single UPDATE.
+
+        Used for stock takes, where the counted quantity replaces the system
+        one; returns the number of rows updated.
+        """
+        if not counts:
+            return 0
+        new_qty = value_case(Inventory, 'product', counts, IntegerField())
+        return self.filter(product_id__in=counts).update(
+            status=Inventory.status_expression(new_qty),
+            qty=new_qty,
+            last_updated_by=updated_by,
+            last_updated=timezone.now(),
+        )
+
+
 class Inventory(models.Model):
+    LOW_STOCK_THRESHOLD = 10
+
     STATUS_CHOICES = [
         ('in_stock', 'In Stock'),
         ('low_stock', 'Low Stock'),
@@ -165,7 +253,9 @@ class Inventory(models.Model):
         blank=True,
         related_name='updated_inventories'
     )
-    last_updated = models.DateTimeField(auto_now=True, editable=False)
+    last_updated = models.DateTimeField(auto_now=True, editable=False, db_index=True)
+
+    objects = InventoryManager()
 
     class Meta:
         verbose_name_plural = 'Inventories'
@@ -173,13 +263,26 @@ class Inventory(models.Model):
     def __str__(self):
         return f"{self.product} - {self.qty} ({self.status})"
 
+    @classmethod
+    def status_expression(cls, qty):
+        """SQL equivalent of status_for() for a qty expression."""
+        return Case(
+            When(Exact(qty, 0), then=Value('out_of_stock')),
+            When(LessThan(qty, cls.LOW_STOCK_THRESHOLD), then=Value('low_stock')),
+            default=Value('in_stock'),
+        )
+
+    @classmethod
+    def status_for(cls, qty):
+        """Stock status for qty; used by save() and by bulk writes that skip it."""
+        if qty == 0:
+            return 'out_of_stock'
+        if qty < cls.LOW_STOCK_THRESHOLD:
+            return 'low_stock'
+        return 'in_stock'
+
     def save(self, *args, **kwargs):
-        if self.qty == 0:
-            self.status = 'out_of_stock'
-        elif self.qty < 10:
-            self.status = 'low_stock'
-        else:
-            self.status = 'in_stock'
+        self.status = self.status_for(self.qty)
         super().save(*args, **kwargs)
 
 
@@ -189,6 +292,12 @@ class Sale(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='sales')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Terminal's own id for a sale uploaded from its offline queue, so re-uploads are skipped
+    client_ref = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['created_at', 'id'])]  # Keyset pagination
+        unique_together = ('created_by', 'client_ref')
 
     def __str__(self):
         return f"Sale #{self.id} - {self.total_amount}"
@@ -200,6 +309,9 @@ class SaleItem(models.Model):
     qty = models.PositiveIntegerField(default=1)
     price = models.DecimalField(max_digits=10, decimal_places=2, editable=False)
     subtotal = models.DecimalField(max_digits=10, decimal_places=2, editable=False)
+    # Category of the product when sold, 0 for none: the sales rollups keep the
+    # line under it when the product is moved. A plain id, like SalesRollup's
+    category_id = models.IntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = 'Sale Item'
@@ -212,36 +324,144 @@ class SaleItem(models.Model):
         if not self.product:
             raise ValidationError("Product is required")
         self.price = self.product.price
+        self.category_id = self.product.category_id or 0
         if self.qty <= 0:
             raise ValidationError("Quantity must be positive")
         self.subtotal = self.qty * self.price
 
+        from polls.utils.rollups import record_sales, sale_lines
+
         with transaction.atomic():
+            # Work out the net stock change so it can be applied as one
+            # guarded UPDATE instead of a read-modify-write in Python.
+            deltas = {self.product_id: -self.qty}
+            totals = {self.sale_id: self.subtotal}
             if self.pk:
-                old_item = SaleItem.objects.get(pk=self.pk)
-                if old_item.product and old_item.qty != self.qty:
-                    old_item.product.inventory.qty += old_item.qty
-                    old_item.product.inventory.save()
-
-            inv = self.product.inventory
-            if inv.qty < self.qty:
+                # Lock the sale before the line, in the order refund_sale() does
+                old_sale_id = SaleItem.objects.filter(pk=self.pk).values_list('sale_id', flat=True).get()
+                Sale.objects.select_for_update().filter(pk=old_sale_id).first()
+                old_item = SaleItem.objects.select_for_update().get(pk=self.pk)
+                # Refunded units are already back in stock, so a line may not
+                # drop below them or move them to another sale or product
+                refunded = old_item.refunded_qty()
+                if refunded and (self.product_id, self.sale_id) != (old_item.product_id, old_item.sale_id):
+                    raise ValidationError("A refunded line cannot be moved to another product or sale.")
+                if self.qty < refunded:
+                    raise ValidationError(f"Quantity cannot be below the {refunded} already refunded.")
+                if old_item.product_id:
+                    deltas[old_item.product_id] = deltas.get(old_item.product_id, 0) + old_item.qty
+                totals[old_item.sale_id] = totals.get(old_item.sale_id, 0) - old_item.subtotal
+            before = sale_lines(totals)
+
+            changed = sum(1 for delta in deltas.values() if delta)
+            if Inventory.objects.adjust_stock(deltas) != changed:
                 raise ValidationError(f"Not enough stock for {self.product.name}")
-            inv.qty -= self.qty
-            inv.save()
 
             super().save(*args, **kwargs)
 
-            total = self.sale.items.aggregate(total=models.Sum('subtotal'))['total'] or 0
-            Sale.objects.filter(pk=self.sale.pk).update(total_amount=total)
+            # Keep the sale total in step with a delta rather than re-summing every line
+            for sale_id, delta in totals.items():
+                if delta:
+                    Sale.objects.filter(pk=sale_id).update(
+                        total_amount=F('total_amount') + delta, updated_at=timezone.now()
+                    )
+            record_sales(Sale.objects.filter(pk__in=totals).only('id', 'created_at'), before)
 
     def delete(self, *args, **kwargs):
-        if self.product:
-            inv = self.product.inventory
-            inv.qty += self.qty
-            inv.save()
-        super().delete(*args, **kwargs)
-        total = self.sale.items.aggregate(total=models.Sum('subtotal'))['total'] or 0
-        Sale.objects.filter(pk=self.sale.pk).update(total_amount=total)
+        from polls.utils.rollups import record_sales, sale_lines
 
-    
+        with transaction.atomic():
+            Sale.objects.select_for_update().filter(pk=self.sale_id).first()  # Serialises with refunds
+            if self.refunded_qty():
+                raise ValidationError("A line with refunds cannot be deleted.")
+            before = sale_lines([self.sale_id])
+            if self.product_id:
+                Inventory.objects.adjust_stock({self.product_id: self.qty})
+            result = super().delete(*args, **kwargs)
+            Sale.objects.filter(pk=self.sale_id).update(
+                total_amount=F('total_amount') - self.subtotal, updated_at=timezone.now()
+            )
+            record_sales(Sale.objects.filter(pk=self.sale_id).only('id', 'created_at'), before)
+        return result
+
+    def refunded_qty(self):
+        return self.refund_items.aggregate(qty=Sum('qty'))['qty'] or 0
+
+
+class Refund(models.Model):
+    """Append-only record of a refund; the refunded sale itself is left untouched."""
+    sale = models.ForeignKey(Sale, on_delete=models.CASCADE, related_name='refunds')
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    reason = models.CharField(max_length=255, blank=True, default='')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='refunds')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Refund #{self.id} of Sale #{self.sale_id} - {self.amount}"
+
+
+class RefundItem(models.Model):
+    refund = models.ForeignKey(Refund, on_delete=models.CASCADE, related_name='items')
+    # Deleting the sale deletes its refunds too, but a refunded line alone cannot be deleted
+    sale_item = models.ForeignKey(SaleItem, on_delete=models.RESTRICT, related_name='refund_items')
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True, related_name='refund_items')
+    qty = models.PositiveIntegerField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        verbose_name = 'Refund Item'
+        verbose_name_plural = 'Refund Items'
+
+    def __str__(self):
+        return f"{self.qty} x {self.product or 'Deleted Product'} refunded"
+
+class SalesRollup(models.Model):
+    """Sales totals per hour or day, kept up to date by polls.utils.rollups.
+
+    One row per period and level: the whole shop (total), a category, or a
+    product within the category it belonged to. Ids are plain integers, 0
+    where the level has none (and for uncategorized products), so history
+    outlives deleted products and categories.
+    """
+    HOUR = 'hour'
+    DAY = 'day'
+    GRANULARITY_CHOICES = [(HOUR, 'Hour'), (DAY, 'Day')]
+    TOTAL = 'total'
+    CATEGORY = 'category'
+    PRODUCT = 'product'
+    LEVEL_CHOICES = [(TOTAL, 'Total'), (CATEGORY, 'Category'), (PRODUCT, 'Product')]
+
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    level = models.CharField(max_length=8, choices=LEVEL_CHOICES)
+    period = models.DateTimeField()  # Start of the hour or day, in TIME_ZONE
+    product_id = models.IntegerField(default=0)
+    category_id = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units = models.IntegerField(default=0)
+    sale_count = models.IntegerField(default=0)  # Sales with at least one line at this level
+    refunded_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)  # By refund time
+    refunded_units = models.IntegerField(default=0)
+
+    class Meta:
+        # Also the index reports read by: granularity, level, then a period range
+        unique_together = ('granularity', 'level', 'period', 'product_id', 'category_id')
+
+    def __str__(self):
+        return f"{self.granularity} {self.period} {self.level} - {self.revenue}"
+
+
+class IdempotencyKey(models.Model):
+    """Stored response for a client-supplied Idempotency-Key header."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = ('user', 'key')
+
+    def __str__(self):
+        return f"{self.user} - {self.key}"
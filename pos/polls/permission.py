@@ -1,15 +1,28 @@
 from rest_framework.permissions import BasePermission
 
+
+def token_roles(request):
+    """Role names embedded in the request's JWT, or None if it carries none."""
+    payload = getattr(request.auth, 'payload', None)
+    if not payload or 'role_version' not in payload:
+        return None
+    return set(payload.get('roles', ()))
+
+
 class IsAdminRole(BasePermission):
     def has_permission(self, request, view):
-        return (
-            request.user.is_authenticated and 
-            request.user.roles.filter(name='admin').exists()
-        )
+        if not request.user.is_authenticated:
+            return False
+        roles = token_roles(request)
+        if roles is not None:
+            return 'admin' in roles
+        return request.user.roles.filter(name='admin').exists()
 
 class IsUserOrAdmin(BasePermission):
     def has_permission(self, request, view):
-        return (
-            request.user.is_authenticated and 
-            request.user.roles.filter(name__in=['admin', 'user']).exists()
-        )
+        if not request.user.is_authenticated:
+            return False
+        roles = token_roles(request)
+        if roles is not None:
+            return bool(roles & {'admin', 'user'})
+        return request.user.roles.filter(name__in=['admin', 'user']).exists()
@@ -1,17 +1,236 @@
+from collections.abc import Mapping
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
 from rest_framework import serializers
-from polls.models import Category, Product,Sale, Inventory, SaleItem,User,Authority,Role,UserRole
+from polls.models import Category, Product,Sale, Inventory, SaleItem,User,Authority,Role,UserRole,SalesRollup
 from django.contrib.auth import get_user_model
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from polls.authentication import BloomRefreshToken
+from polls.signals import bump_role_version
+from polls.utils.authorities import registry
+from polls.utils.checkout import create_sale, update_sale
+from polls.utils.repricing import ROUNDING
 User = get_user_model()
 
 
+class EagerLoadingMixin:
+    """Lets a serializer declare the relations it reads in Meta.
+
+    Meta.select_related / Meta.prefetch_related list the lookups a queryset
+    needs so that serializing many rows does not cost a query per row.
+    """
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        select = getattr(cls.Meta, 'select_related', ())
+        prefetch = getattr(cls.Meta, 'prefetch_related', ())
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+
+def _related_pk(queryset, value):
+    """value as the queryset model's primary key, or None if it cannot be one."""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        return queryset.model._meta.pk.to_python(value)
+    except DjangoValidationError:
+        return None
+
+
+def _collect_related_pks(serializer, data, found):
+    # Walk the incoming data alongside the serializer tree
+    if isinstance(serializer, serializers.ListSerializer):
+        if isinstance(data, list):
+            for item in data:
+                _collect_related_pks(serializer.child, item, found)
+        return
+    if not isinstance(data, Mapping) or not hasattr(serializer, 'fields'):
+        return
+    for name, field in serializer.fields.items():
+        if field.read_only or name not in data:
+            continue
+        value = data[name]
+        if isinstance(field, serializers.ManyRelatedField):
+            field, values = field.child_relation, value if isinstance(value, list) else []
+        else:
+            values = [value]
+        if isinstance(field, BatchedPrimaryKeyRelatedField):
+            queryset = field.get_queryset()
+            pks = found.setdefault(field.batch_key, (queryset, set()))[1]
+            pks.update(pk for pk in (_related_pk(queryset, v) for v in values) if pk is not None)
+        elif isinstance(field, serializers.BaseSerializer):
+            _collect_related_pks(field, value, found)
+
+
+class BatchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """PrimaryKeyRelatedField resolved from one in_bulk() query per queryset and payload.
+
+    The first field to validate collects every pk the root serializer's
+    initial data references through batched fields, including nested and
+    many=True items, and loads each queryset once. Errors are the same as
+    PrimaryKeyRelatedField's.
+    """
+    @cached_property
+    def batch_key(self):
+        # Fields whose querysets compile to the same SQL share a batch; compiled
+        # once per bound field, not on every value validated
+        queryset = self.get_queryset()
+        return queryset.model, str(queryset.query)
+
+    def _related_objects(self):
+        root = self.root
+        if not hasattr(root, '_batched_related'):
+            found = {}
+            _collect_related_pks(root, getattr(root, 'initial_data', None), found)
+            root._batched_related = {
+                key: queryset.in_bulk(pks) if pks else {}
+                for key, (queryset, pks) in found.items()
+            }
+        return root._batched_related.get(self.batch_key)
+
+    def to_internal_value(self, data):
+        objects = self._related_objects() if self.pk_field is None else None
+        pk = _related_pk(self.get_queryset(), data)
+        if objects is None or pk is None:
+            return super().to_internal_value(data)
+        try:
+            return objects[pk]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+
+
+def parse_field_tree(value):
+    """'id,items.product' -> {'id': {}, 'items': {'product': {}}}"""
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def expandable_serializer(name):
+    """The serializer class a Meta.expandable entry names: a class in this module or a dotted path."""
+    return import_string(name if '.' in name else f'{__name__}.{name}')
+
+
+class SparseFieldsMixin:
+    """Lets a read request trim fields (?fields=) and inline relations (?expand=).
+
+    Both take comma separated names, dotted for nested serializers
+    (fields=id,items.qty / expand=items.product). Meta.expandable maps a
+    relation field to the serializer that replaces it when expanded, see
+    expandable_serializer. Unknown names are ignored.
+    """
+    def apply_sparse_fieldset(self, fields=None, expand=None):
+        fields, expand = fields or {}, expand or {}
+        expandable = getattr(self.Meta, 'expandable', {})
+        for name in expand:
+            if name in expandable and name in self.fields:
+                self.fields[name] = expandable_serializer(expandable[name])(read_only=True)
+        if fields:
+            for name in [name for name in self.fields if name not in fields]:
+                self.fields.pop(name)
+        for name, field in self.fields.items():
+            child = getattr(field, 'child', field)
+            if isinstance(child, SparseFieldsMixin) and (fields.get(name) or expand.get(name)):
+                child.apply_sparse_fieldset(fields.get(name), expand.get(name))
+        return self
+
+    def sparse_lookups(self):
+        """(only, select_related, prefetch_related) for the fields left after trimming.
+
+        only is None when a field reads something other than model columns
+        (e.g. a SerializerMethodField), in which case no column is deferred.
+        """
+        model = self.Meta.model
+        only = {model._meta.pk.name}
+        select, prefetch = [], []
+        sources = set()
+        related = set()  # Columns read through dotted sources such as product.name
+        nested = set()  # Relations a nested serializer renders in full
+        for name, field in self.fields.items():
+            if field.write_only:
+                continue
+            try:
+                model_field = model._meta.get_field(field.source_attrs[0]) if field.source_attrs else None
+            except FieldDoesNotExist:
+                model_field = None
+            if model_field is None:
+                sources.add(name)
+                if field.source_attrs and not hasattr(model, field.source_attrs[0]):
+                    continue  # Never rendered: DRF skips the field
+                only = None
+                continue
+
+            attr = field.source_attrs[0]
+            child = getattr(field, 'child', field)
+            if not isinstance(child, serializers.BaseSerializer):
+                sources.update([name, attr])
+            if isinstance(child, SparseFieldsMixin):
+                _, child_select, child_prefetch = child.sparse_lookups()
+                lookups = [attr] + [f'{attr}__{lookup}' for lookup in child_select]
+                if field is child:
+                    select += lookups
+                else:
+                    prefetch += lookups
+                prefetch += [f'{attr}__{lookup}' for lookup in child_prefetch]
+                nested.update(lookups)
+            elif len(field.source_attrs) > 1:
+                select.append('__'.join(field.source_attrs[:-1]))
+                related.update('__'.join(field.source_attrs[:i + 1]) for i in range(1, len(field.source_attrs)))
+            if only is not None and model_field.concrete:
+                only.add(attr)
+
+        # Keep the serializer's declared eager loading for the fields still present
+        declared = [l for l in getattr(self.Meta, 'select_related', ()) if l.split('__')[0] in sources]
+        select += declared
+        prefetch += [l for l in getattr(self.Meta, 'prefetch_related', ()) if l.split('__')[0] in sources]
+        if only is not None:
+            # Narrow related rows to the columns read, unless something else needs them whole
+            nested.update(lookup.rsplit('__', 1)[0] for lookup in declared if '__' in lookup)
+            for lookup in related:
+                parts = lookup.split('__')
+                if not any('__'.join(parts[:i]) in nested for i in range(1, len(parts))):
+                    only.add(lookup)
+        return only, select, prefetch
+
+    def setup_sparse_loading(self, queryset, columns=()):
+        """queryset loading only what the fields need, plus columns (e.g. the ordering)."""
+        only, select, prefetch = self.sparse_lookups()
+        queryset = queryset.select_related(None).prefetch_related(None)
+        if select:
+            queryset = queryset.select_related(*dict.fromkeys(select))
+        if prefetch:
+            queryset = queryset.prefetch_related(*dict.fromkeys(prefetch))
+        if only is not None:
+            queryset = queryset.only(*only, *columns, *(lookup.split('__')[0] for lookup in select))
+        return queryset
+
+
+def set_role_claims(token, user):
+    """Embed the user's role and authority names so permission checks skip the DB."""
+    token['roles'] = sorted(user.roles.values_list('name', flat=True))
+    token['authorities'] = sorted(user.get_authority_names())
+    token['role_version'] = user.role_version
+
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user):
         token = super().get_token(user)
-        # Add custom claims if needed, e.g. user roles
+        # Add custom claims: enough for ClaimsJWTAuthentication and the permission classes
         token['email'] = user.email
+        token['is_staff'] = user.is_staff
+        set_role_claims(token, user)
         return token
 
     def validate(self, attrs):
@@ -19,23 +238,61 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
         # You may need to adjust authentication backend accordingly
         return super().validate(attrs)
 
+
+class MyTokenRefreshSerializer(TokenRefreshSerializer):
+    # Blacklist lookups go through the Bloom filter in BloomRefreshToken
+    token_class = BloomRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+
+        user_id = refresh.payload.get(jwt_settings.USER_ID_CLAIM)
+        user = User.objects.filter(**{jwt_settings.USER_ID_FIELD: user_id}).first()
+        if user is None or not jwt_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+
+        # Re-embed role claims when the user's roles changed since the token was issued,
+        # so access tokens pick up role changes within one access token lifetime
+        if refresh.payload.get('role_version') != user.role_version:
+            set_role_claims(refresh, user)
+        refresh['is_staff'] = user.is_staff
+
+        data = {'access': str(refresh.access_token)}
+
+        if jwt_settings.ROTATE_REFRESH_TOKENS:
+            if jwt_settings.BLACKLIST_AFTER_ROTATION:
+                # The Bloom filter may lag behind other workers; the database has the
+                # final say here, so a token rotated twice concurrently is refused
+                _, created = refresh.blacklist()
+                if not created:
+                    raise InvalidToken("Token is blacklisted")
+
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+
+            data['refresh'] = str(refresh)
+
+        return data
+
 class RoleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Role
         fields = ['id', 'name']
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
     roles = serializers.SerializerMethodField()
 
     class Meta:
         model = User
         fields = ['id', 'email', 'user_name', 'is_staff', 'is_active', 'roles']
+        prefetch_related = ['roles']
 
     def get_roles(self, obj):
-        # Return serialized role data instead of raw list
-        roles = Role.objects.filter(userrole__user=obj)
-        return RoleSerializer(roles, many=True).data
+        # Return serialized role data instead of raw list; uses prefetched roles
+        return RoleSerializer(obj.roles.all(), many=True).data
 
 
 class UserCreateUpdateSerializer(serializers.ModelSerializer):
@@ -70,18 +327,26 @@ class UserCreateUpdateSerializer(serializers.ModelSerializer):
         instance.save()
 
         if roles_data is not None:  # Replace roles completely
-            UserRole.objects.filter(user=instance).delete()
-            self._assign_roles(instance, roles_data)
+            self._assign_roles(instance, roles_data, replace=True)
 
         return instance
 
-    def _assign_roles(self, user, roles_data):
+    def _assign_roles(self, user, roles_data, replace=False):
+        roles = Role.objects.in_bulk(roles_data, field_name='name')
         for role_name in roles_data:
-            try:
-                role = Role.objects.get(name=role_name)
-                UserRole.objects.get_or_create(user=user, role=role)
-            except Role.DoesNotExist:
+            if role_name not in roles:
                 raise serializers.ValidationError(f"Role '{role_name}' does not exist")
+        current = set(UserRole.objects.filter(user=user).values_list('role_id', flat=True))
+        wanted = {role.pk for role in roles.values()}
+        if replace and current - wanted:
+            # Deleted one by one so polls.signals.user_role_changed invalidates
+            UserRole.objects.filter(user=user, role_id__in=current - wanted).delete()
+        if not wanted - current:
+            return  # Unchanged roles keep the user's tokens and cached masks valid
+        UserRole.objects.bulk_create([UserRole(user=user, role_id=role_id) for role_id in wanted - current])
+        # bulk_create sends no post_save, so invalidate like polls.signals.user_role_changed
+        bump_role_version(User.objects.filter(pk=user.pk))
+        registry.invalidate_user(user.pk)
 
 
 class UserRoleSerializer(serializers.ModelSerializer):
@@ -98,13 +363,13 @@ class AuthoritySerializer(serializers.ModelSerializer):
         fields = ['id', 'name']
 
 
-class CategorySerializer(serializers.ModelSerializer):
-    created_by = serializers.PrimaryKeyRelatedField(
+class CategorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    created_by = BatchedPrimaryKeyRelatedField(
         queryset=User.objects.all(), 
         required=False, 
         allow_null=True
     )
-    updated_by = serializers.PrimaryKeyRelatedField(
+    updated_by = BatchedPrimaryKeyRelatedField(
         queryset=User.objects.all(), 
         required=False, 
         allow_null=True
@@ -119,18 +384,18 @@ class CategorySerializer(serializers.ModelSerializer):
         # Optional: Add custom validation if needed
         return data
 
-class ProductSerializer(serializers.ModelSerializer):
-    created_by = serializers.PrimaryKeyRelatedField(
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    created_by = BatchedPrimaryKeyRelatedField(
         queryset=User.objects.all(), 
         required=False, 
         allow_null=True
     )
-    updated_by = serializers.PrimaryKeyRelatedField(
+    updated_by = BatchedPrimaryKeyRelatedField(
         queryset=User.objects.all(), 
         required=False, 
         allow_null=True
     )
-    category = serializers.PrimaryKeyRelatedField(
+    category = BatchedPrimaryKeyRelatedField(
         queryset=Category.objects.all(), 
         required=False, 
         allow_null=True
@@ -141,6 +406,7 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = ['id', 'active', 'description', 'name', 'price', 'category', 
                   'created_by', 'updated_by', 'created_at', 'updated_at']
         read_only_fields = ['created_at', 'updated_at']  # Prevent manual input
+        expandable = {'category': 'CategorySerializer'}  # ?expand=category
 
     def validate(self, data):
         # Optional: Add custom validation (e.g., ensure price is positive)
@@ -148,12 +414,12 @@ class ProductSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Price cannot be negative")
         return data
 
-class InventorySerializer(serializers.ModelSerializer):
-    product = serializers.PrimaryKeyRelatedField(
+class InventorySerializer(SparseFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    product = BatchedPrimaryKeyRelatedField(
         queryset=Product.objects.all(),
         required=True  # Product is required for Inventory
     )
-    last_updated_by = serializers.PrimaryKeyRelatedField(
+    last_updated_by = BatchedPrimaryKeyRelatedField(
         queryset=User.objects.all(),
         required=False,
         allow_null=True
@@ -165,6 +431,8 @@ class InventorySerializer(serializers.ModelSerializer):
         fields = ['id', 'active', 'qty', 'status', 'product', 'product_name', 
                   'last_updated_by', 'last_updated']
         read_only_fields = ['status', 'last_updated']  # Status is auto-set, last_updated is auto-filled
+        select_related = ['product']  # For product_name
+        expandable = {'product': 'ProductSerializer'}  # ?expand=product
 
     def validate(self, data):
         # Ensure qty is non-negative
@@ -173,43 +441,81 @@ class InventorySerializer(serializers.ModelSerializer):
         return data
 
 
-class SaleItemSerializer(serializers.ModelSerializer):
+class SaleItemSerializer(SparseFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    serializer_related_field = BatchedPrimaryKeyRelatedField  # One query per model for many lines
     product_name = serializers.CharField(source='product.name', read_only=True)
 
     class Meta:
         model = SaleItem
         fields = ['id', 'product', 'product_name', 'qty', 'price', 'subtotal']
         read_only_fields = ['price', 'subtotal', 'product_name']
+        select_related = ['product']  # For product_name
+        expandable = {'product': 'ProductSerializer'}  # ?expand=product, or items.product on sales
 
-class SaleSerializer(serializers.ModelSerializer):
+class SaleSerializer(SparseFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    serializer_related_field = BatchedPrimaryKeyRelatedField  # One query per model for many lines
     items = SaleItemSerializer(many=True)
-    created_by_name = serializers.CharField(source='created_by.username', read_only=True)
+    created_by_name = serializers.CharField(source='created_by.user_name', read_only=True)
 
     class Meta:
         model = Sale
         fields = ['id', 'customer_name', 'total_amount', 'created_by', 'created_by_name', 'created_at', 'updated_at', 'items']
         read_only_fields = ['total_amount', 'created_by_name', 'created_at', 'updated_at']
+        select_related = ['created_by']  # For created_by_name
+        prefetch_related = ['items__product']  # Nested items and their product_name
 
     def create(self, validated_data):
         items_data = validated_data.pop('items', [])
-        sale = Sale.objects.create(**validated_data)
-        for item_data in items_data:
-            SaleItem.objects.create(sale=sale, **item_data)
-        return sale
+        return create_sale(items_data, **validated_data)
 
     def update(self, instance, validated_data):
         items_data = validated_data.pop('items', None)
         instance.customer_name = validated_data.get('customer_name', instance.customer_name)
-        instance.save()
-        if items_data is not None:
-            instance.items.all().delete()
-            for item_data in items_data:
-                SaleItem.objects.create(sale=instance, **item_data)
+        if items_data is None:
+            instance.save()
+        else:
+            update_sale(instance, items_data)  # Also saves the sale with its new total
         return instance
     
 class SaleItemRefundSerializer(serializers.Serializer):
-    product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.all())
+    product = BatchedPrimaryKeyRelatedField(queryset=Product.objects.all())
     qty = serializers.IntegerField(min_value=1)
 class RefundSerializer(serializers.Serializer):
     items = SaleItemRefundSerializer(many=True)
 
+
+class ProductPriceSerializer(serializers.Serializer):
+    product = BatchedPrimaryKeyRelatedField(queryset=Product.objects.all())
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+
+
+class RepriceSerializer(serializers.Serializer):
+    # Either new prices per product...
+    prices = ProductPriceSerializer(many=True, required=False)
+    # ...or one change applied to a category or a set of products
+    category = BatchedPrimaryKeyRelatedField(queryset=Category.objects.all(), required=False)
+    products = BatchedPrimaryKeyRelatedField(queryset=Product.objects.all(), many=True, required=False)
+    percent = serializers.DecimalField(max_digits=7, decimal_places=3, min_value=-100, required=False)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, required=False)
+    rounding = serializers.ChoiceField(choices=list(ROUNDING), default='half_up')
+    dry_run = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        if 'prices' in attrs:
+            if any(name in attrs for name in ('category', 'products', 'percent', 'amount')):
+                raise serializers.ValidationError("prices cannot be combined with a category, products or a change.")
+            return attrs
+        if ('category' in attrs) == ('products' in attrs):
+            raise serializers.ValidationError("Give prices, or exactly one of category or products.")
+        if ('percent' in attrs) == ('amount' in attrs):
+            raise serializers.ValidationError("Give exactly one of percent or amount.")
+        return attrs
+
+
+class SalesRollupSerializer(serializers.ModelSerializer):
+    net_revenue = serializers.DecimalField(max_digits=14, decimal_places=2, read_only=True)  # Annotated
+
+    class Meta:
+        model = SalesRollup
+        fields = ['period', 'level', 'product_id', 'category_id', 'revenue', 'units', 'sale_count',
+                  'refunded_amount', 'refunded_units', 'net_revenue']
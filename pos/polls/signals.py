@@ -0,0 +1,83 @@
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from polls.authentication import forget_user_state, user_cache
+from polls.models import Authority, Category, Inventory, Product, Role, RoleAuthority, Sale, User, UserRole
+from polls.utils.authorities import registry
+from polls.utils.bloom import blacklist_filter
+from polls.utils.catalog import catalog
+from polls.utils.response_cache import response_cache
+from polls.utils.rollups import record_sale_deleted
+
+
+def bump_role_version(users):
+    """Invalidate the role claims embedded in the tokens of users."""
+    user_ids = list(users.values_list('pk', flat=True))
+    User.objects.filter(pk__in=user_ids).update(role_version=F('role_version') + 1, updated_at=timezone.now())
+    forget_user_state(user_ids)
+
+
+@receiver([post_save, post_delete], sender=UserRole)
+def user_role_changed(sender, instance, **kwargs):
+    bump_role_version(User.objects.filter(pk=instance.user_id))
+    registry.invalidate_user(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=RoleAuthority)
+def role_authority_changed(sender, instance, **kwargs):
+    bump_role_version(User.objects.filter(userrole__role_id=instance.role_id))
+    registry.invalidate()
+
+
+@receiver(post_save, sender=Role)
+def role_changed(sender, instance, created, **kwargs):
+    if not created:
+        bump_role_version(User.objects.filter(userrole__role=instance))
+
+
+@receiver(post_save, sender=Authority)
+def authority_changed(sender, instance, created, **kwargs):
+    if not created:
+        bump_role_version(User.objects.filter(userrole__role__roleauthority__authority=instance))
+    registry.invalidate()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    user_cache.pop(instance.pk)
+    forget_user_state([instance.pk])
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def token_blacklisted(sender, instance, created, **kwargs):
+    if created:
+        blacklist_filter.add(instance.token.jti)
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Inventory)
+@receiver(post_save, sender=Product)
+def catalog_changed(sender, instance, **kwargs):
+    catalog.mark_stale()
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    catalog.discard(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Inventory)
+def response_cache_changed(sender, instance, **kwargs):
+    response_cache.bump(sender._meta.model_name)
+
+
+# Line and refund removals cascade without signals, so take the whole sale out here
+@receiver(pre_delete, sender=Sale)
+def sale_deleted(sender, instance, **kwargs):
+    record_sale_deleted(instance)
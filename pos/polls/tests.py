@@ -1,3 +1,1331 @@
-from django.test import TestCase
+import json
+import multiprocessing
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.db.models import QuerySet
+from django.db.models.sql import Query
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework.views import APIView
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from polls import messagepack
+from polls.management.commands.bench_checkout import per_line_checkout
+from polls.management.commands.bench_serializers import render_fast, render_serializer
+from polls.messagepack import MessagePackParser, MessagePackRenderer
+from polls.models import (
+    Authority, Category, IdempotencyKey, Inventory, Product, Refund, RefundItem, Role, RoleAuthority, Sale, SaleItem,
+    SalesRollup, User, UserRole,
+)
+from polls.serializers import (
+    CategorySerializer, MyTokenObtainPairSerializer, ProductSerializer, SaleSerializer, UserCreateUpdateSerializer,
+    expandable_serializer,
+)
+from polls.authentication import user_cache
+from polls.signals import bump_role_version
+from polls.utils.authorities import registry
+from polls.utils.bloom import BlacklistFilter
+from polls.utils.catalog import CatalogSnapshot, invalidate_catalog
+from polls.utils.checkout import create_sale, lock_inventories, update_sale
+from polls.utils.fast_serializers import FastJSONRenderer, ValuesSerializer
+from polls.utils.refund import refund_sale
+from polls.utils.product_import import import_products
+from polls.utils.repricing import adjust_prices, adjusted_price, reprice_products
+from polls.utils.rollups import MEASURES, rebuild
+from polls.utils.response_cache import FileBackend, LocalBackend, response_cache
+from polls.utils import stock_take as stock_take_module
+from polls.utils.stock_take import stock_take
+from polls.views import InventoryViewSet
+
+PRODUCT_SELECT = re.compile(r'SELECT .* FROM [`"]?polls_product[`"]?(\s|$)')
+
+
+class POSTestCase(TestCase):
+    """An admin client and a category of stocked products."""
+    product_count = 100
+    stock = 1000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('admin@example.com', 'password')
+        UserRole.objects.create(user=cls.user, role=Role.objects.create(name='admin'))
+        cls.category = Category.objects.create(name='Drinks')
+        cls.products = []
+        for i in range(cls.product_count):
+            product = Product.objects.create(name=f'Product {i}', price=Decimal('2.50'), category=cls.category)
+            Inventory.objects.create(product=product, qty=cls.stock)
+            cls.products.append(product)
+
+    def setUp(self):
+        response_cache.backend.clear()  # Pages cached by another test would hide this one's queries
+        caches['auth'].clear()  # User states of rolled-back rows
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def count_queries(self, func, *args, **kwargs):
+        """(number of queries, return value) of func(*args, **kwargs)."""
+        with CaptureQueriesContext(connection) as queries:
+            result = func(*args, **kwargs)
+        return len(queries.captured_queries), result
+
+    def basket(self, lines, qty=1):
+        return {'items': [{'product': product.id, 'qty': qty} for product in self.products[:lines]]}
+
+
+class CheckoutTests(POSTestCase):
+    def test_query_count_does_not_grow_with_basket_size(self):
+        counts = {}
+        for lines in (1, 10, 100):
+            counts[lines], response = self.count_queries(
+                self.client.post, '/api/sales/', self.basket(lines), format='json'
+            )
+            self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(counts[1], counts[10], counts)
+        self.assertEqual(counts[1], counts[100], counts)
+
+    def test_fewer_queries_than_the_per_line_path(self):
+        for lines in (1, 10, 100):
+            items_data = [{'product': product, 'qty': 1} for product in self.products[:lines]]
+            batched, _ = self.count_queries(create_sale, items_data)
+            per_line, _ = self.count_queries(per_line_checkout, items_data)
+            with self.subTest(lines=lines):
+                self.assertLessEqual(batched, per_line)
+                if lines > 1:
+                    self.assertGreaterEqual(per_line, lines * 4)  # Each line locks, updates stock and total
+        self.assertEqual(Inventory.objects.get(product=self.products[0]).qty, self.stock - 6)
+
+    def test_benchmark_command_reports_both_paths_and_keeps_nothing(self):
+        out = StringIO()
+        call_command('bench_checkout', lines=[1, 3], repeat=1, stdout=out)
+        rows = [line.split() for line in out.getvalue().splitlines() if 'queries' in line]
+        self.assertEqual([(row[0], row[2]) for row in rows],
+                         [('1', 'per-line'), ('1', 'batched'), ('3', 'per-line'), ('3', 'batched')])
+        self.assertEqual(Product.objects.count(), self.product_count)
+        self.assertEqual(Sale.objects.count(), 0)
+
+    def test_checkout_deducts_stock_and_totals_once(self):
+        response = self.client.post('/api/sales/', self.basket(10, qty=3), format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()['total_amount'], '75.00')
+        self.assertEqual(Inventory.objects.get(product=self.products[0]).qty, self.stock - 3)
+        self.assertEqual(Inventory.objects.get(product=self.products[10]).qty, self.stock)
+
+    def test_not_enough_stock_rolls_back_the_whole_sale(self):
+        basket = self.basket(2)
+        basket['items'][1]['qty'] = self.stock + 1
+        response = self.client.post('/api/sales/', basket, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Not enough stock", response.json()['error'])
+        self.assertEqual(Sale.objects.count(), 0)
+        self.assertEqual(Inventory.objects.get(product=self.products[0]).qty, self.stock)
+
+
+def _terminal(product_id, attempts):
+    # One terminal in its own process: (sold, sold out) over attempts checkouts of product_id
+    sold = sold_out = 0
+    try:
+        for _ in range(attempts):
+            try:
+                create_sale([{'product': Product.objects.get(pk=product_id), 'qty': 1}])
+            except ValidationError:
+                sold_out += 1
+            else:
+                sold += 1
+    finally:
+        connections.close_all()
+    return sold, sold_out
+
+
+class ContendedStockTests(POSTestCase):
+    product_count = 1
+
+    def test_guarded_update_stops_a_stale_read_from_overselling(self):
+        # Both terminals read the last unit before either writes, as without row locks
+        product = self.products[0]
+        Inventory.objects.filter(product=product).update(qty=1)
+        stale = lock_inventories([product.pk])
+        with mock.patch('polls.utils.checkout.lock_inventories', return_value=stale):
+            create_sale([{'product': product, 'qty': 1}])
+            with self.assertRaisesMessage(ValidationError, "Not enough stock"):
+                create_sale([{'product': product, 'qty': 1}])
+        inventory = Inventory.objects.get(product=product)
+        self.assertEqual((inventory.qty, inventory.status), (0, 'out_of_stock'))
+        self.assertEqual(SaleItem.objects.filter(product=product).count(), 1)
+
+
+class HotProductStressTest(TransactionTestCase):
+    """Terminals in separate processes all selling the last units of one product."""
+    terminals = 8
+    attempts = 25  # Checkouts per terminal
+    stock = 100  # Fewer than terminals * attempts, so some must sell out
+
+    def setUp(self):
+        # SQLite only takes concurrent writers from several processes with a file
+        # test database and write locks taken up front
+        if connection.vendor == 'sqlite' and (
+            connection.is_in_memory_db() or connection.settings_dict['OPTIONS'].get('transaction_mode') != 'IMMEDIATE'
+        ):
+            self.skipTest("Needs a test database several processes can write to")
+
+    def test_hot_product_is_never_oversold(self):
+        product = Product.objects.create(name='Hot', price=Decimal('1.00'))
+        Inventory.objects.create(product=product, qty=self.stock)
+
+        connections.close_all()  # Forked terminals must open connections of their own
+        with multiprocessing.get_context('fork').Pool(self.terminals) as pool:
+            results = pool.starmap(_terminal, [(product.pk, self.attempts)] * self.terminals)
+
+        sold = sum(result[0] for result in results)
+        self.assertEqual(sum(map(sum, results)), self.terminals * self.attempts)  # No checkout errored out
+        self.assertEqual(sold, self.stock)
+        inventory = Inventory.objects.get(product=product)
+        self.assertEqual((inventory.qty, inventory.status), (0, 'out_of_stock'))
+        self.assertEqual(SaleItem.objects.filter(product=product).count(), self.stock)
+        self.assertEqual(Sale.objects.count(), self.stock)
+
+
+class BulkSaleUploadTests(POSTestCase):
+    def upload(self, sales):
+        return self.client.post('/api/sales/bulk/', {'sales': sales}, format='json')
+
+    def test_products_of_all_sales_are_loaded_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.upload([self.basket(lines) for lines in (1, 10, 100)])
+        self.assertEqual(response.status_code, 201, response.content)
+        product_selects = [q['sql'] for q in queries.captured_queries if PRODUCT_SELECT.match(q['sql'])]
+        self.assertEqual(len(product_selects), 1, product_selects)
+
+    def test_validation_queries_do_not_grow_with_the_lines(self):
+        def validate(lines):
+            serializer = SaleSerializer(data=self.basket(lines))
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+        one, _ = self.count_queries(validate, 1)
+        with mock.patch.object(Query, '__str__', autospec=True, side_effect=Query.__str__) as compiled:
+            many, _ = self.count_queries(validate, 100)
+        self.assertEqual(many, one)
+        self.assertLessEqual(compiled.call_count, 2)  # Once per bound field, not once per line
+
+
+        out_of_stock = self.basket(1, qty=self.stock + 1)
+        response = self.upload([self.basket(2), out_of_stock, {'items': [{'product': 0, 'qty': 1}]}])
+        self.assertEqual(response.status_code, 207, response.content)
+        self.assertEqual([r['status'] for r in response.json()['results']], ['created', 'failed', 'invalid'])
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_reuploaded_sales_are_not_created_again(self):
+        sales = [dict(self.basket(1), client_ref=f'terminal-1/{i}') for i in range(3)]
+        first = self.upload(sales[:2]).json()
+        response = self.upload(sales)
+        self.assertEqual(response.status_code, 201, response.content)
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], ['duplicate', 'duplicate', 'created'])
+        self.assertEqual([r['id'] for r in results[:2]], [r['id'] for r in first['results']])
+        self.assertEqual(Sale.objects.count(), 3)
+        self.assertEqual(Inventory.objects.get(product=self.products[0]).qty, self.stock - 3)
+
+
+class IdempotencyKeyTests(POSTestCase):
+    def checkout(self, key, basket):
+        return self.client.post('/api/sales/', basket, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_stored_response(self):
+        first = self.checkout('retry-1', self.basket(2, qty=3))
+        retry = self.checkout('retry-1', self.basket(2, qty=3))
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertEqual(Inventory.objects.get(product=self.products[0]).qty, self.stock - 3)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.checkout('retry-2', self.basket(1))
+        response = self.checkout('retry-2', self.basket(2))
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_rejected_request_can_be_retried_with_its_key(self):
+        basket = self.basket(1, qty=self.stock + 1)
+        self.assertEqual(self.checkout('retry-3', basket).status_code, 400)
+        Inventory.objects.filter(product=self.products[0]).update(qty=self.stock + 1)
+        self.assertEqual(self.checkout('retry-3', basket).status_code, 201)
+
+
+class RefundTests(POSTestCase):
+    def sell(self, lines, qty=3):
+        response = self.client.post('/api/sales/', self.basket(lines, qty=qty), format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.json()['id']
+
+    def refund(self, sale_id, lines, qty=1):
+        return self.client.post(f'/api/sales/{sale_id}/refund/', self.basket(lines, qty=qty), format='json')
+
+    def stock_of(self, index=0):
+        return Inventory.objects.get(product=self.products[index]).qty
+
+    def test_query_count_does_not_grow_with_refunded_lines(self):
+        counts = {}
+        for lines in (2, 50):
+            sale_id = self.sell(lines)
+            counts[lines], response = self.count_queries(self.refund, sale_id, lines)
+            self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(counts[2], counts[50], counts)
+        self.assertEqual(self.stock_of(), self.stock - 4)
+
+    def test_empty_refund_is_a_bad_request(self):
+        sale_id = self.sell(1)
+        response = self.client.post(f'/api/sales/{sale_id}/refund/', {'items': []}, format='json')
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.json()['error'], "Nothing to refund.")
+        self.assertFalse(Refund.objects.exists())
+        with self.assertRaisesMessage(ValidationError, "must be positive"):
+            refund_sale(Sale.objects.get(pk=sale_id), {self.products[0].pk: 0})
+
+    def test_line_cannot_drop_below_its_refunded_quantity(self):
+        sale_id = self.sell(1)
+        self.refund(sale_id, 1, qty=2)
+        item = SaleItem.objects.get(sale_id=sale_id)
+
+        response = self.client.patch(f'/api/saleitems/{item.pk}/', {'qty': 1}, format='json')
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(self.stock_of(), self.stock - 1)
+
+        response = self.client.patch(f'/api/saleitems/{item.pk}/', {'qty': 2}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.stock_of(), self.stock)
+
+    def test_refunded_line_cannot_be_deleted(self):
+        sale_id = self.sell(1)
+        self.refund(sale_id, 1)
+        item = SaleItem.objects.get(sale_id=sale_id)
+
+        response = self.client.delete(f'/api/saleitems/{item.pk}/')
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(self.stock_of(), self.stock - 2)
+        self.assertEqual(RefundItem.objects.filter(sale_item=item).count(), 1)
+
+    def test_deleting_a_sale_deletes_its_refunds(self):
+        sale_id = self.sell(2)
+        self.refund(sale_id, 2)
+        Sale.objects.get(pk=sale_id).delete()
+        self.assertFalse(RefundItem.objects.exists())
+
+
+class SaleUpdateTests(POSTestCase):
+    def setUp(self):
+        super().setUp()
+        response = self.client.post('/api/sales/', self.basket(2, qty=3), format='json')
+        self.sale_id = response.json()['id']
+
+    def update(self, basket):
+        return self.client.patch(f'/api/sales/{self.sale_id}/', basket, format='json')
+
+    def test_stock_and_refund_errors_are_bad_requests(self):
+        self.client.post(f'/api/sales/{self.sale_id}/refund/', self.basket(1, qty=2), format='json')
+        response = self.update(self.basket(2, qty=1))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("refunded", response.json()['error'])
+
+        response = self.update(self.basket(2, qty=self.stock + 3))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Not enough stock", response.json()['error'])
+        self.assertEqual(Inventory.objects.get(product=self.products[1]).qty, self.stock - 3)
+
+    def test_sale_is_locked_before_its_lines(self):
+        locked = []
+        select_for_update = QuerySet.select_for_update
+
+        def record(queryset, *args, **kwargs):
+            locked.append(queryset.model)
+            return select_for_update(queryset, *args, **kwargs)
+
+        sale = Sale.objects.get(pk=self.sale_id)
+        items_data = [{'product': product, 'qty': 4} for product in self.products[:2]]
+        with mock.patch.object(QuerySet, 'select_for_update', record):
+            update_sale(sale, items_data)
+        self.assertEqual(locked[:2], [Sale, SaleItem])
+
+    def test_lines_of_deleted_products_are_kept(self):
+        self.products[1].delete()
+        response = self.update(self.basket(1, qty=4))
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(SaleItem.objects.filter(sale_id=self.sale_id).count(), 2)
+        self.assertEqual(response.json()['total_amount'], '17.50')
+
+
+class CursorPaginationTests(POSTestCase):
+    product_count = 60
+
+    def setUp(self):
+        super().setUp()
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.sale_ids = []
+        for i in range(12):
+            sale = Sale.objects.create(created_by=self.user)
+            Sale.objects.filter(pk=sale.pk).update(created_at=start + timedelta(minutes=i))
+            self.sale_ids.insert(0, sale.id)  # Newest first
+
+    def walk(self, url):
+        """Ids of every page from url on, following the next links."""
+        ids = []
+        while url:
+            body = self.client.get(url).json()
+            ids += [row['id'] for row in body['results']]
+            url = body['next']
+        return ids
+
+    def test_pages_do_not_shift_when_sales_are_added(self):
+        body = self.client.get('/api/sales/?page_size=5').json()
+        first_page = [row['id'] for row in body['results']]
+        for _ in range(3):
+            Sale.objects.create(created_by=self.user)  # Newer than every listed sale
+        self.assertEqual(first_page + self.walk(body['next']), self.sale_ids)
+
+    def test_count_is_only_run_when_asked_for(self):
+        with CaptureQueriesContext(connection) as queries:
+            body = self.client.get('/api/sales/?page_size=5').json()
+        self.assertNotIn('count', body)
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(*)' in q['sql'].upper()])
+
+        body = self.client.get('/api/sales/?page_size=5&count=true').json()
+        self.assertEqual((body['count'], len(body['results'])), (12, 5))
+
+    def test_page_sizes_are_set_per_view(self):
+        self.assertEqual(len(self.client.get('/api/inventories/').json()['results']), 60)  # View default 100, not 50
+        self.assertEqual(len(self.client.get('/api/sales/').json()['results']), 12)
+        with mock.patch.object(InventoryViewSet, 'max_page_size', 8):
+            self.assertEqual(len(self.client.get('/api/inventories/?page_size=15').json()['results']), 8)
+        self.assertEqual(len(self.client.get('/api/products/?page_size=50').json()['results']), 10)
+
+
+class JWTTestCase(POSTestCase):
+    """Requests authenticated with real access tokens instead of force_authenticate."""
+    product_count = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.clerk = User.objects.create_user('clerk@example.com', 'password')
+        UserRole.objects.create(user=cls.clerk, role=Role.objects.create(name='user'))
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(None)
+
+    def get(self, url, access):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        return self.client.get(url)
+
+    def access_token(self, user, legacy=False, **claims):
+        access = MyTokenObtainPairSerializer.get_token(User.objects.get(pk=user.pk)).access_token
+        if legacy:
+            del access['role_version']  # As issued before roles were embedded
+        for name, value in claims.items():
+            access[name] = value
+        return access
+
+
+class RoleClaimTests(JWTTestCase):
+    def test_claims_replace_the_user_and_role_queries(self):
+        access, legacy_access = self.access_token(self.user), self.access_token(self.user, legacy=True)
+        self.get('/api/reports/sales/', access)  # Caches the user's state
+        with CaptureQueriesContext(connection) as claims:
+            self.assertEqual(self.get('/api/reports/sales/', access).status_code, 200)
+        with CaptureQueriesContext(connection) as legacy:
+            self.assertEqual(self.get('/api/reports/sales/', legacy_access).status_code, 200)
+        tables = re.compile(r'FROM [`"]?polls_(user|role|userrole)[`"]?\s')
+        self.assertFalse([q['sql'] for q in claims.captured_queries if tables.search(q['sql'])])
+        self.assertLess(len(claims.captured_queries), len(legacy.captured_queries))
+
+    def test_permissions_are_decided_from_the_claims(self):
+        self.assertEqual(self.get('/api/reports/sales/', self.access_token(self.clerk)).status_code, 403)
+        self.assertEqual(self.get('/api/categories/', self.access_token(self.clerk)).status_code, 200)
+        # The signed claims are trusted over the current rows until the token is refreshed
+        self.assertEqual(self.get('/api/reports/sales/', self.access_token(self.clerk, roles=['admin'])).status_code, 200)
+        self.assertEqual(self.get('/api/categories/', self.access_token(self.clerk, roles=[])).status_code, 403)
+
+    def test_tokens_without_role_version_fall_back_to_the_db(self):
+        access = self.access_token(self.clerk, legacy=True, roles=['admin'])
+        self.assertEqual(self.get('/api/reports/sales/', access).status_code, 403)
+        UserRole.objects.create(user=self.clerk, role=Role.objects.get(name='admin'))
+        self.assertEqual(self.get('/api/reports/sales/', access).status_code, 200)
+
+    def test_unchanged_roles_keep_the_tokens_valid(self):
+        def assign(*roles):
+            serializer = UserCreateUpdateSerializer(
+                User.objects.get(pk=self.clerk.pk), data={'roles': list(roles)}, partial=True)
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+            serializer.save()
+            return User.objects.get(pk=self.clerk.pk).role_version
+
+        version = User.objects.get(pk=self.clerk.pk).role_version
+        self.assertEqual(assign('user'), version)
+        self.assertGreater(assign('user', 'admin'), version)
+        version = User.objects.get(pk=self.clerk.pk).role_version
+        self.assertGreater(assign('admin'), version)
+        self.assertEqual(set(self.clerk.userrole_set.values_list('role__name', flat=True)), {'admin'})
+
+
+        tokens = self.client.post('/api/token/', {'email': 'admin@example.com', 'password': 'password'}).json()
+        self.assertEqual(self.get('/api/reports/sales/', tokens['access']).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserRole.objects.filter(user=self.user).delete()
+        self.assertEqual(self.get('/api/reports/sales/', tokens['access']).status_code, 401)
+        self.client.credentials()
+        refreshed = self.client.post('/api/token/refresh/', {'refresh': tokens['refresh']}).json()
+        self.assertEqual(self.get('/api/reports/sales/', refreshed['access']).status_code, 403)
+
+
+class ClaimsAuthenticationTests(JWTTestCase):
+    def setUp(self):
+        super().setUp()
+        self.access = self.access_token(self.clerk)
+        self.assertEqual(self.get('/api/categories/', self.access).status_code, 200)
+
+    def test_deactivated_user_is_refused_by_every_worker(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.clerk.is_active = False
+            self.clerk.save()
+        user_cache.clear()  # Another worker has none of this process's User rows
+        response = self.get('/api/categories/', self.access)
+        self.assertEqual((response.status_code, response.json()['code']), (401, 'user_inactive'))
+
+    def test_role_change_refuses_older_tokens(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            UserRole.objects.create(user=self.clerk, role=Role.objects.get(name='admin'))
+        response = self.get('/api/categories/', self.access)
+        self.assertEqual((response.status_code, response.json()['code']), (401, 'token_not_valid'))
+        self.assertEqual(self.get('/api/reports/sales/', self.access_token(self.clerk)).status_code, 200)
+
+    def test_deleted_user_is_unauthorized(self):
+        state = (True, User.objects.get(pk=self.clerk.pk).role_version)
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.filter(pk=self.clerk.pk).delete()
+        response = self.get('/api/categories/', self.access)
+        self.assertEqual((response.status_code, response.json()['code']), (401, 'user_not_found'))
+
+        # Deleted after this worker cached the state: loading the row must not 500
+        with mock.patch('polls.authentication.get_user_state', return_value=state):
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.access}')
+            response = self.client.post('/api/categories/', {'name': 'Snacks'})  # Saves request.user as created_by
+        self.assertEqual((response.status_code, response.json()['code']), (401, 'user_not_found'))
+
+
+class AuthorityRegistryTests(POSTestCase):
+    product_count = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        authorities = [Authority.objects.create(name=name) for name in ('sell', 'refund', 'reprice', 'report')]
+        cls.cashier, cls.manager = Role.objects.create(name='cashier'), Role.objects.create(name='manager')
+        for role, granted in ((cls.cashier, authorities[:2]), (cls.manager, authorities[1:])):
+            for authority in granted:
+                RoleAuthority.objects.create(role=role, authority=authority)
+        cls.clerk = User.objects.create_user('clerk@example.com', 'password')
+        UserRole.objects.create(user=cls.clerk, role=cls.cashier)
+
+    def setUp(self):
+        super().setUp()
+        registry.invalidate()
+
+    def assertMatchesDatabase(self, user):
+        user = User.objects.get(pk=user.pk)
+        granted = set(Authority.objects.filter(role__userrole__user=user).values_list('name', flat=True))
+        self.assertEqual(user.get_authority_names(), granted)
+        for name in Authority.objects.values_list('name', flat=True):
+            self.assertEqual(user.has_authority(name), name in granted, name)
+
+    def test_bits_match_the_database(self):
+        UserRole.objects.create(user=self.clerk, role=self.manager)
+        for user in (self.user, self.clerk):
+            self.assertMatchesDatabase(user)
+        clerk = User.objects.get(pk=self.clerk.pk)
+        clerk.has_authority('sell')
+        self.assertEqual(self.count_queries(clerk.has_authority, 'refund'), (0, True))
+
+        Authority.objects.get(name='sell').delete()  # Every later authority moves down a bit
+        self.assertMatchesDatabase(self.clerk)
+
+    def test_role_version_bump_drops_the_cached_mask(self):
+        clerk = User.objects.get(pk=self.clerk.pk)
+        self.assertFalse(clerk.has_authority('report'))
+        # Assigned by another worker: no signal reaches this registry, only the new role_version
+        UserRole.objects.bulk_create([UserRole(user=clerk, role=self.manager)])
+        self.assertFalse(clerk.has_authority('report'))
+        bump_role_version(User.objects.filter(pk=clerk.pk))
+        clerk.refresh_from_db()
+        self.assertTrue(clerk.has_authority('report'))
+
+
+class BlacklistFilterTests(POSTestCase):
+    product_count = 1
+
+    def outstanding(self, count, expires_at=None):
+        expires_at = expires_at or datetime(2100, 1, 1, tzinfo=timezone.utc)
+        return OutstandingToken.objects.bulk_create([
+            OutstandingToken(user=self.user, jti=f'jti-{expires_at.year}-{i}', token='-', expires_at=expires_at)
+            for i in range(count)
+        ])
+
+    def test_every_blacklisted_jti_is_refused(self):
+        tokens = self.outstanding(5)
+        # bulk_create sends no signal, like rows written by another worker
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(id=100 + i, token=tokens[i]) for i in range(3)])
+        blacklist = BlacklistFilter(sync_interval=0)
+        self.assertEqual([blacklist.might_contain(t.jti) for t in tokens], [True] * 3 + [False] * 2)
+
+        # A transaction that started before the last sync commits after it: lower id, older timestamp
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(id=50, token=tokens[3])])
+        BlacklistedToken.objects.filter(id=50).update(blacklisted_at=datetime.now(timezone.utc) - timedelta(seconds=30))
+        self.assertEqual([blacklist.might_contain(t.jti) for t in tokens], [True] * 4 + [False])
+        self.assertEqual(blacklist._filter.count, 4)  # Rows read again in the overlap are not counted twice
+
+    def test_checks_during_a_rebuild_use_the_current_filter(self):
+        tokens = self.outstanding(2)
+        BlacklistedToken.objects.create(token=tokens[0])
+        blacklist = BlacklistFilter()
+        self.assertTrue(blacklist.might_contain(tokens[0].jti))
+
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=tokens[1])])
+        build, answers = blacklist._build, []
+
+        def build_while_checking():
+            answers.append(blacklist.might_contain(tokens[1].jti))  # Would deadlock if the lock were held
+            return build()
+        with mock.patch.object(blacklist, '_build', build_while_checking):
+            blacklist.refresh(rebuild=True)
+        self.assertEqual(answers, [False])
+        self.assertTrue(blacklist.might_contain(tokens[1].jti))
+
+    def test_compact_tokens_deletes_expired_tokens_in_batches(self):
+        expired = self.outstanding(25, expires_at=datetime(2000, 1, 1, tzinfo=timezone.utc))
+        live = self.outstanding(3)
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=t) for t in expired[:5] + live[:1]])
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('compact_tokens', batch_size=10, stdout=out)
+        self.assertIn("Deleted 25 expired outstanding and 5 blacklisted tokens. "
+                      "3 outstanding and 1 blacklisted tokens remain.", out.getvalue())
+        self.assertIn("6 tokens blacklisted in the last 24 hours. Rebuilding the blacklist filter took", out.getvalue())
+        batches = [q for q in queries.captured_queries if re.search(r'LIMIT 10\b', q['sql'])]
+        self.assertEqual(len(batches), 4)  # Three batches and the empty one that ends the loop
+
+
+class CatalogSnapshotTests(POSTestCase):
+    product_count = 3
+
+    def setUp(self):
+        super().setUp()
+        # Everything last changed long ago, well outside the delta's overlap window
+        long_ago = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        Product.objects.update(updated_at=long_ago)
+        Category.objects.update(updated_at=long_ago)
+        Inventory.objects.update(last_updated=long_ago)
+        self.catalog = CatalogSnapshot(probe_interval=0)
+        for module in ('polls.views', 'polls.signals', 'polls.utils.catalog'):
+            patcher = mock.patch(f'{module}.catalog', self.catalog)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, query='', etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(f'/api/products/catalog/{query}', **headers)
+
+    def test_snapshot_lists_active_products(self):
+        response = self.get()
+        body = response.json()
+        self.assertEqual([row['id'] for row in body['products']], [p.id for p in self.products])
+        self.assertTrue(response['ETag'].startswith('"%d-' % body['version']), response['ETag'])
+
+        self.products[1].active = False
+        self.products[1].save()
+        self.assertEqual([row['id'] for row in self.get().json()['products']], [self.products[0].id, self.products[2].id])
+
+    def test_unchanged_catalog_is_not_modified(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(etag=etag).status_code, 304)
+        # Stock moves that keep every status are not a new catalog
+        Inventory.objects.adjust_stock({self.products[0].id: -1})
+        self.assertEqual(self.get(etag=etag).status_code, 304)
+
+        Inventory.objects.adjust_stock({self.products[0].id: -(self.stock - 1)})
+        response = self.get(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'].split('-')[0], etag.split('-')[0])
+        self.assertEqual(response.json()['products'][0]['status'], 'out_of_stock')
+
+    def test_since_returns_only_the_changes(self):
+        Product.objects.filter(pk=self.products[0].pk).update(updated_at=datetime(2024, 1, 2, tzinfo=timezone.utc))
+        version = self.get().json()['version']
+        self.products[2].price = Decimal('3.00')
+        self.products[2].save()
+        body = self.get(f'?since={version}').json()
+        # The product that set the version is re-sent: it falls in the overlap window
+        self.assertEqual([(row['id'], row['price']) for row in body['products']],
+                         [(self.products[0].id, '2.50'), (self.products[2].id, '3.00')])
+        self.assertGreater(body['version'], version)
+        self.assertEqual(self.get('?since=yesterday').status_code, 400)
+
+    def test_probe_runs_once_per_interval_unless_invalidated(self):
+        self.catalog.probe_interval = 60
+        etag = self.get()['ETag']
+        self.assertEqual(self.count_queries(self.catalog.get)[0], 0)
+
+        # Bulk writes send no signals; until invalidated the snapshot may lag by probe_interval
+        Product.objects.filter(pk=self.products[0].pk).update(price=Decimal('9.00'), updated_at=datetime.now(timezone.utc))
+        self.assertEqual(self.get(etag=etag).status_code, 304)
+        invalidate_catalog('product')
+        self.assertEqual(self.get(etag=etag).json()['products'][0]['price'], '9.00')
+
+
+class ResponseCacheTests(JWTTestCase):
+    def key(self, url, scope='product', models=('product',), user=None):
+        request = APIView().initialize_request(RequestFactory().get(url))
+        request.user, request.auth = user or self.user, None
+        return response_cache.key(scope, models, request)
+
+    def test_key_composition(self):
+        key = self.key('/api/products/?page=2&page_size=5')
+        self.assertEqual(key, self.key('/api/products/?page_size=5&page=2'))  # Parameter order does not matter
+        self.assertNotEqual(key, self.key('/api/products/?page=3&page_size=5'))
+        self.assertNotEqual(key, self.key('/api/products/?page=2&page_size=5', scope='category'))
+        self.assertNotEqual(key, self.key('/api/products/?page=2&page_size=5', models=('product', 'category')))
+        self.assertNotEqual(key, self.key('/api/products/?page=2&page_size=5', user=self.clerk))  # Another role class
+        response_cache.bump('product')
+        self.assertNotEqual(key, self.key('/api/products/?page=2&page_size=5'))
+
+    def test_backends(self):
+        with TemporaryDirectory() as directory:
+            for backend in (LocalBackend(ttl=60), FileBackend(directory, max_entries=3)):
+                with self.subTest(backend=type(backend).__name__):
+                    backend.set('page', {'results': [1]})
+                    self.assertEqual(backend.get('page'), {'results': [1]})
+                    self.assertIsNone(backend.get('missing'))
+                    generation = backend.generation('product')
+                    backend.bump('product')
+                    self.assertNotEqual(backend.generation('product'), generation)
+                    backend.clear()
+                    self.assertIsNone(backend.get('page'))
+
+            # Another worker's FileBackend on the same directory sees the same entries and bumps
+            first, second = FileBackend(directory, max_entries=3), FileBackend(directory)
+            first.set('page', [1])
+            first.bump('category')
+            self.assertEqual((second.get('page'), second.generation('category')), ([1], first.generation('category')))
+            for i in range(6):
+                first.set(f'page-{i}', i)
+            self.assertLessEqual(len([n for n in os.listdir(directory) if n.endswith('.entry')]), 3)
+            with mock.patch('time.time', return_value=time.time() + 301):
+                self.assertIsNone(second.get('page'))  # Past the ttl
+
+    def test_writes_bump_the_generations_they_change(self):
+        def bumped(names, write):
+            before = {name: response_cache.backend.generation(name) for name in names}
+            with self.captureOnCommitCallbacks(execute=True):
+                write()
+            return {name for name in names if response_cache.backend.generation(name) != before[name]}
+
+        names = ('category', 'product', 'inventory')
+        product = self.products[0]
+        self.assertEqual(bumped(names, lambda: Product.objects.filter(pk=product.pk).first().save()), {'product'})
+        self.assertEqual(bumped(names, lambda: import_products([(1, {'name': 'Tea', 'price': '1.00', 'qty': '2'})])),
+                         set(names))
+        self.assertEqual(bumped(names, lambda: reprice_products({product.pk: Decimal('3.00')})), {'product'})
+        self.assertEqual(bumped(names, lambda: stock_take([(0, {'product': product.pk, 'counted_qty': 5})])),
+                         {'inventory'})
+
+    def test_hit_runs_no_query(self):
+        access = self.access_token(self.user)
+        self.assertEqual(self.get('/api/products/', access)['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.get('/api/products/', access)
+        self.assertEqual((response.status_code, response['X-Cache']), (200, 'HIT'))
+
+
+class SparseFieldsetTests(POSTestCase):
+    product_count = 3
+
+    def setUp(self):
+        super().setUp()
+        User.objects.filter(pk=self.user.pk).update(user_name='till-1')
+        create_sale([{'product': product, 'qty': 1} for product in self.products], created_by=self.user)
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        # Without the conditional GET validator's aggregate
+        return response.json()['results'], [q['sql'] for q in queries.captured_queries if 'MAX(' not in q['sql']]
+
+    def test_fields_trim_nested_rows(self):
+        rows, _ = self.get('/api/sales/?fields=id,total_amount,items.qty')
+        self.assertEqual(list(rows[0]), ['id', 'total_amount', 'items'])
+        self.assertEqual(rows[0]['items'], [{'qty': 1}] * 3)
+
+    def test_only_the_columns_read_are_loaded(self):
+        rows, queries = self.get('/api/sales/?fields=id,created_by_name')
+        self.assertEqual(rows, [{'id': rows[0]['id'], 'created_by_name': 'till-1'}])
+        sale_query = next(sql for sql in queries if 'FROM "polls_sale"' in sql.replace('`', '"'))
+        self.assertIn('user_name', sale_query)
+        self.assertNotIn('password', sale_query)  # Not the whole user row
+        self.assertNotIn('customer_name', sale_query)
+
+        rows, queries = self.get('/api/inventories/?fields=id,product_name')
+        self.assertEqual(rows[-1], {'id': rows[-1]['id'], 'product_name': 'Product 0'})
+        self.assertNotIn('price', next(sql for sql in queries if 'polls_inventory' in sql))
+
+    def test_expand_inlines_related_rows(self):
+        rows, queries = self.get('/api/inventories/?expand=product&fields=id,product,product_name')
+        self.assertEqual(rows[0]['product']['price'], '2.50')  # Whole product, even with product_name narrowed
+        self.assertEqual(rows[0]['product_name'], rows[0]['product']['name'])
+        self.assertEqual(len(queries), 1)
+
+        rows, _ = self.get('/api/sales/?fields=id,items.product&expand=items.product')
+        self.assertEqual([item['product']['name'] for item in rows[0]['items']], [p.name for p in self.products])
+
+        self.assertIs(expandable_serializer('CategorySerializer'), CategorySerializer)
+        self.assertIs(expandable_serializer('polls.serializers.CategorySerializer'), CategorySerializer)
+
+
+class StreamAllTests(POSTestCase):
+    def test_every_row_is_streamed_once_in_key_order(self):
+        Product.objects.bulk_create([
+            Product(name=f'Extra {i}', price=Decimal('1.00'), category=self.category) for i in range(1100)
+        ])
+        for fmt in ('json', 'ndjson'):
+            with self.subTest(format=fmt):
+                response = self.client.get(f'/api/products/all/?format={fmt}')
+                body = b''.join(response.streaming_content).decode()
+                rows = json.loads(body) if fmt == 'json' else [json.loads(line) for line in body.splitlines()]
+                ids = [row['id'] for row in rows]
+                self.assertEqual(ids, sorted(Product.objects.values_list('id', flat=True)))
+
+
+class ListQueryCountTests(POSTestCase):
+    """Every list and /all endpoint runs the same queries for 2 rows as for 12."""
+    product_count = 2
+    urls = [
+        '/api/categories/?page_size=10', '/api/categories/all/',
+        '/api/products/?page_size=10', '/api/products/?page_size=10&expand=category', '/api/products/all/',
+        '/api/inventories/', '/api/inventories/?expand=product', '/api/inventories/all/',
+        '/api/saleitems/', '/api/saleitems/?expand=product', '/api/saleitems/all/',
+        '/api/sales/', '/api/sales/?expand=items.product', '/api/sales/all/', '/api/sales/all/?format=msgpack',
+        '/api/users/?page_size=10', '/api/users/all/',
+        '/api/reports/sales/?level=product&granularity=hour',
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.added = 0
+
+    def add_rows(self, count):
+        role = Role.objects.get(name='admin')
+        for i in range(count):
+            UserRole.objects.create(user=User.objects.create_user(f'clerk{self.added}@example.com'), role=role)
+            category = Category.objects.create(name=f'Category {self.added}', created_by=self.user)
+            product = Product.objects.create(
+                name=f'Extra {self.added}', price=Decimal('1.00'), category=category, updated_by=self.user,
+            )
+            Inventory.objects.create(product=product, qty=self.stock, last_updated_by=self.user)
+            self.added += 1
+            with self.captureOnCommitCallbacks(execute=True):
+                sale = create_sale([{'product': product, 'qty': 2}, {'product': self.products[0], 'qty': 1}],
+                                   created_by=self.user)
+                refund_sale(sale, {product.id: 1}, user=self.user)
+
+    def fetch(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        if response.streaming:
+            b''.join(response.streaming_content)  # The queries run while the body streams
+        return response
+
+    def query_counts(self):
+        counts = {}
+        for url in self.urls:
+            response_cache.backend.clear()
+            counts[url], _ = self.count_queries(self.fetch, url)
+        return counts
+
+    def assertQueryCountsDoNotGrow(self, more_rows):
+        """Fail for any url whose query count changes once more_rows rows of every kind are added."""
+        before = self.query_counts()
+        self.add_rows(more_rows)
+        after = self.query_counts()
+        for url in self.urls:
+            with self.subTest(url=url):
+                self.assertEqual(before[url], after[url], f"{before[url]} queries, then {after[url]} with more rows")
+
+    def test_list_endpoints(self):
+        self.add_rows(2)
+        self.assertQueryCountsDoNotGrow(10)
+
+
+class ConditionalGetTests(POSTestCase):
+    product_count = 3
+
+    def revalidate(self, url):
+        etag = self.client.get(url)['ETag']
+        return etag, self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_pages_are_not_modified(self):
+        for url in ('/api/products/', f'/api/products/{self.products[0].pk}/', '/api/inventories/'):
+            with self.subTest(url=url):
+                _, response = self.revalidate(url)
+                self.assertEqual(response.status_code, 304)
+
+    def test_related_rows_change_the_etag(self):
+        inventory = Inventory.objects.get(product=self.products[0])
+        cases = [
+            ('/api/inventories/', self.products[0]),
+            (f'/api/inventories/{inventory.pk}/', self.products[0]),
+            ('/api/products/?expand=category', self.category),
+        ]
+        for url, related in cases:
+            with self.subTest(url=url):
+                etag, _ = self.revalidate(url)
+                related.name += ' renamed'
+                with self.captureOnCommitCallbacks(execute=True):
+                    related.save()
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response['ETag'], etag)
+
+    def test_not_modified_runs_only_the_validator_query(self):
+        create_sale([{'product': product, 'qty': 1} for product in self.products])
+        cases = [
+            ('/api/inventories/', 1),
+            ('/api/saleitems/', 1),
+            ('/api/sales/', 1),
+            (f'/api/products/{self.products[0].pk}/', 1),
+            ('/api/products/', 1),  # Cache hit: only the cache key's role lookup, which a JWT would carry
+        ]
+        for url, queries in cases:
+            with self.subTest(url=url):
+                etag = self.client.get(url)['ETag']
+                with self.assertNumQueries(queries):
+                    self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_deleted_rows_change_the_list_etag(self):
+        etag, _ = self.revalidate('/api/inventories/')
+        Inventory.objects.filter(product=self.products[2]).delete()
+        self.assertEqual(self.client.get('/api/inventories/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_detail_responses_carry_last_modified(self):
+        url = f'/api/products/{self.products[0].pk}/'
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get('/api/products/0/').status_code, 404)
+
+
+class FastSerializerTests(POSTestCase):
+    product_count = 3
+    cases = [
+        (ProductSerializer, lambda: Product.objects.order_by('pk')),
+        (SaleSerializer, lambda: SaleSerializer.setup_eager_loading(Sale.objects.order_by('pk'))),
+    ]
+
+    def test_output_is_byte_identical(self):
+        Product.objects.create(name='Loose \u2028 "item" \u00e9', price=Decimal('0.10'))  # No category, odd text
+        create_sale([{'product': self.products[0], 'qty': 2}, {'product': self.products[1], 'qty': 1}],
+                    created_by=self.user, customer_name='Zo\u00eb')
+        create_sale([{'product': self.products[2], 'qty': 1}])
+        self.products[2].delete()  # Its line stays with product=None
+        for serializer_class, queryset in self.cases:
+            with self.subTest(serializer=serializer_class.__name__):
+                self.assertEqual(render_fast(serializer_class, queryset()), render_serializer(serializer_class, queryset()))
+
+    def test_benchmark_command_checks_parity_and_keeps_nothing(self):
+        out = StringIO()
+        call_command('bench_serializers', rows=20, repeat=1, stdout=out)
+        self.assertEqual([line.split()[0] for line in out.getvalue().splitlines() if 'fast path' in line],
+                         ['ProductSerializer', 'SaleSerializer'])
+        self.assertEqual((Product.objects.count(), Sale.objects.count()), (self.product_count, 0))
+
+
+@skipUnless(messagepack.msgpack, "msgpack is not installed")
+class MessagePackTests(POSTestCase):
+    product_count = 3
+    media_types = ['application/msgpack', 'application/msgpack; intern=1']
+
+    def round_trip(self, data, media_type):
+        body = MessagePackRenderer().render(data, media_type)
+        return MessagePackParser().parse(BytesIO(body))
+
+    def test_renderer_and_parser_round_trip(self):
+        create_sale([{'product': self.products[0], 'qty': 2}, {'product': self.products[1], 'qty': 1}])
+        sales = SaleSerializer(SaleSerializer.setup_eager_loading(Sale.objects.all()), many=True).data
+        moment = datetime(2026, 10, 17, 9, 30, 15, 250000, tzinfo=timezone.utc)
+        for media_type in self.media_types:
+            with self.subTest(media_type=media_type):
+                self.assertEqual(self.round_trip(sales, media_type), sales)
+                self.assertEqual(
+                    self.round_trip({'price': Decimal('1.50'), 'at': moment, 'tags': [{'id': 1}, {'id': 2}]}, media_type),
+                    {'price': '1.50', 'at': moment, 'tags': [{'id': 1}, {'id': 2}]},
+                )
+
+    def test_api_speaks_msgpack_both_ways(self):
+        for media_type in self.media_types:
+            with self.subTest(media_type=media_type):
+                body = MessagePackRenderer().render(self.basket(2), media_type)
+                response = self.client.post('/api/sales/', body, content_type='application/msgpack',
+                                            HTTP_ACCEPT=media_type)
+                self.assertEqual(response.status_code, 201)
+                created = MessagePackParser().parse(BytesIO(response.content))
+                self.assertEqual(created['total_amount'], '5.00')
+
+                listed = self.client.get('/api/sales/', HTTP_ACCEPT=media_type)
+                as_json = self.client.get('/api/sales/').json()
+                self.assertEqual(MessagePackParser().parse(BytesIO(listed.content)), as_json)
+
+    def test_interned_keys_make_lists_smaller(self):
+        data = ProductSerializer(Product.objects.all(), many=True).data
+        plain, interned = (len(MessagePackRenderer().render(data, media_type)) for media_type in self.media_types)
+        self.assertLess(plain, len(JSONRenderer().render(data)))
+        self.assertLess(interned, plain)
+
+    def test_all_streams_one_map_per_row(self):
+        create_sale([{'product': self.products[0], 'qty': 2}])
+        create_sale([{'product': self.products[1], 'qty': 1}])
+        for url in ('/api/products/all/', '/api/sales/all/'):
+            with self.subTest(url=url):
+                body = b''.join(self.client.get(url, HTTP_ACCEPT=self.media_types[0]).streaming_content)
+                unpacker = messagepack.msgpack.Unpacker(raw=False, timestamp=3)
+                unpacker.feed(body)
+                rows = list(unpacker)
+                as_json = json.loads(b''.join(self.client.get(url).streaming_content))
+                self.assertEqual([row['id'] for row in rows], [row['id'] for row in as_json])
+                self.assertEqual(rows[0].keys(), as_json[0].keys())
+                with self.assertRaises(messagepack.msgpack.ExtraData):  # Not one array: a stream of maps
+                    messagepack.msgpack.unpackb(body, raw=False, timestamp=3)
+
+    def test_benchmark_command_reports_every_format(self):
+        out = StringIO()
+        call_command('bench_formats', rows=10, repeat=1, stdout=out)
+        self.assertEqual([line.split()[0] for line in out.getvalue().splitlines() if 'bytes' in line],
+                         ['json', 'msgpack', 'msgpack+intern'])
+        self.assertEqual(Product.objects.count(), self.product_count)
+
+
+class ProductImportTests(POSTestCase):
+    product_count = 0
+
+    def upload(self, body, content_type):
+        return self.client.post('/api/products/import/', body, content_type=content_type)
+
+    def test_unreadable_csv_rows_are_rejected_by_line(self):
+        body = (
+            b'\xef\xbb\xbfname,price,qty\n'
+            b'Tea,1.20,5\n'
+            b'Caf\xe9,2.00,5\n'  # Latin-1, not UTF-8
+            b'Huge,' + b'9' * 200000 + b',1\n'  # Larger than the csv module's field limit
+            b'"Scone, plain",1.50,2\n'
+        )
+        response = self.upload(body, 'text/csv')
+        self.assertEqual(response.status_code, 200, response.content)
+        summary = response.json()
+        self.assertEqual((summary['created'], summary['rejected']), (2, 2))
+        self.assertEqual(
+            [(error['line'], error['errors']['non_field_errors'][0][:11]) for error in summary['errors']],
+            [(3, 'Invalid UTF'), (4, 'Invalid CSV')],
+        )
+        self.assertEqual(set(Product.objects.values_list('name', flat=True)), {'Tea', 'Scone, plain'})
+
+    def test_unreadable_ndjson_lines_are_rejected_by_line(self):
+        body = b'{"name": "Tea", "price": "1.20"}\n{"name": "Caf\xe9", "price": "2.00"}\n{"name": \n'
+        summary = self.upload(body, 'application/x-ndjson').json()
+        self.assertEqual((summary['created'], summary['rejected']), (1, 2))
+        self.assertEqual(
+            [(error['line'], error['errors']['non_field_errors'][0][:12]) for error in summary['errors']],
+            [(2, 'Invalid UTF-'), (3, 'Invalid JSON')],
+        )
+
+
+    def test_failed_chunks_hide_the_database_error(self):
+        records = [(1, {'name': 'Tea', 'price': '1.20'}), (2, {'name': 'Scone', 'price': '1.50'})]
+        with mock.patch('polls.utils.product_import._import_chunk', side_effect=DatabaseError('SELECT secret')), \
+                self.assertLogs('polls.utils.product_import', 'ERROR'):
+            summary = import_products(records).as_dict()
+        self.assertEqual(summary['rejected'], 2)
+        self.assertNotIn('secret', json.dumps(summary['errors']))
+
+    def test_catalog_is_invalidated_once_per_import(self):
+        records = [(line_no, {'name': f'Tea {line_no}', 'price': '1.20'}) for line_no in range(1, 6)]
+        with self.captureOnCommitCallbacks() as callbacks:
+            summary = import_products(records, chunk_size=2)
+        self.assertEqual(summary.created, 5)
+        self.assertEqual(len(callbacks), 1)
+
+
+class StockTakeTests(POSTestCase):
+    product_count = 3
+
+    def count(self, items, key=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return self.client.post('/api/inventories/stock-take/', {'items': items}, format='json', **headers)
+
+    def qty(self, index):
+        return Inventory.objects.get(product=self.products[index]).qty
+
+    def test_counts_and_deltas_are_applied_and_reported(self):
+        response = self.count([
+            {'product': self.products[0].pk, 'counted_qty': self.stock - 4},
+            {'product': self.products[1].pk, 'delta': 2},
+            {'product': self.products[1].pk, 'delta': 1},
+            {'product': self.products[2].pk, 'counted_qty': self.stock},
+            {'product': 0, 'counted_qty': 1},
+        ])
+        self.assertEqual(response.status_code, 200, response.content)
+        report = response.json()
+        self.assertEqual((report['counted'], report['adjusted'], report['rejected']), (4, 3, 1))
+        self.assertEqual((report['shrinkage'], report['surplus']), (4, 3))
+        self.assertEqual([v['product'] for v in report['variances']], [self.products[0].pk, self.products[1].pk])
+        self.assertEqual([self.qty(i) for i in range(3)], [self.stock - 4, self.stock + 3, self.stock])
+
+    def test_variances_are_capped_but_totalled(self):
+        items = [{'product': product.pk, 'delta': -1} for product in self.products]
+        with mock.patch.object(stock_take_module, 'MAX_VARIANCES', 2):
+            report = stock_take(enumerate(items), chunk_size=2).as_dict()
+        self.assertEqual((len(report['variances']), report['variances_truncated']), (2, True))
+        self.assertEqual(report['shrinkage'], 3)
+
+    def test_repeated_key_replays_without_counting_again(self):
+        items = [{'product': self.products[0].pk, 'delta': -1}]
+        first, retry = self.count(items, key='count-1'), self.count(items, key='count-1')
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.qty(0), self.stock - 1)
+
+    def test_chunks_do_not_run_inside_the_key_transaction(self):
+        depth = len(connection.atomic_blocks)
+        seen = []
+
+        def counting(*args, **kwargs):
+            seen.append(len(connection.atomic_blocks))
+            return stock_take(*args, **kwargs)
+        with mock.patch('polls.views.stock_take', side_effect=counting):
+            self.assertEqual(self.count([{'product': self.products[0].pk, 'delta': 1}], key='count-2').status_code, 200)
+        self.assertEqual(seen, [depth])
+        self.assertEqual(IdempotencyKey.objects.get(key='count-2').response_status, 200)
+
+    def test_key_still_being_processed_is_a_conflict(self):
+        items = [{'product': self.products[0].pk, 'delta': 1}]
+        self.count(items, key='count-3')
+        IdempotencyKey.objects.filter(key='count-3').update(response_status=None, response_body=None)
+        self.assertEqual(self.count(items, key='count-3').status_code, 409)
+        self.assertEqual(self.qty(0), self.stock + 1)
+
+    def test_command_writes_every_variance(self):
+        with TemporaryDirectory() as directory:
+            path, variances = os.path.join(directory, 'count.csv'), os.path.join(directory, 'variances.csv')
+            with open(path, 'w') as f:
+                f.write('product,counted_qty,delta\n')
+                f.writelines(f'{product.pk},{self.stock - 1},\n' for product in self.products)
+                f.write(f'{self.products[0].pk},,x\n')
+            out = StringIO()
+            with mock.patch.object(stock_take_module, 'MAX_VARIANCES', 1):
+                call_command('stock_take', path, '--batch-size', '2', '--variance-report', variances, stdout=out)
+            with open(variances) as f:
+                self.assertEqual(len(f.readlines()), 1 + len(self.products))
+        self.assertIn('Line 5: {"delta"', out.getvalue())
+        self.assertIn("Counted 3 rows: 3 inventory records updated, 0 created, 1 rejected; 3 variances "
+                      "(shrinkage 3, surplus 0).", out.getvalue())
+        self.assertEqual(self.qty(2), self.stock - 1)
+
+
+class RepricingTests(POSTestCase):
+    product_count = 5
+
+    def reprice(self, **data):
+        return self.client.post('/api/products/reprice/', data, format='json')
+
+    def prices(self):
+        return [str(price) for price in Product.objects.order_by('pk').values_list('price', flat=True)]
+
+    def test_dry_run_reports_without_writing(self):
+        with mock.patch('polls.utils.repricing.invalidate_catalog') as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.reprice(category=self.category.pk, percent='10', dry_run=True)
+        self.assertEqual(response.status_code, 200, response.content)
+        result = response.json()
+        self.assertEqual((result['dry_run'], result['matched'], result['changed']), (True, 5, 5))
+        self.assertEqual(result['sample'][0], {
+            'product': self.products[0].pk, 'name': 'Product 0', 'old_price': '2.50', 'new_price': '2.75',
+        })
+        self.assertEqual(self.prices(), ['2.50'] * 5)
+        invalidate.assert_not_called()
+
+    def test_rounding(self):
+        roundings = ('half_up', 'half_even', 'up', 'down')
+        self.assertEqual([str(adjusted_price(Decimal('2.50'), percent=1, rounding=name)) for name in roundings],
+                         ['2.53', '2.52', '2.53', '2.52'])
+        response = self.reprice(products=[self.products[0].pk], percent='1', rounding='half_even')
+        self.assertEqual(response.json()['changed'], 1)
+        self.assertEqual(self.prices()[:2], ['2.52', '2.50'])
+
+    def test_write_invalidates_the_catalog_once(self):
+        with mock.patch('polls.utils.repricing.invalidate_catalog') as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            result = adjust_prices(Product.objects.all(), amount=Decimal('0.50'), chunk_size=2)
+        self.assertEqual((result['changed'], self.prices()), (5, ['3.00'] * 5))
+        invalidate.assert_called_once_with('product')
+
+    def test_each_chunk_is_locked_and_written_in_its_own_transaction(self):
+        savepoints = []
+
+        def set_prices(*args, **kwargs):
+            savepoints.append(connection.savepoint_ids[-1])
+        with mock.patch.object(Product.objects, 'set_prices', side_effect=set_prices):
+            adjust_prices(Product.objects.all(), percent=5, chunk_size=2)
+        self.assertEqual(len(set(savepoints)), 3)
+
+    def test_out_of_range_price_writes_nothing(self):
+        response = self.reprice(category=self.category.pk, amount='-3')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'],
+                         f"Product {self.products[0].pk} (Product 0) would be priced at -0.50.")
+        self.assertEqual(self.prices(), ['2.50'] * 5)
+
+    def test_sample_is_bounded(self):
+        with mock.patch('polls.utils.repricing.SAMPLE_SIZE', 2):
+            result = reprice_products({product.pk: Decimal('1.00') for product in self.products}, chunk_size=2)
+        self.assertEqual((result['changed'], len(result['sample'])), (5, 2))
+
+
+class SalesRollupTests(POSTestCase):
+    product_count = 3
+
+    def rollups(self):
+        return sorted(SalesRollup.objects.values_list(
+            'granularity', 'period', 'level', 'product_id', 'category_id', *MEASURES,
+        ))
+
+    def assertRollupsMatchRebuild(self):
+        incremental = self.rollups()
+        now = datetime.now(timezone.utc)
+        rebuild(now - timedelta(days=1), now + timedelta(days=1))
+        self.assertEqual(incremental, self.rollups())
+
+    def sale(self, *lines):
+        products = Product.objects.in_bulk(product.pk for product in self.products)  # As validation loads them
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_sale([{'product': products[self.products[index].pk], 'qty': qty} for index, qty in lines])
+
+    def test_incremental_rows_equal_a_rebuild(self):
+        first, second = self.sale((0, 2), (1, 1)), self.sale((1, 3))
+        self.assertRollupsMatchRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            update_sale(first, [{'product': self.products[0], 'qty': 1}, {'product': self.products[2], 'qty': 4}])
+        self.assertRollupsMatchRebuild()
+
+        item = second.items.get()
+        item.qty = 2
+        with self.captureOnCommitCallbacks(execute=True):
+            item.save()
+        self.assertRollupsMatchRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            refund_sale(first, {self.products[2].pk: 3})
+        self.assertRollupsMatchRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.items.get(product=self.products[0]).delete()
+        self.assertRollupsMatchRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertRollupsMatchRebuild()
+
+    def test_recategorized_product_keeps_its_past_sales(self):
+        self.sale((0, 2))
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.products[0].pk).update(category=Category.objects.create(name='Food'))
+        sale = self.sale((0, 1))
+        self.assertEqual(list(sale.items.values_list('category_id', flat=True)), [
+            Product.objects.get(pk=self.products[0].pk).category_id,
+        ])
+        self.assertRollupsMatchRebuild()
+        day = SalesRollup.objects.filter(granularity=SalesRollup.DAY, level=SalesRollup.CATEGORY)
+        self.assertEqual(dict(day.values_list('category_id', 'units')), {
+            self.category.pk: 2, sale.items.get().category_id: 1,
+        })
+
+    def test_rows_that_cancel_out_are_pruned(self):
+        sale = self.sale((0, 2), (1, 1))
+        with self.captureOnCommitCallbacks(execute=True):
+            update_sale(sale, [{'product': self.products[0], 'qty': 2}])
+        self.assertFalse(SalesRollup.objects.filter(product_id=self.products[1].pk).exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            sale.delete()
+        self.assertFalse(SalesRollup.objects.exists())
+
+    def test_report(self):
+        sale = self.sale((0, 2), (1, 1))
+        with self.captureOnCommitCallbacks(execute=True):
+            refund_sale(sale, {self.products[0].pk: 1})
+        response = self.client.get('/api/reports/sales/', {'level': 'product', 'granularity': 'day'})
+        self.assertEqual(response.status_code, 200, response.content)
+        rows = {row['product_id']: row for row in response.json()['results']}
+        self.assertEqual(set(rows), {self.products[0].pk, self.products[1].pk})
+        row = rows[self.products[0].pk]
+        self.assertEqual((Decimal(row['revenue']), row['units'], Decimal(row['net_revenue'])),
+                         (Decimal('5.00'), 2, Decimal('2.50')))
+        self.assertEqual(self.client.get('/api/reports/sales/', {'level': 'shop'}).status_code, 400)
+
+
+class SaleTotalTests(POSTestCase):
+    product_count = 3
+
+    def sale(self, *lines):
+        return create_sale([{'product': self.products[index], 'qty': qty} for index, qty in lines])
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command('reconcile_sale_totals', *args, stdout=out)
+        return out.getvalue()
+
+    def test_line_moved_between_sales_moves_its_subtotal(self):
+        first, second = self.sale((0, 2), (1, 1)), self.sale((2, 1))
+        item = first.items.get(product=self.products[1])
+        item.sale = second
+        item.qty = 3
+        item.save()
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.total_amount, second.total_amount), (Decimal('5.00'), Decimal('10.00')))
+        self.assertEqual(Inventory.objects.get(product=self.products[1]).qty, self.stock - 3)
+
+        item.delete()
+        second.refresh_from_db()
+        self.assertEqual(second.total_amount, Decimal('2.50'))
+        self.assertIn("Repaired 0 wrong totals", self.reconcile())
+
+    def test_reconcile_detects_and_repairs_drift(self):
+        sale, other = self.sale((0, 2), (1, 1)), self.sale((2, 1))
+        Sale.objects.filter(pk=sale.pk).update(total_amount=Decimal('99.00'))
+
+        out = self.reconcile('--dry-run', '--batch-size', '1')
+        self.assertRegex(out, rf"Sale #{sale.id}: stored 99.00, items sum to 7.50?\n")  # SQLite drops the 0
+        self.assertIn("Checked 2 sales. Found 1 wrong totals.", out)
+        self.assertEqual(Sale.objects.get(pk=sale.pk).total_amount, Decimal('99.00'))
+
+        self.assertIn("Repaired 1 wrong totals.", self.reconcile())
+        self.assertEqual(Sale.objects.get(pk=sale.pk).total_amount, Decimal('7.50'))
+        self.assertEqual(Sale.objects.get(pk=other.pk).total_amount, Decimal('2.50'))
@@ -2,7 +2,7 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import (
      CategoryViewSet, ProductViewSet, InventoryViewSet, SaleItemViewSet,UserViewSet,
-     SaleViewSet
+     SaleViewSet, SalesReportViewSet
 )
 
 router = DefaultRouter()
@@ -12,6 +12,7 @@ router.register(r'inventories', InventoryViewSet, basename='inventory')
 router.register(r'saleitems', SaleItemViewSet, basename='saleitem')
 router.register(r'sales', SaleViewSet, basename='sale')
 router.register(r'users', UserViewSet, basename='user')
+router.register(r'reports/sales', SalesReportViewSet, basename='sales-report')
 
 urlpatterns = [
     # path('api/token/', CustomTokenView.as_view(), name='token_obtain_pair'),
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+
+from polls.models import Authority, RoleAuthority, UserRole
+
+
+class AuthorityRegistry:
+    """In-process bitset view of role -> authority assignments.
+
+    Every Authority gets a bit, every Role a mask of its authorities' bits,
+    and each user's effective mask is kept in an LRU keyed by
+    (user id, role_version). Checking an authority is then a bitwise AND.
+
+    Signals in polls.signals reset the registry when authorities or role
+    assignments change. Other worker processes pick up role changes of a
+    user through role_version and everything else after `ttl` seconds.
+    """
+
+    def __init__(self, max_users=4096, ttl=60):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._bits = {}
+        self._role_masks = {}
+        self._user_masks = OrderedDict()
+
+    def _load(self):
+        bits, names = {}, {}
+        for index, (authority_id, name) in enumerate(Authority.objects.order_by('id').values_list('id', 'name')):
+            bits[name] = 1 << index
+            names[authority_id] = name
+        by_id = {authority_id: bits[name] for authority_id, name in names.items()}
+
+        role_masks = {}
+        for role_id, authority_id in RoleAuthority.objects.values_list('role_id', 'authority_id'):
+            role_masks[role_id] = role_masks.get(role_id, 0) | by_id.get(authority_id, 0)
+
+        # New dicts on every load, never changed in place, so a reader can keep one
+        self._bits = bits
+        self._role_masks = role_masks
+        self._user_masks = OrderedDict()
+        self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            self._load()
+
+    def _user_mask(self, user):
+        # The mask together with the name -> bit map it was built from, read under
+        # one lock so a reload in between cannot pair a mask with renumbered bits
+        key = (user.pk, user.role_version)
+        with self._lock:
+            self._ensure_loaded()
+            mask = self._user_masks.get(key)
+            if mask is not None:
+                self._user_masks.move_to_end(key)
+                return mask, self._bits
+
+            mask = 0
+            for role_id in UserRole.objects.filter(user_id=user.pk).values_list('role_id', flat=True):
+                mask |= self._role_masks.get(role_id, 0)
+            self._user_masks[key] = mask
+            if len(self._user_masks) > self.max_users:
+                self._user_masks.popitem(last=False)
+            return mask, self._bits
+
+    def user_mask(self, user):
+        """Bitmask of every authority granted to user through its roles."""
+        return self._user_mask(user)[0]
+
+    def has_authority(self, user, name):
+        mask, bits = self._user_mask(user)
+        return bool(mask & bits.get(name, 0))
+
+    def authority_names(self, user):
+        mask, bits = self._user_mask(user)
+        return {name for name, bit in bits.items() if mask & bit}
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in [key for key in self._user_masks if key[0] == user_id]:
+                del self._user_masks[key]
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+
+registry = AuthorityRegistry()
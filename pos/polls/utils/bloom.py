@@ -0,0 +1,125 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings: no false negatives, rare false positives."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(capacity, 1)
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        # Double hashing: position i is h1 + i * h2
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        if value in self:
+            return  # Re-reading rows must not make the filter look fuller
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+
+class BlacklistFilter:
+    """Bloom filter of blacklisted refresh-token JTIs, synced from the database.
+
+    At most every `sync_interval` seconds the rows blacklisted since the last
+    sync are pulled in, reaching `overlap` seconds further back so rows whose
+    transaction committed after a later one are not missed. The filter is
+    rebuilt every `rebuild_interval` seconds or when it outgrows its capacity,
+    which also drops compacted rows. Queries and rebuilds run outside the
+    lock; checks meanwhile use the current filter, or go to the database
+    before the first one is built. A negative answer can therefore be up to
+    `sync_interval` old; callers must still rely on the database when they
+    write (see MyTokenRefreshSerializer).
+    """
+
+    def __init__(self, capacity=100000, sync_interval=5, rebuild_interval=3600, overlap=60):
+        self.initial_capacity = capacity
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.overlap = timedelta(seconds=overlap)
+        self._lock = threading.Lock()
+        self._filter = None
+        self._refreshing = False
+        self._synced_through = None
+        self._synced_at = 0
+        self._built_at = 0
+        self.refresh_seconds = None  # Duration of the last sync or rebuild
+
+    def _jtis(self, since=None):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        rows = BlacklistedToken.objects.all()
+        if since is not None:
+            rows = rows.filter(blacklisted_at__gte=since)
+        return rows.values_list('token__jti', flat=True).iterator(chunk_size=5000)
+
+    def _build(self):
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        count = BlacklistedToken.objects.count()
+        bloom = BloomFilter(max(self.initial_capacity, count * 2))
+        for jti in self._jtis():
+            bloom.add(jti)
+        return bloom
+
+    def refresh(self, rebuild=False):
+        """Sync or rebuild the filter if due (or rebuild now); a no-op while another thread does."""
+        now = time.monotonic()
+        with self._lock:
+            if self._refreshing:
+                return
+            rebuild = (rebuild or self._filter is None or now - self._built_at > self.rebuild_interval
+                       or self._filter.count > self._filter.capacity)
+            if not rebuild and now - self._synced_at <= self.sync_interval:
+                return
+            self._refreshing = True
+            since = None if rebuild else self._synced_through - self.overlap
+
+        try:
+            started = timezone.now()
+            if rebuild:
+                bloom = self._build()
+            else:
+                jtis = list(self._jtis(since))
+            with self._lock:
+                if rebuild:
+                    self._filter = bloom
+                    self._built_at = now
+                else:
+                    for jti in jtis:
+                        self._filter.add(jti)
+                self._synced_through = started
+                self._synced_at = now
+                self.refresh_seconds = time.monotonic() - now
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def might_contain(self, jti):
+        self.refresh()
+        with self._lock:
+            # No filter until the first build finishes: let the database answer
+            return self._filter is None or jti in self._filter
+
+    def add(self, jti):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(jti)
+
+
+blacklist_filter = BlacklistFilter()
@@ -0,0 +1,159 @@
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Count, Max, Q
+
+from polls.models import Category, Inventory, Product
+from polls.utils.response_cache import response_cache
+from polls.utils.streaming import dumps
+
+# Rows committed slightly out of timestamp order are caught by re-reading this window
+OVERLAP = timedelta(seconds=5)
+
+
+def to_version(moment):
+    """Catalog version: a timestamp in integer microseconds since the epoch."""
+    return int(moment.timestamp() * 1_000_000) if moment else 0
+
+
+def from_version(version):
+    return datetime.fromtimestamp(version / 1_000_000, tz=dt_timezone.utc)
+
+
+def product_row(product):
+    inventory = getattr(product, 'inventory', None)
+    return {
+        'id': product.id,
+        'name': product.name,
+        'price': str(product.price),
+        'active': product.active,
+        'category': product.category_id,
+        'category_name': product.category.name if product.category else None,
+        'status': inventory.status if inventory else None,
+        'updated_at': product.updated_at,
+    }
+
+
+def changed_products(since):
+    """Products whose own row, category or inventory changed after since."""
+    return Product.objects.select_related('category', 'inventory').filter(
+        Q(updated_at__gt=since)
+        | Q(category__updated_at__gt=since)
+        | Q(inventory__last_updated__gt=since)
+    ).order_by('id')
+
+
+def current_version():
+    """Cheap probe of the newest change across the tables the catalog reads."""
+    products = Product.objects.aggregate(latest=Max('updated_at'), count=Count('id'))
+    latest = [
+        products['latest'],
+        Category.objects.aggregate(latest=Max('updated_at'))['latest'],
+        Inventory.objects.aggregate(latest=Max('last_updated'))['latest'],
+    ]
+    return max((to_version(moment) for moment in latest if moment), default=0), products['count']
+
+
+class CatalogSnapshot:
+    """Precomputed catalog of active products, patched in place as the catalog changes.
+
+    The version probe runs at most every `probe_interval` seconds, or at
+    once after a signal marks the snapshot stale, so other processes' changes
+    show up within that interval. When it moves, only the products changed
+    since the last probe are re-read. A full rebuild happens on first use,
+    when products were deleted in another process, and every
+    `rebuild_interval` seconds.
+
+    The body's version is the probe at which the rows last changed, so a
+    sale that leaves every stock status as it was keeps clients on 304. The
+    ETag covers both the version and the rows.
+    """
+
+    def __init__(self, rebuild_interval=300, probe_interval=1):
+        self.rebuild_interval = rebuild_interval
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._rows = None
+        self._version = 0
+        self._probed_version = 0
+        self._product_count = None
+        self._built_at = 0
+        self._probed_at = 0
+        self._stale = False
+        self._body = b''
+        self._etag = ''
+
+    def _render(self):
+        rows = dumps([self._rows[pk] for pk in sorted(self._rows)])
+        self._etag = '"%d-%s"' % (self._version, hashlib.sha256(rows.encode()).hexdigest())
+        self._body = ('{"version":%d,"products":%s}' % (self._version, rows)).encode()
+
+    def _full_build(self):
+        products = Product.objects.select_related('category', 'inventory').filter(active=True)
+        rows = {product.id: product_row(product) for product in products.iterator(chunk_size=2000)}
+        changed = rows != self._rows
+        self._rows = rows
+        self._built_at = time.monotonic()
+        return changed
+
+    def _patch(self):
+        changed = False
+        for product in changed_products(from_version(self._probed_version) - OVERLAP):
+            row = product_row(product) if product.active else None
+            if row != self._rows.get(product.id):
+                changed = True
+                if row is None:
+                    del self._rows[product.id]
+                else:
+                    self._rows[product.id] = row
+        return changed
+
+    def get(self):
+        """Return (version, body, etag) of the up-to-date snapshot."""
+        with self._lock:
+            now = time.monotonic()
+            if self._rows is not None and not self._stale and now - self._probed_at < self.probe_interval:
+                return self._version, self._body, self._etag
+
+            version, count = current_version()
+            self._probed_at = now
+            expired = now - self._built_at > self.rebuild_interval
+            if self._rows is None or expired or (self._product_count is not None and count < self._product_count):
+                changed = self._full_build()
+            elif version != self._probed_version or count != self._product_count or self._stale:
+                changed = self._patch()
+            else:
+                changed = False
+            self._probed_version = version
+            self._product_count = count
+            self._stale = False
+            if changed:
+                self._version = version
+                self._render()
+            return self._version, self._body, self._etag
+
+    def mark_stale(self):
+        self._stale = True
+
+    def discard(self, product_id):
+        with self._lock:
+            if self._rows is not None and self._rows.pop(product_id, None) is not None:
+                self._product_count = None
+                self._render()
+
+
+catalog = CatalogSnapshot()
+
+
+def catalog_delta(since):
+    """Products changed after version since, including deactivated ones."""
+    return [product_row(product) for product in changed_products(from_version(since) - OVERLAP)]
+
+
+def invalidate_catalog(*model_names):
+    """What polls.signals does on a save, for bulk writes that send no signals."""
+    catalog.mark_stale()
+    for name in model_names:
+        response_cache.bump(name)
@@ -0,0 +1,160 @@
+from collections import Counter
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Sum
+
+from polls.models import Inventory, RefundItem, Sale, SaleItem
+from polls.utils.rollups import record_sales, sale_lines
+
+
+def lock_inventories(product_ids):
+    """Lock the inventory rows of product_ids and return them by product id.
+
+    Rows are always locked in product_id order so two terminals checking out
+    overlapping baskets cannot deadlock on each other.
+    """
+    inventories = (
+        Inventory.objects.select_for_update()
+        .filter(product_id__in=product_ids)
+        .order_by('product_id')
+    )
+    return {inv.product_id: inv for inv in inventories}
+
+
+def create_sale(items_data, **sale_fields):
+    """Create a sale with all of its items using a fixed number of queries.
+
+    items_data is the validated `items` list of SaleSerializer. Inventories are
+    locked in one query, stock is deducted with one guarded UPDATE and the
+    items are inserted with bulk_create.
+    """
+    demand = Counter()
+    for item_data in items_data:
+        if not item_data.get('product'):
+            raise ValidationError("Product is required")
+        if item_data.get('qty', 1) <= 0:
+            raise ValidationError("Quantity must be positive")
+        demand[item_data['product'].pk] += item_data.get('qty', 1)
+
+    with transaction.atomic():
+        inventories = lock_inventories(demand)
+        for item_data in items_data:
+            product = item_data['product']
+            inv = inventories.get(product.pk)
+            if inv is None or inv.qty < demand[product.pk]:
+                raise ValidationError(f"Not enough stock for {product.name}")
+
+        items = []
+        total = 0
+        for item_data in items_data:
+            product = item_data['product']
+            item = SaleItem(product=product, qty=item_data.get('qty', 1), price=product.price,
+                            category_id=product.category_id or 0)
+            item.subtotal = item.qty * item.price
+            total += item.subtotal
+            items.append(item)
+
+        # The rows are locked, but the UPDATE is guarded as well so a backend
+        # without SELECT ... FOR UPDATE still cannot oversell.
+        if Inventory.objects.adjust_stock({pid: -qty for pid, qty in demand.items()}) != len(demand):
+            raise ValidationError("Not enough stock for this sale")
+
+        sale = Sale.objects.create(total_amount=total, **sale_fields)
+        for item in items:
+            item.sale = sale
+        SaleItem.objects.bulk_create(items)
+        record_sales([sale], {}, after={sale.pk: [
+            (item.product_id, item.category_id, item.qty, item.subtotal) for item in items
+        ]})
+    return sale
+
+
+def update_sale(sale, items_data):
+    """Replace the items of sale with items_data by applying only the difference.
+
+    Lines are matched by product: unchanged lines are left alone, changed
+    lines keep their sold price, and only the net stock change per product
+    is applied, in one guarded UPDATE. The sale total is written once.
+    """
+    wanted = Counter()
+    products = {}
+    for item_data in items_data:
+        if not item_data.get('product'):
+            raise ValidationError("Product is required")
+        if item_data.get('qty', 1) <= 0:
+            raise ValidationError("Quantity must be positive")
+        products[item_data['product'].pk] = item_data['product']
+        wanted[item_data['product'].pk] += item_data.get('qty', 1)
+
+    with transaction.atomic():
+        # The sale before its lines, in the order refund_sale() and SaleItem.save() lock them
+        Sale.objects.select_for_update().filter(pk=sale.pk).first()
+        existing = {}
+        for item in sale.items.select_for_update().order_by('pk'):
+            existing.setdefault(item.product_id, []).append(item)
+        before = sale_lines([sale.pk])
+
+        refunded = Counter(dict(
+            RefundItem.objects.filter(sale_item__sale=sale)
+            .values_list('product_id')
+            .annotate(qty=Sum('qty'))
+        ))
+
+        deltas = {}
+        to_create, to_update, to_delete = [], [], []
+        # Lines whose product was deleted cannot be named by items_data; they are left as they are
+        for product_id in (set(existing) | set(wanted)) - {None}:
+            lines = existing.get(product_id, [])
+            old_qty = sum(item.qty for item in lines)
+            new_qty = wanted.get(product_id, 0)
+            if new_qty < refunded[product_id]:
+                raise ValidationError(f"Quantity for product {product_id} is below its refunded quantity.")
+            if old_qty != new_qty:
+                deltas[product_id] = old_qty - new_qty
+
+            # Keep one line per product: the first existing one, if any
+            if new_qty == 0:
+                to_delete.extend(lines)
+                continue
+            if not lines:
+                product = products[product_id]
+                to_create.append(SaleItem(
+                    sale=sale, product=product, qty=new_qty,
+                    price=product.price, subtotal=new_qty * product.price, category_id=product.category_id or 0,
+                ))
+                continue
+            keep, extra = lines[0], lines[1:]
+            if extra and refunded[product_id]:
+                RefundItem.objects.filter(sale_item__in=extra).update(sale_item=keep)
+            to_delete.extend(extra)
+            if keep.qty != new_qty:
+                keep.qty = new_qty
+                keep.subtotal = new_qty * keep.price
+                to_update.append(keep)
+
+        short = [pid for pid, delta in deltas.items() if delta < 0]
+        if short:
+            inventories = lock_inventories(short)
+            for product_id in short:
+                inv = inventories.get(product_id)
+                if inv is None or inv.qty < -deltas[product_id]:
+                    raise ValidationError(f"Not enough stock for {products[product_id].name}")
+        changed = sum(1 for delta in deltas.values() if delta)
+        if Inventory.objects.adjust_stock(deltas) != changed:
+            raise ValidationError("Not enough stock for this sale")
+
+        deleted = {item.pk for item in to_delete}
+        if deleted:
+            # Queryset delete: the stock for these lines is already in deltas
+            SaleItem.objects.filter(pk__in=deleted).delete()
+        if to_update:
+            SaleItem.objects.bulk_update(to_update, ['qty', 'subtotal'])
+        if to_create:
+            SaleItem.objects.bulk_create(to_create)
+
+        kept = [item for lines in existing.values() for item in lines if item.pk not in deleted]
+        sale.total_amount = sum(item.subtotal for item in kept + to_create)
+        sale.save()
+        record_sales([sale], before)
+    return sale
@@ -0,0 +1,180 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from rest_framework import ISO_8601, serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
+
+try:
+    import orjson
+except ImportError:  # Optional: without it everything is encoded by the json module
+    orjson = None
+
+# Fields whose values come out of QuerySet.values() already in their JSON form
+PLAIN_FIELDS = (serializers.IntegerField, serializers.CharField, serializers.BooleanField)
+
+_encoder_default = encoders.JSONEncoder().default
+
+
+class ValuesRows(list):
+    """Rows built by a ValuesSerializer: only str, int, bool, None, lists and dicts.
+
+    Those encode identically with orjson and DRF's JSONRenderer, which is what
+    lets FastJSONRenderer switch encoders for them.
+    """
+
+
+def _utc_isoformat(value):
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def _converter(field):
+    """Function turning a raw values() value into the field's representation, or None for as-is."""
+    if isinstance(field, serializers.FloatField):
+        raise ImproperlyConfigured(f"{field.field_name}: float fields are not supported by ValuesSerializer.")
+    if isinstance(field, PLAIN_FIELDS):
+        return None
+    if (isinstance(field, serializers.DateTimeField) and settings.USE_TZ and settings.TIME_ZONE == 'UTC'
+            and getattr(field, 'format', api_settings.DATETIME_FORMAT) in (ISO_8601, None)):
+        return _utc_isoformat
+    return field.to_representation
+
+
+class ValuesSerializer:
+    """Read-only twin of a ModelSerializer that builds rows from QuerySet.values().
+
+    The serializer's fields are compiled once into (name, lookup, converter)
+    extractors, so a row costs one dict lookup per field instead of a model
+    instance plus DRF's per-field dispatch. The rows are the same data the
+    serializer produces for many=True: sources spanning a NULL relation or
+    naming no model field are omitted like DRF's SkipField does. Nested
+    many=True serializers over a reverse foreign key are loaded with one
+    query per page. Anything else raises ImproperlyConfigured.
+    """
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self.model = serializer_class.Meta.model
+        self.pk = self.model._meta.pk.attname
+        self.extractors = []
+        self.nested = []
+        self.lookups = {self.pk}
+        for name, field in serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.ListSerializer):
+                self._compile_nested(name, field)
+            else:
+                self._compile_field(name, field)
+
+    def _compile_field(self, name, field):
+        if not field.source_attrs:
+            raise ImproperlyConfigured(f"{name}: source='*' is not supported.")
+        model = self.model
+        path, guards = [], []
+        for position, attr in enumerate(field.source_attrs):
+            try:
+                model_field = model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                if hasattr(model, attr):
+                    raise ImproperlyConfigured(f"{name}: '{attr}' is not a database field.")
+                return  # DRF raises AttributeError and skips the field on every row
+            last = position == len(field.source_attrs) - 1
+            if model_field.many_to_one or (model_field.one_to_one and model_field.concrete):
+                if last:
+                    if not isinstance(field, serializers.PrimaryKeyRelatedField):
+                        raise ImproperlyConfigured(f"{name}: only primary key relations are supported.")
+                    self._add(name, '__'.join(path + [model_field.attname]), guards, field.pk_field and field.pk_field.to_representation)
+                    return
+                guard = '__'.join(path + [model_field.attname])
+                guards.append(guard)
+                self.lookups.add(guard)
+                path.append(attr)
+                model = model_field.related_model
+            elif model_field.is_relation:
+                raise ImproperlyConfigured(f"{name}: to-many relations need a nested serializer.")
+            elif not last:
+                raise ImproperlyConfigured(f"{name}: '{attr}' is not a relation.")
+            else:
+                self._add(name, '__'.join(path + [attr]), guards, _converter(field))
+
+    def _add(self, name, lookup, guards, convert):
+        self.lookups.add(lookup)
+        self.extractors.append((name, lookup, tuple(guards), convert))
+
+    def _compile_nested(self, name, field):
+        relation = self.model._meta.get_field(field.source)
+        if not relation.one_to_many:
+            raise ImproperlyConfigured(f"{name}: only reverse foreign keys can be nested.")
+        child = ValuesSerializer(type(field.child))
+        fk = relation.field.attname
+        child.lookups.add(fk)
+        self.nested.append((name, child, fk))
+        self.extractors.append((name, None, (), None))
+
+    def values(self, queryset):
+        """queryset reduced to the columns the extractors read."""
+        return queryset.select_related(None).prefetch_related(None).values(*sorted(self.lookups))
+
+    def _row(self, values, nested):
+        row = {}
+        for name, lookup, guards, convert in self.extractors:
+            if lookup is None:
+                row[name] = nested[name].get(values[self.pk], [])
+                continue
+            if guards and any(values[guard] is None for guard in guards):
+                continue
+            value = values[lookup]
+            row[name] = value if value is None or convert is None else convert(value)
+        return row
+
+    def to_representation(self, rows):
+        """Serialize values() rows (e.g. a page of self.values(queryset))."""
+        rows = list(rows)
+        nested = {}
+        if self.nested and rows:
+            ids = [values[self.pk] for values in rows]
+            for name, child, fk in self.nested:
+                children = child.model._default_manager.filter(**{f'{fk}__in': ids})
+                ordering = child.model._meta.ordering or [child.pk]
+                groups = defaultdict(ValuesRows)
+                for values in child.values(children.order_by(*ordering)):
+                    groups[values[fk]].append(child._row(values, {}))
+                nested[name] = groups
+        return ValuesRows(self._row(values, nested) for values in rows)
+
+
+def dumps_rows(rows):
+    """JSON text of each row, encoded with orjson when the rows allow it."""
+    if orjson is not None and isinstance(rows, ValuesRows):
+        return [orjson.dumps(row).decode() for row in rows]
+    from polls.utils.streaming import dumps
+    return [dumps(row) for row in rows]
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer that hands ValuesRows payloads to orjson; output is byte-identical."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        rows = data.get('results') if isinstance(data, dict) else data
+        if (orjson is None or not isinstance(rows, ValuesRows) or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {})):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=_encoder_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Same escaping of the two separators JavaScript does not allow in literals
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+# Default renderers with JSONRenderer swapped for FastJSONRenderer
+FAST_RENDERERS = [
+    FastJSONRenderer if renderer is JSONRenderer else renderer
+    for renderer in api_settings.DEFAULT_RENDERER_CLASSES
+]
@@ -0,0 +1,131 @@
+import functools
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from polls.models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+
+
+def request_fingerprint(request):
+    """Hash of the method, path and payload a key was first used with."""
+    payload = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder)
+    raw = f"{request.method} {request.path}\n{payload}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _replay(record, fingerprint):
+    if record.request_hash != fingerprint:
+        return Response(
+            {"error": f"{HEADER} was already used for a different request."},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    if record.response_status is None:
+        return Response(
+            {"error": f"A request with this {HEADER} is still being processed."},
+            status=status.HTTP_409_CONFLICT
+        )
+    response = Response(record.response_body, status=record.response_status)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _claim(request, key, fingerprint, now, expires_at):
+    """(record, None) when this request owns the key, or (None, response) to return instead.
+
+    Call inside a transaction: the key row stays locked until it ends.
+    """
+    # Insert first rather than get_or_create(): locking a key that does not
+    # exist yet takes a gap lock on InnoDB, and two duplicates holding the
+    # same gap deadlock on their inserts. A duplicate insert instead waits
+    # on the first request's row and fails once it commits.
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(
+                user=request.user, key=key, request_hash=fingerprint, expires_at=expires_at,
+            )
+        return record, None
+    except IntegrityError:
+        record = IdempotencyKey.objects.select_for_update().get(user=request.user, key=key)
+    if record.expires_at > now:
+        return None, _replay(record, fingerprint)
+    return record, None
+
+
+def _store(record, response, fingerprint, expires_at):
+    record.request_hash = fingerprint
+    record.expires_at = expires_at
+    record.response_status = response.status_code
+    record.response_body = response.data
+    record.save(update_fields=['request_hash', 'expires_at', 'response_status', 'response_body'])
+
+
+def idempotent(view_method=None, *, chunked=False):
+    """Replay the stored response when a request repeats an Idempotency-Key.
+
+    The key row is inserted in the same transaction as the view, so a
+    concurrent duplicate blocks on it until the first request commits and
+    then replays that response instead of running the view again.
+
+    A chunked view commits its work in transactions of its own, which one
+    outer transaction would merge back into a single long one. With
+    chunked=True the key is claimed in a short transaction of its own and the
+    view runs outside it; a duplicate arriving before the response is stored
+    gets a 409 instead of waiting.
+    """
+    if view_method is None:
+        return functools.partial(idempotent, chunked=chunked)
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view_method(self, request, *args, **kwargs)
+
+        fingerprint = request_fingerprint(request)
+        now = timezone.now()
+        expires_at = now + getattr(settings, 'IDEMPOTENCY_KEY_TTL', timedelta(hours=24))
+
+        if chunked:
+            with transaction.atomic():
+                record, response = _claim(request, key, fingerprint, now, expires_at)
+                if record is None:
+                    return response
+                if record.expires_at <= now:  # Expired key, claimed again for this request
+                    record.request_hash = fingerprint
+                    record.expires_at = expires_at
+                    record.response_status = record.response_body = None
+                    record.save(update_fields=['request_hash', 'expires_at', 'response_status', 'response_body'])
+            # Errors raised or returned by the view release the key so the client can retry
+            try:
+                response = view_method(self, request, *args, **kwargs)
+            except BaseException:
+                record.delete()
+                raise
+            if not status.is_success(response.status_code):
+                record.delete()
+                return response
+            _store(record, response, fingerprint, expires_at)
+            return response
+
+        with transaction.atomic():
+            record, response = _claim(request, key, fingerprint, now, expires_at)
+            if record is None:
+                return response
+
+            # Errors raised or returned by the view roll back the key so the client can retry
+            response = view_method(self, request, *args, **kwargs)
+            if not status.is_success(response.status_code):
+                transaction.set_rollback(True)
+                return response
+            _store(record, response, fingerprint, expires_at)
+        return response
+    return wrapper
@@ -0,0 +1,226 @@
+import csv
+import json
+import logging
+from itertools import islice
+
+from django.db import DatabaseError, connection, transaction
+from rest_framework import serializers
+from rest_framework.parsers import BaseParser
+
+from polls.models import Category, Inventory, Product
+from polls.utils.catalog import invalidate_catalog
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000  # Rows upserted per transaction
+MAX_ERRORS = 1000  # Rejected rows reported in detail; the rest are only counted
+
+# Product columns a row may leave out; they are then not touched on existing products
+OPTIONAL_COLUMNS = ('description', 'active', 'category')
+
+
+class StreamParser(BaseParser):
+    """Hands the raw request stream to the view instead of parsing the body up front."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return stream
+
+
+class CSVStreamParser(StreamParser):
+    media_type = 'text/csv'
+
+
+class NDJSONStreamParser(StreamParser):
+    media_type = 'application/x-ndjson'
+
+
+class ProductImportRowSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=255)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=0)
+    description = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    active = serializers.BooleanField(required=False)
+    category = serializers.CharField(max_length=255, required=False)  # Category name, created if missing
+    qty = serializers.IntegerField(min_value=0, required=False)  # Sets the inventory count
+
+
+def _text_lines(lines, bad_lines):
+    # Decode a binary line iterator a line at a time, dropping a UTF-8 byte
+    # order mark; the numbers of lines that are not UTF-8 go to bad_lines
+    for line_no, line in enumerate(lines, start=1):
+        try:
+            text = line.decode('utf-8')
+        except UnicodeDecodeError:
+            text = line.decode('utf-8', errors='replace')
+            bad_lines.add(line_no)
+        yield text.lstrip('\ufeff') if line_no == 1 else text
+
+
+def csv_records(lines):
+    """(line number, row) for each CSV row; blank optional cells count as absent.
+
+    A row that is not valid UTF-8 or not valid CSV comes as (line number,
+    ValueError) instead, and reading goes on with the next row.
+    """
+    bad_lines = set()
+    reader = csv.DictReader(_text_lines(lines, bad_lines))
+    while True:
+        first_line = reader.line_num + 1
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as exc:
+            # line_num may not count the line the error was found on yet
+            yield max(reader.line_num, first_line), ValueError(f"Invalid CSV: {exc}")
+            continue
+        if bad_lines.intersection(range(first_line, reader.line_num + 1)):
+            yield reader.line_num, ValueError("Invalid UTF-8.")
+            continue
+        record = {key: value for key, value in row.items() if key and value not in ('', None)}
+        yield reader.line_num, record
+
+
+def ndjson_records(lines):
+    """(line number, object) for each non-blank NDJSON line, or (line number, ValueError) for a bad one."""
+    bad_lines = set()
+    for line_no, line in enumerate(_text_lines(lines, bad_lines), start=1):
+        if line_no in bad_lines:
+            yield line_no, ValueError("Invalid UTF-8.")
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as exc:
+            record = ValueError(f"Invalid JSON: {exc}")
+        yield line_no, record
+
+
+class ImportSummary:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line_no, errors):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'line': line_no, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'errors_truncated': self.rejected > len(self.errors),
+        }
+
+
+def _upsert_kwargs(unique_fields, update_fields):
+    kwargs = {'update_conflicts': True, 'update_fields': update_fields}
+    # MySQL upserts on any unique key and rejects an explicit target
+    if connection.features.supports_update_conflicts_with_target:
+        kwargs['unique_fields'] = unique_fields
+    return kwargs
+
+
+def _import_chunk(rows, user, summary):
+    """Upsert one chunk of validated (line number, data) rows in a single transaction."""
+    duplicates = len(rows)
+    rows = dict((data['name'], (line_no, data)) for line_no, data in rows)  # Last row per name wins
+    names = list(rows)
+    duplicates -= len(rows)
+
+    category_names = {data['category'] for _, data in rows.values() if 'category' in data}
+    if category_names:
+        Category.objects.bulk_create(
+            [Category(name=name, created_by=user, updated_by=user) for name in category_names],
+            ignore_conflicts=True,
+        )
+    category_ids = dict(Category.objects.filter(name__in=category_names).values_list('name', 'id'))
+    existing = set(Product.objects.filter(name__in=names).values_list('name', flat=True))
+
+    # Rows are upserted in groups sharing the same columns, so a column a row
+    # leaves out is never overwritten on an existing product
+    groups = {}
+    for _, data in rows.values():
+        columns = tuple(column for column in OPTIONAL_COLUMNS if column in data)
+        groups.setdefault(columns, []).append(data)
+    for columns, group in groups.items():
+        products = [
+            Product(
+                name=data['name'],
+                price=data['price'],
+                description=data.get('description'),
+                active=data.get('active', True),
+                category_id=category_ids.get(data.get('category')),
+                created_by=user,
+                updated_by=user,
+            )
+            for data in group
+        ]
+        Product.objects.bulk_create(products, **_upsert_kwargs(
+            ['name'], ['price', *columns, 'updated_by', 'updated_at'],
+        ))
+
+    stocked = {name: data['qty'] for name, (_, data) in rows.items() if 'qty' in data}
+    if stocked:
+        product_ids = dict(Product.objects.filter(name__in=stocked).values_list('name', 'id'))
+        Inventory.objects.bulk_create(
+            [
+                Inventory(product_id=product_ids[name], qty=qty, status=Inventory.status_for(qty), last_updated_by=user)
+                for name, qty in stocked.items()
+            ],
+            **_upsert_kwargs(['product'], ['qty', 'status', 'last_updated_by', 'last_updated']),
+        )
+
+    summary.created += len(set(names) - existing)
+    summary.updated += len(existing) + duplicates  # A repeated name overwrites the earlier row
+
+
+def import_products(records, user=None, chunk_size=CHUNK_SIZE):
+    """Upsert products from (line number, record) pairs and return an ImportSummary.
+
+    records is consumed lazily, chunk_size rows at a time, each chunk in its
+    own transaction, so memory stays flat however long the input is. Products
+    are matched by name; categories are matched by name and created when
+    missing; a qty sets the product's inventory count.
+    """
+    summary = ImportSummary()
+    imported = False
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        valid = []
+        for line_no, record in chunk:
+            if isinstance(record, ValueError):
+                summary.reject(line_no, {'non_field_errors': [str(record)]})
+                continue
+            if not isinstance(record, dict):
+                summary.reject(line_no, {'non_field_errors': ["Expected an object."]})
+                continue
+            row = ProductImportRowSerializer(data=record)
+            if row.is_valid():
+                valid.append((line_no, row.validated_data))
+            else:
+                summary.reject(line_no, row.errors)
+        if not valid:
+            continue
+        try:
+            with transaction.atomic():
+                _import_chunk(valid, user, summary)
+        except DatabaseError:
+            # The database's message may show SQL and values of other rows
+            logger.exception("Product import chunk of lines %d-%d failed", valid[0][0], valid[-1][0])
+            for line_no, _ in valid:
+                summary.reject(line_no, {'non_field_errors': ["The rows around this line could not be saved."]})
+        else:
+            imported = True
+    if imported:
+        # bulk_create sends no signals
+        transaction.on_commit(lambda: invalidate_catalog('category', 'product', 'inventory'))
+    return summary
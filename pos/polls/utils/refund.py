@@ -1,29 +1,65 @@
-from polls.models import Inventory
-
-def refund_sale_item(item, reason=""):
-    """Mark a SaleItem as refunded and update inventory."""
-    if not item.refunded:
-        item.refunded = True
-        item.refund_reason = reason
-        item.save()
-
-        try:
-            inventory = Inventory.objects.get(product=item.product)
-            inventory.qty += item.qty
-            inventory.save()
-        except Inventory.DoesNotExist:
-            pass
-
-def refund_whole_sale(sale, reason=""):
-    """Refund all items in a sale and mark sale refunded."""
-    if sale.refunded:
-        return False
-
-    sale.refunded = True
-    sale.refund_reason = reason
-    sale.save()
-
-    for item in sale.items.all():
-        refund_sale_item(item, reason)
-
-    return True
\ No newline at end of file
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+
+from polls.models import Inventory, Refund, RefundItem, Sale, SaleItem
+from polls.utils.rollups import record_refund
+
+
+def _refundable_items(sale, product_ids=None):
+    """Sale items of sale annotated with the quantity already refunded."""
+    items = SaleItem.objects.filter(sale=sale).annotate(
+        refunded_qty=Coalesce(Sum('refund_items__qty'), 0)
+    ).order_by('pk')
+    if product_ids is not None:
+        items = items.filter(product_id__in=product_ids)
+    return items
+
+
+def refund_sale(sale, quantities, reason="", user=None):
+    """Refund {product_id: qty} of sale and restock them.
+
+    Runs a fixed number of queries however many lines are refunded. The sale
+    and its items are not modified; the refund is appended to Refund and
+    RefundItem. Raises ValidationError if nothing is refunded, a product is
+    not in the sale or more is refunded than is left.
+    """
+    if any(qty <= 0 for qty in quantities.values()):
+        raise ValidationError("Refund quantities must be positive.")
+    if not quantities:
+        raise ValidationError("Nothing to refund.")
+
+    with transaction.atomic():
+        # Serialises concurrent refunds of the same sale
+        Sale.objects.select_for_update().filter(pk=sale.pk).first()
+
+        lines = {}
+        for item in _refundable_items(sale, quantities):
+            lines.setdefault(item.product_id, []).append(item)
+
+        refund = Refund(sale=sale, reason=reason, created_by=user)
+        refund_items = []
+        for product_id, qty in quantities.items():
+            if product_id not in lines:
+                raise ValidationError(f"Product {product_id} not found in this sale.")
+            remaining = sum(item.qty - item.refunded_qty for item in lines[product_id])
+            if qty > remaining:
+                raise ValidationError(f"Refund quantity for product {product_id} exceeds sold quantity.")
+
+            # A product sold on several lines is refunded from the first lines first
+            for item in lines[product_id]:
+                take = min(qty, item.qty - item.refunded_qty)
+                if take > 0:
+                    refund_items.append(RefundItem(
+                        refund=refund, sale_item=item, product_id=product_id,
+                        qty=take, amount=take * item.price,
+                    ))
+                    refund.amount += take * item.price
+                    qty -= take
+
+        refund.save()
+        RefundItem.objects.bulk_create(refund_items)
+        Inventory.objects.adjust_stock(quantities)
+        record_refund(refund, refund_items)
+    return refund
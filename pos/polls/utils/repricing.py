@@ -0,0 +1,109 @@
+from decimal import ROUND_DOWN, ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_UP, Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Max, Min
+
+from polls.models import Product
+from polls.utils.catalog import invalidate_catalog
+
+CHUNK_SIZE = 1000  # Products repriced per UPDATE
+SAMPLE_SIZE = 20  # Price changes listed in the response
+
+CENT = Decimal('0.01')
+MAX_PRICE = Decimal('99999999.99')  # Largest value Product.price (10 digits, 2 places) can hold
+
+# Rounding applied to computed prices, by the name clients send
+ROUNDING = {
+    'half_up': ROUND_HALF_UP,
+    'half_even': ROUND_HALF_EVEN,
+    'up': ROUND_UP,
+    'down': ROUND_DOWN,
+}
+
+
+def adjusted_price(price, percent=None, amount=None, rounding='half_up'):
+    """price changed by percent (5 = +5%) or by a fixed amount, rounded to the cent."""
+    if percent is not None:
+        price = price * (100 + percent) / 100
+    else:
+        price = price + amount
+    return price.quantize(CENT, rounding=ROUNDING[rounding])
+
+
+def _check_price(pk, name, price):
+    if not 0 <= price <= MAX_PRICE:
+        raise ValidationError(f"Product {pk} ({name}) would be priced at {price}.")
+
+
+def _reprice(products, new_price, user, dry_run, chunk_size):
+    """Walk products in pk order, chunk_size at a time, writing each chunk's changes in one UPDATE.
+
+    Each chunk is locked, read and written in a transaction of its own, so no
+    lock is held while the next chunk is recomputed.
+    """
+    result = {'dry_run': dry_run, 'matched': 0, 'changed': 0, 'sample': []}
+    last_pk = 0
+    try:
+        while True:
+            with transaction.atomic():
+                chunk = products.filter(pk__gt=last_pk).order_by('pk')
+                if not dry_run:
+                    chunk = chunk.select_for_update()
+                rows = list(chunk.values_list('pk', 'name', 'price')[:chunk_size])
+                if not rows:
+                    break
+                last_pk = rows[-1][0]
+                prices = {}
+                for pk, name, price in rows:
+                    new = new_price(pk, price)
+                    _check_price(pk, name, new)  # Rolls back this chunk only, see adjust_prices
+                    if new == price:
+                        continue
+                    prices[pk] = new
+                    if len(result['sample']) < SAMPLE_SIZE:
+                        result['sample'].append(
+                            {'product': pk, 'name': name, 'old_price': str(price), 'new_price': str(new)}
+                        )
+                if not dry_run:
+                    Product.objects.set_prices(prices, updated_by=user)
+            result['matched'] += len(rows)
+            result['changed'] += len(prices)
+    finally:
+        if result['changed'] and not dry_run:
+            # update() sends no signals
+            transaction.on_commit(lambda: invalidate_catalog('product'))
+    return result
+
+
+def reprice_products(prices, user=None, dry_run=False, chunk_size=CHUNK_SIZE):
+    """Set {product_id: price}; returns the matched and changed counts and a sample of the changes.
+
+    The products are locked and updated a chunk at a time, each chunk in its
+    own transaction. With dry_run nothing is written and the same result is
+    returned.
+    """
+    return _reprice(Product.objects.filter(pk__in=prices), lambda pk, price: prices[pk], user, dry_run, chunk_size)
+
+
+def adjust_prices(products, percent=None, amount=None, rounding='half_up', user=None, dry_run=False,
+                  chunk_size=CHUNK_SIZE):
+    """Change the price of every product in the products queryset, see adjusted_price.
+
+    Like reprice_products. Raises ValidationError, writing nothing, when a
+    price would go negative or overflow the column: the change is monotonic,
+    so checking the cheapest and dearest product up front covers them all. A
+    price edited while the chunks are written can still fail its own chunk,
+    leaving the chunks before it written.
+    """
+    bounds = products.aggregate(low=Min('price'), high=Max('price'))
+    for price in (bounds['low'], bounds['high']):
+        if price is None:
+            continue  # No products
+        new = adjusted_price(price, percent, amount, rounding)
+        if not 0 <= new <= MAX_PRICE:
+            pk, name = products.filter(price=price).order_by('pk').values_list('pk', 'name').first()
+            _check_price(pk, name, new)
+    return _reprice(
+        products, lambda pk, price: adjusted_price(price, percent, amount, rounding), user, dry_run, chunk_size,
+    )
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from polls.permission import token_roles
+from polls.utils.lru import LRUCache
+
+
+class LocalBackend:
+    """Per-process LRU; generations are bumped only in the process that saw the change.
+
+    Only correct with a single worker process: the others keep serving pages
+    from before a change until they expire after `ttl` seconds. FileBackend
+    is the backend for several workers.
+    """
+
+    def __init__(self, max_size=1000, ttl=60):
+        self._entries = LRUCache(max_size, ttl)
+        self._lock = threading.Lock()
+        self._generations = Counter()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def set(self, key, value):
+        self._entries.set(key, value)
+
+    def generation(self, name):
+        return self._generations[name]
+
+    def bump(self, name):
+        with self._lock:
+            self._generations[name] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+
+class FileBackend:
+    """Entries and generations kept as files in `directory`, shared by every worker on the host."""
+
+    def __init__(self, directory, max_entries=5000, ttl=300):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _write(self, name, data):
+        # Write then rename so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(name))
+
+    def get(self, key):
+        path = self._path(key + '.entry')
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        self._write(key + '.entry', pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self._cull()
+
+    def _cull(self):
+        entries = [name for name in os.listdir(self.directory) if name.endswith('.entry')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda name: os.path.getmtime(self._path(name)))
+        for name in entries[:len(entries) - self.max_entries * 2 // 3]:
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+
+    def generation(self, name):
+        try:
+            with open(self._path(f'{name}.generation'), 'rb') as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self, name):
+        # A nanosecond clock instead of read-increment-write, so two workers
+        # bumping at once still both move the generation
+        self._write(f'{name}.generation', str(time.time_ns()).encode())
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.entry'):
+                os.remove(self._path(name))
+
+
+def role_class(request):
+    """Sorted role names of the requesting user, as one cache key component."""
+    if not request.user.is_authenticated:
+        return 'anonymous'
+    roles = token_roles(request)
+    if roles is None:
+        roles = request.user.roles.values_list('name', flat=True)
+    return ','.join(sorted(roles)) or 'authenticated'
+
+
+class ResponseCache:
+    """Cache of rendered list pages, invalidated through per-model generation counters.
+
+    An entry is keyed by the view, the current generation of every model it
+    depends on, the caller's role class and the full query string, so bumping
+    a model's generation (see polls.signals) makes every page that read it
+    unreachable without having to find and delete the entries.
+    """
+
+    def __init__(self):
+        self._backend = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            config = getattr(settings, 'RESPONSE_CACHE', {})
+            backend_class = import_string(config.get('BACKEND', 'polls.utils.response_cache.LocalBackend'))
+            self._backend = backend_class(**config.get('OPTIONS', {}))
+        return self._backend
+
+    def key(self, scope, models, request):
+        generations = ','.join(f'{name}:{self.backend.generation(name)}' for name in models)
+        params = sorted((name, values) for name, values in request.query_params.lists())
+        raw = f'{scope}|{generations}|{role_class(request)}|{request.get_host()}|{params}'
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _count(self, scope, outcome):
+        with self._lock:
+            self._stats.setdefault(scope, Counter())[outcome] += 1
+
+    def get(self, scope, key):
+        entry = self.backend.get(key)
+        self._count(scope, 'hits' if entry is not None else 'misses')
+        return entry
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def bump(self, name):
+        self.backend.bump(name)
+
+    def stats(self, scope=None):
+        """Hit/miss counts of this process, for one scope or all of them."""
+        with self._lock:
+            scopes = [scope] if scope else list(self._stats)
+            result = {}
+            for name in scopes:
+                counts = self._stats.get(name, Counter())
+                lookups = counts['hits'] + counts['misses']
+                result[name] = {
+                    'hits': counts['hits'],
+                    'misses': counts['misses'],
+                    'hit_rate': round(counts['hits'] / lookups, 4) if lookups else None,
+                }
+            return result
+
+
+response_cache = ResponseCache()
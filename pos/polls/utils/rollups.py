@@ -0,0 +1,240 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from polls.models import RefundItem, SaleItem, SalesRollup, value_case
+
+# Columns of SalesRollup that deltas add to, in the order RollupDelta keeps them
+MEASURES = ('revenue', 'units', 'sale_count', 'refunded_amount', 'refunded_units')
+REVENUE, UNITS, SALE_COUNT, REFUNDED_AMOUNT, REFUNDED_UNITS = range(len(MEASURES))
+
+
+def buckets(moment):
+    """(granularity, period start) of the hour and the day moment falls in."""
+    hour = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+    return [(SalesRollup.HOUR, hour), (SalesRollup.DAY, hour.replace(hour=0))]
+
+
+def _levels(product_id, category_id):
+    # Rollup rows one line counts towards; lines of deleted products only count in the totals
+    keys = [(SalesRollup.TOTAL, 0, 0), (SalesRollup.CATEGORY, 0, category_id or 0)]
+    if product_id:
+        keys.append((SalesRollup.PRODUCT, product_id, category_id or 0))
+    return keys
+
+
+def sale_lines(sale_ids):
+    """{sale_id: [(product_id, category_id, qty, subtotal)]} as the sales stand now.
+
+    Lines count towards the category their product was in when sold, see
+    SaleItem.category_id, so moving a product leaves past rollups as they are.
+    """
+    lines = defaultdict(list)
+    rows = SaleItem.objects.filter(sale_id__in=sale_ids).values_list(
+        'sale_id', 'product_id', 'category_id', 'qty', 'subtotal',
+    )
+    for sale_id, *line in rows:
+        lines[sale_id].append(tuple(line))
+    return lines
+
+
+def _sale_totals(lines):
+    totals = defaultdict(lambda: [0] * len(MEASURES))
+    for product_id, category_id, qty, subtotal in lines:
+        for key in _levels(product_id, category_id):
+            totals[key][REVENUE] += subtotal
+            totals[key][UNITS] += qty
+            totals[key][SALE_COUNT] = 1
+    return totals
+
+
+class RollupDelta:
+    """Changes to SalesRollup rows, added to them in three queries by apply()."""
+
+    def __init__(self):
+        self.rows = defaultdict(lambda: [0] * len(MEASURES))
+
+    def add_sale(self, created_at, before, after):
+        """A sale's lines went from before to after (either may be empty)."""
+        old, new = _sale_totals(before), _sale_totals(after)
+        periods = buckets(created_at)
+        for key in old.keys() | new.keys():
+            change = new.get(key, [0] * len(MEASURES))
+            if key in old:
+                change = [b - a for a, b in zip(old[key], change)]
+            for bucket in periods:
+                row = self.rows[bucket + key]
+                for index, value in enumerate(change):
+                    row[index] += value
+
+    def add_refund(self, created_at, lines, sign=1):
+        """lines are (product_id, category_id, qty, amount) of a refund; sign=-1 takes it back out."""
+        periods = buckets(created_at)
+        for product_id, category_id, qty, amount in lines:
+            for key in _levels(product_id, category_id):
+                for bucket in periods:
+                    row = self.rows[bucket + key]
+                    row[REFUNDED_AMOUNT] += sign * amount
+                    row[REFUNDED_UNITS] += sign * qty
+
+    def _objects(self, rows, with_values):
+        return [
+            SalesRollup(
+                granularity=granularity, period=period, level=level, product_id=product_id, category_id=category_id,
+                **(dict(zip(MEASURES, values)) if with_values else {}),
+            )
+            for (granularity, period, level, product_id, category_id), values in rows.items()
+        ]
+
+    def create(self, batch_size=None):
+        """Insert the rows as they are, for periods that have no rows yet."""
+        rows = {key: values for key, values in self.rows.items() if any(values)}
+        self.rows.clear()
+        SalesRollup.objects.bulk_create(self._objects(rows, with_values=True), batch_size=batch_size)
+
+    def apply(self):
+        rows = {key: values for key, values in self.rows.items() if any(values)}
+        self.rows.clear()
+        if not rows:
+            return
+        # Make sure every row exists, then add to them with one UPDATE; the
+        # additions are atomic per row, so concurrent deltas never lose each other
+        with transaction.atomic():
+            SalesRollup.objects.bulk_create(self._objects(rows, with_values=False), ignore_conflicts=True)
+            # Locked until the empty rows below are deleted, so no other delta adds to one in between
+            candidates = SalesRollup.objects.select_for_update().filter(
+                period__in={key[1] for key in rows},
+                product_id__in={key[3] for key in rows},
+                category_id__in={key[4] for key in rows},
+            ).order_by('id').values_list('id', 'granularity', 'period', 'level', 'product_id', 'category_id')
+            ids = {tuple(key): pk for pk, *key in candidates if tuple(key) in rows}
+            changes = {}
+            for index, name in enumerate(MEASURES):
+                values = {ids[key]: values[index] for key, values in rows.items() if key in ids}
+                if any(values.values()):
+                    output_field = SalesRollup._meta.get_field(name).clone()
+                    changes[name] = F(name) + value_case(SalesRollup, 'id', values, output_field)
+            SalesRollup.objects.filter(pk__in=ids.values()).update(**changes)
+            # Rows the deltas cancelled out, e.g. of a deleted sale, are dropped as a rebuild would
+            SalesRollup.objects.filter(pk__in=ids.values(), **{name: 0 for name in MEASURES}).delete()
+
+    def apply_on_commit(self):
+        transaction.on_commit(self.apply)
+
+
+def record_sales(sales, before, after=None):
+    """Roll up the change to sales since before ({sale_id: lines}, see sale_lines) once committed.
+
+    after defaults to the sales' lines as they are now.
+    """
+    if after is None:
+        after = sale_lines([sale.pk for sale in sales])
+    delta = RollupDelta()
+    for sale in sales:
+        delta.add_sale(sale.created_at, before.get(sale.pk, ()), after.get(sale.pk, ()))
+    delta.apply_on_commit()
+
+
+def refund_lines(refund_items):
+    """(product_id, category_id, qty, amount) of RefundItem objects; the category is their sale line's."""
+    return [(item.product_id, item.sale_item.category_id, item.qty, item.amount) for item in refund_items]
+
+
+def record_refund(refund, refund_items):
+    """Roll up a new refund once committed."""
+    delta = RollupDelta()
+    delta.add_refund(refund.created_at, refund_lines(refund_items))
+    delta.apply_on_commit()
+
+
+def record_sale_deleted(sale):
+    """Take a sale that is about to be deleted, and its refunds, out of the rollups once committed."""
+    delta = RollupDelta()
+    delta.add_sale(sale.created_at, sale_lines([sale.pk]).get(sale.pk, ()), ())
+    refunds = RefundItem.objects.filter(refund__sale=sale).values_list(
+        'refund__created_at', 'product_id', 'sale_item__category_id', 'qty', 'amount',
+    )
+    for created_at, *line in refunds:
+        delta.add_refund(created_at, [tuple(line)], sign=-1)
+    delta.apply_on_commit()
+
+
+def parse_bound(value, end=False):
+    """A date or datetime query parameter as an aware datetime; None if it is neither.
+
+    With end=True a bare date means the end of that day, so ?to= includes it.
+    """
+    try:
+        day = parse_date(value)
+        if day is not None:
+            moment = datetime.combine(day + timedelta(days=1) if end else day, time.min)
+        else:
+            moment = parse_datetime(value)
+            if moment is None:
+                return None
+    except ValueError:  # Well formed but out of range, e.g. 2026-13-01
+        return None
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def _next_day(day):
+    # Start of the following day, also across a daylight saving change
+    return buckets(day + timedelta(hours=36))[1][1]
+
+
+def _rebuild_day(day, batch_size):
+    delta = RollupDelta()
+    next_day = _next_day(day)
+    lines = SaleItem.objects.filter(sale__created_at__gte=day, sale__created_at__lt=next_day).order_by('sale_id')
+    sales = 0
+    current, created_at, sale = None, None, []
+    for sale_id, sale_created_at, *line in lines.values_list(
+        'sale_id', 'sale__created_at', 'product_id', 'category_id', 'qty', 'subtotal',
+    ).iterator(chunk_size=batch_size):
+        if sale_id != current:
+            if sale:
+                delta.add_sale(created_at, (), sale)
+            current, created_at, sale = sale_id, sale_created_at, []
+            sales += 1
+        sale.append(tuple(line))
+    if sale:
+        delta.add_sale(created_at, (), sale)
+
+    refunds = RefundItem.objects.filter(refund__created_at__gte=day, refund__created_at__lt=next_day).values_list(
+        'refund__created_at', 'product_id', 'sale_item__category_id', 'qty', 'amount',
+    )
+    refund_items = 0
+    for created_at, *line in refunds.iterator(chunk_size=batch_size):
+        delta.add_refund(created_at, [tuple(line)])
+        refund_items += 1
+
+    with transaction.atomic():
+        SalesRollup.objects.filter(period__gte=day, period__lt=next_day).delete()
+        delta.create(batch_size)
+    return sales, refund_items
+
+
+def rebuild(start, end, batch_size=1000):
+    """Recompute the rollups of the days from start up to end from the sales and refunds.
+
+    Works a day at a time: the day's lines are read batch_size at a time
+    and aggregated in memory, then the day's rows are replaced in one
+    transaction. Returns how many sales and refund lines were read. A sale
+    taken on a day while it is being rebuilt may be counted twice or not at
+    all, so rebuild past days or run it while the shop is closed.
+    """
+    day = buckets(start)[1][1]
+    counts = {'days': 0, 'sales': 0, 'refund_items': 0}
+    while day < end:
+        sales, refund_items = _rebuild_day(day, batch_size)
+        counts['days'] += 1
+        counts['sales'] += sales
+        counts['refund_items'] += refund_items
+        day = _next_day(day)
+    return counts
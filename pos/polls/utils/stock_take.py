@@ -0,0 +1,177 @@
+from itertools import islice
+
+from django.db import DatabaseError, transaction
+from rest_framework import serializers
+
+from polls.models import Inventory, Product
+from polls.utils.catalog import invalidate_catalog
+
+CHUNK_SIZE = 1000  # Products counted per transaction (and per UPDATE)
+MAX_ERRORS = 1000  # Rejected rows reported in detail; the rest are only counted
+MAX_VARIANCES = 1000  # Variances reported in detail; the rest only count towards the totals
+
+
+class StockTakeRowSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    counted_qty = serializers.IntegerField(min_value=0, required=False)  # Replaces the system count
+    delta = serializers.IntegerField(required=False)  # Added to the system count
+
+    def validate(self, attrs):
+        if ('counted_qty' in attrs) == ('delta' in attrs):
+            raise serializers.ValidationError("Give exactly one of counted_qty or delta.")
+        return attrs
+
+
+class StockTakeReport:
+    """Totals of a stock take; on_variance, if given, is called with every variance."""
+
+    def __init__(self, on_variance=None, capped=True):
+        self.counted = 0
+        self.adjusted = 0
+        self.created = 0
+        self.rejected = 0
+        self.varied = 0
+        self.shrinkage = 0
+        self.surplus = 0
+        self.errors = []
+        self.variances = []
+        self.on_variance = on_variance
+        self.max_variances = MAX_VARIANCES if capped else None
+
+    def reject(self, row, errors):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'row': row, 'errors': errors})
+
+    def vary(self, variance):
+        self.varied += 1
+        if variance['variance'] < 0:
+            self.shrinkage -= variance['variance']
+        else:
+            self.surplus += variance['variance']
+        if self.on_variance is not None:
+            self.on_variance(variance)
+        if self.max_variances is None or len(self.variances) < self.max_variances:
+            self.variances.append(variance)
+
+    def merge(self, other):
+        self.counted += other.counted
+        self.adjusted += other.adjusted
+        self.created += other.created
+        for error in other.errors:
+            self.reject(error['row'], error['errors'])
+        self.rejected += other.rejected - len(other.errors)
+        for variance in other.variances:
+            self.vary(variance)
+
+    def as_dict(self):
+        return {
+            'counted': self.counted,
+            'adjusted': self.adjusted,
+            'created': self.created,
+            'rejected': self.rejected,
+            'shrinkage': self.shrinkage,
+            'surplus': self.surplus,
+            'variances': self.variances,
+            'variances_truncated': self.varied > len(self.variances),
+            'errors': self.errors,
+            'errors_truncated': self.rejected > len(self.errors),
+        }
+
+
+def _merge(rows):
+    """{product_id: (rows, counted_qty or None, delta)}, applying the rows in order."""
+    merged = {}
+    for row, data in rows:
+        rows_, counted, delta = merged.get(data['product'], ((), None, 0))
+        if 'counted_qty' in data:
+            counted, delta = data['counted_qty'], 0  # A count overrides what came before it
+        else:
+            delta += data['delta']
+        merged[data['product']] = (rows_ + (row,), counted, delta)
+    return merged
+
+
+def _count_chunk(rows, user, report):
+    """Apply one chunk of validated (row, data) pairs in a single transaction."""
+    merged = _merge(rows)
+    system = dict(
+        Inventory.objects.select_for_update()
+        .filter(product_id__in=merged).order_by('product_id')
+        .values_list('product_id', 'qty')
+    )
+    missing = set(merged) - set(system)
+    known = set(Product.objects.filter(id__in=missing).values_list('id', flat=True)) if missing else set()
+
+    counts, created = {}, {}
+    for product_id, (product_rows, counted, delta) in merged.items():
+        if product_id not in system and product_id not in known:
+            for row in product_rows:
+                report.reject(row, {'product': [f'Invalid pk "{product_id}" - object does not exist.']})
+            continue
+        system_qty = system.get(product_id, 0)
+        qty = (system_qty if counted is None else counted) + delta
+        if qty < 0:
+            for row in product_rows:
+                report.reject(row, {'non_field_errors': [f"Stock of product {product_id} would drop to {qty}."]})
+            continue
+        (counts if product_id in system else created)[product_id] = qty
+        report.counted += len(product_rows)
+        if qty != system_qty:
+            report.vary({
+                'product': product_id, 'system_qty': system_qty, 'new_qty': qty, 'variance': qty - system_qty,
+            })
+
+    # Rows whose count did not move are rewritten too, to record who counted them and when
+    report.adjusted += Inventory.objects.set_stock(counts, updated_by=user)
+    if created:
+        Inventory.objects.bulk_create([
+            Inventory(product_id=product_id, qty=qty, status=Inventory.status_for(qty), last_updated_by=user)
+            for product_id, qty in created.items()
+        ])
+        report.created += len(created)
+
+
+def stock_take(rows, user=None, chunk_size=CHUNK_SIZE, on_variance=None):
+    """Apply counted quantities or deltas from (row, record) pairs and return a StockTakeReport.
+
+    Each chunk locks its inventory rows, turns deltas into absolute counts and
+    writes them with one set-based UPDATE that also recomputes the status;
+    products without an inventory row get one. Variances are reported against
+    the system count read under the lock; the report keeps the first
+    MAX_VARIANCES, on_variance sees every committed one.
+    """
+    report = StockTakeReport(on_variance)
+    validator = StockTakeRowSerializer()  # Reused: a serializer per row would copy its fields every time
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        valid = []
+        for row, record in chunk:
+            if isinstance(record, ValueError):  # Unreadable line, see polls.utils.product_import
+                report.reject(row, {'non_field_errors': [str(record)]})
+                continue
+            if not isinstance(record, dict):
+                report.reject(row, {'non_field_errors': ["Expected an object."]})
+                continue
+            try:
+                valid.append((row, validator.run_validation(record)))
+            except serializers.ValidationError as exc:
+                report.reject(row, serializers.as_serializer_error(exc))
+        if not valid:
+            continue
+        # Counted into a report of its own so a rolled back chunk leaves no trace
+        chunk_report = StockTakeReport(capped=False)
+        try:
+            with transaction.atomic():
+                _count_chunk(valid, user, chunk_report)
+        except DatabaseError as exc:
+            for row, _ in valid:
+                report.reject(row, {'non_field_errors': [str(exc)]})
+        else:
+            report.merge(chunk_report)
+    # UPDATE and bulk_create send no signals
+    transaction.on_commit(lambda: invalidate_catalog('inventory'))
+    return report
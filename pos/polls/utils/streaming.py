@@ -0,0 +1,96 @@
+import json
+from operator import attrgetter, itemgetter
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
+
+from polls.messagepack import packb
+from polls.utils.fast_serializers import dumps_rows
+
+CHUNK_SIZE = 500  # Rows fetched and serialized at a time
+
+
+def dumps(data):
+    """Encode data the same way DRF's JSONRenderer does."""
+    return json.dumps(data, cls=encoders.JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Newline-delimited JSON, one object per line (?format=ndjson)."""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        return ''.join(dumps(row) + '\n' for row in rows).encode()
+
+
+# Renderers for the streamed /all actions: the defaults plus NDJSON
+STREAM_RENDERERS = list(api_settings.DEFAULT_RENDERER_CLASSES) + [NDJSONRenderer]
+
+
+def _row_chunks(view, queryset, chunk_size):
+    # Views with a fast serializer (see polls.utils.fast_serializers) skip model instances
+    fast = view.get_fast_serializer() if hasattr(view, 'get_fast_serializer') else None
+    queryset = queryset.order_by('pk')
+    if fast is not None:
+        queryset, row_pk = fast.values(queryset), itemgetter(fast.pk)
+    else:
+        row_pk = attrgetter('pk')
+    # Keyset batches rather than QuerySet.iterator(): MySQL's driver buffers
+    # the whole result set of a query, so each chunk is a query of its own
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            return
+        last = row_pk(chunk[-1])
+        if fast is not None:
+            yield fast.to_representation(chunk)
+        else:
+            yield view.get_serializer(chunk, many=True).data
+        if len(chunk) < chunk_size:
+            return
+
+
+def _json_array(chunks):
+    yield '['
+    first = True
+    for rows in chunks:
+        if not first:
+            yield ','
+        first = False
+        yield ','.join(rows)
+    yield ']'
+
+
+def stream_all(view, queryset, chunk_size=CHUNK_SIZE):
+    """Stream every row of queryset through the view's serializer.
+
+    Rows are read in primary key order, chunk_size at a time with one keyset
+    query per chunk, and serialized a chunk at a time, so memory stays flat
+    however large the table is. The body is a JSON array, or NDJSON when
+    that format was negotiated.
+
+    MessagePack is framed like NDJSON, not like the paginated endpoints: one
+    packed map per row, back to back, with no enclosing array because the
+    row count is not known up front. Clients read it with msgpack.Unpacker
+    rather than MessagePackParser, and key interning (intern=1) is not applied.
+    """
+    chunks = _row_chunks(view, queryset, chunk_size)
+    renderer = getattr(view.request, 'accepted_renderer', None)
+    renderer_format = getattr(renderer, 'format', None)
+    if renderer_format == 'msgpack':
+        content = (b''.join(packb(row) for row in rows) for rows in chunks)
+        return StreamingHttpResponse(content, content_type=renderer.media_type)
+    chunks = (dumps_rows(rows) for rows in chunks)
+    if renderer_format == NDJSONRenderer.format:
+        content = (''.join(row + '\n' for row in rows) for rows in chunks)
+        return StreamingHttpResponse(content, content_type=NDJSONRenderer.media_type)
+    return StreamingHttpResponse(_json_array(chunks), content_type='application/json')
@@ -1,33 +1,236 @@
-from rest_framework import viewsets
-from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, IsAdminUser
+from rest_framework import mixins, viewsets
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated, IsAuthenticatedOrReadOnly, IsAdminUser
 from rest_framework.decorators import action
 from rest_framework import status
 from rest_framework.response import Response
-from django.http import HttpResponseForbidden
-from polls.models import Category, Product, Inventory, SaleItem, User, Sale
+from rest_framework.serializers import ValidationError, as_serializer_error
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotModified
+from django.core.exceptions import ValidationError as DjangoValidationError
+from polls.models import Category, Product, Inventory, SaleItem, User, Sale, SalesRollup
 from polls.serializers import (
     CategorySerializer, ProductSerializer, InventorySerializer,
     SaleItemSerializer, UserSerializer, UserCreateUpdateSerializer,
-    SaleSerializer, MyTokenObtainPairSerializer, RefundSerializer
+    SaleSerializer, MyTokenObtainPairSerializer, RefundSerializer, RepriceSerializer,
+    SalesRollupSerializer, SparseFieldsMixin, parse_field_tree
 )
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
-from django.db import transaction
-from rest_framework.pagination import PageNumberPagination
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Sum, prefetch_related_objects
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+import hashlib
+from collections import Counter
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.parsers import MultiPartParser
 from polls.permission import IsAdminRole, IsUserOrAdmin
+from polls.utils.idempotency import idempotent
+from polls.utils.refund import refund_sale
+from polls.utils.streaming import STREAM_RENDERERS, stream_all
+from polls.utils.catalog import catalog, catalog_delta
+from polls.utils.response_cache import response_cache
+from polls.utils.fast_serializers import FAST_RENDERERS, ValuesSerializer
+from polls.utils.product_import import (
+    CSVStreamParser, NDJSONStreamParser, csv_records, import_products, ndjson_records
+)
+from polls.utils.repricing import adjust_prices, reprice_products
+from polls.utils.rollups import parse_bound
+from polls.utils.stock_take import stock_take
 
 # Get the custom User model
 User = get_user_model()
 
 
+# Lets a viewset set page_size / max_page_size for its own pages
+class ViewPageSizeMixin:
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = getattr(view, 'page_size', self.page_size)
+        self.max_page_size = getattr(view, 'max_page_size', self.max_page_size)
+        return super().paginate_queryset(queryset, request, view)
+
+
 # Custom pagination class for controlling page sizes
-class ForPageNumberPagination(PageNumberPagination):
+class ForPageNumberPagination(ViewPageSizeMixin, PageNumberPagination):
     page_size = 3  # Default number of items per page
     page_size_query_param = 'page_size'  # URL parameter to override page size
     max_page_size = 10  # Maximum allowed page size
 
 
+# Keyset pagination for large tables: no OFFSET and no COUNT(*) unless ?count=true
+class ForCursorPagination(ViewPageSizeMixin, CursorPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = '-id'
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.ordering = getattr(view, 'cursor_ordering', self.ordering)
+        self.count = None
+        if request.query_params.get(self.count_query_param, '').lower() in ('1', 'true'):
+            self.count = queryset.count()
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        body = {'next': self.get_next_link(), 'previous': self.get_previous_link()}
+        if self.count is not None:
+            body['count'] = self.count
+        body['results'] = data
+        return Response(body)
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties']['count'] = {'type': 'integer', 'example': 123}
+        return response_schema
+
+
+# Applies the eager loading declared by the serializer to every queryset
+class EagerLoadingViewSetMixin:
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        serializer_class = self.get_serializer_class()
+        if hasattr(serializer_class, 'setup_eager_loading'):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        return queryset
+
+
+# ?fields= / ?expand= on reads: trims the serializer and the queryset's
+# columns and joins to what the client asked for (see SparseFieldsMixin)
+class SparseFieldsetViewSetMixin:
+    def sparse_fieldset(self):
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in SAFE_METHODS:
+            return None, None
+        fields = parse_field_tree(request.query_params.get('fields', ''))
+        expand = parse_field_tree(request.query_params.get('expand', ''))
+        return fields or None, expand or None
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        fields, expand = self.sparse_fieldset()
+        child = getattr(serializer, 'child', serializer)
+        if (fields or expand) and isinstance(child, SparseFieldsMixin):
+            child.apply_sparse_fieldset(fields, expand)
+        return serializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields, expand = self.sparse_fieldset()
+        serializer_class = self.get_serializer_class()
+        if (fields or expand) and issubclass(serializer_class, SparseFieldsMixin):
+            # Cursor pagination reads the ordering columns of the last row
+            ordering = getattr(self, 'cursor_ordering', None) or getattr(self.pagination_class, 'ordering', ())
+            if isinstance(ordering, str):
+                ordering = (ordering,)
+            serializer = serializer_class().apply_sparse_fieldset(fields, expand)
+            queryset = serializer.setup_sparse_loading(queryset, [field.lstrip('-') for field in ordering])
+        return queryset
+
+
+# Opt-in fast list path: rows come straight from QuerySet.values() through the
+# view's fast_serializer and render with FastJSONRenderer, byte for byte the
+# same as the regular serializer. Other formats take the regular path
+class FastReadMixin:
+    fast_serializer = None
+    renderer_classes = FAST_RENDERERS
+
+    # The fast path only knows the serializer's full field set
+    def get_fast_serializer(self):
+        sparse_fieldset = getattr(self, 'sparse_fieldset', None)
+        if sparse_fieldset is not None and any(sparse_fieldset()):
+            return None
+        return self.fast_serializer
+
+    def list(self, request, *args, **kwargs):
+        fast_serializer = self.get_fast_serializer()
+        if fast_serializer is None or request.accepted_renderer.format != 'json':
+            return super().list(request, *args, **kwargs)
+        queryset = fast_serializer.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(fast_serializer.to_representation(page))
+        return Response(fast_serializer.to_representation(queryset))
+
+
+# Answers conditional GETs on list and detail responses with 304 before the
+# serializer runs. The validator is one aggregate over the filtered queryset:
+# its row count and the newest of timestamp_fields, which name the row's own
+# timestamp and those of the related rows the payload shows (product_name,
+# ?expand=...). Detail responses also carry Last-Modified
+class ConditionalGetMixin:
+    timestamp_fields = ('updated_at',)
+
+    def get_validator(self, queryset):
+        """('count|newest timestamp', newest timestamp) of queryset."""
+        stats = queryset.aggregate(
+            count=Count('pk', distinct=True),
+            **{f'latest_{i}': Max(field) for i, field in enumerate(self.timestamp_fields)},
+        )
+        count = stats.pop('count')
+        latest = max(filter(None, stats.values()), default=None)
+        return f"{count}|{latest.isoformat() if latest else ''}", latest
+
+    def get_etag(self, validator):
+        # The same rows render differently per page, cursor, ?fields= and format
+        raw = f"{self.request.get_full_path()}|{self.request.accepted_renderer.format}|{validator}"
+        return 'W/"%s"' % hashlib.md5(raw.encode()).hexdigest()
+
+    def list(self, request, *args, **kwargs):
+        self.validator, _ = self.get_validator(self.filter_queryset(self.get_queryset()))
+        etag = self.get_etag(self.validator)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).filter(**{self.lookup_field: kwargs[lookup_url_kwarg]})
+        validator, latest = self.get_validator(queryset)
+        if latest is None:
+            return super().retrieve(request, *args, **kwargs)  # Not found: the usual 404
+
+        etag = self.get_etag(validator)
+        last_modified = int(latest.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().retrieve(request, *args, **kwargs)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+# Serves list pages from the response cache. Entries are keyed on the
+# generations of cache_models, which polls.signals bump on every change, and
+# keep ConditionalGetMixin's validator so a hit can still answer 304
+class ResponseCacheMixin:
+    cache_models = ()
+
+    def list(self, request, *args, **kwargs):
+        key = response_cache.key(self.basename, self.cache_models, request)
+        entry = response_cache.get(self.basename, key)
+        if entry is not None:
+            data, validator = entry
+            etag = self.get_etag(validator)
+            response = get_conditional_response(request, etag=etag) or Response(data)
+            response['ETag'] = etag
+            response['X-Cache'] = 'HIT'
+            return response
+
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            response_cache.set(key, (response.data, self.validator))
+        response['X-Cache'] = 'MISS'
+        return response
+
+    # Custom action to report the hit/miss counts of this worker's list cache
+    @action(detail=False, methods=['get'], url_path='cache-stats', permission_classes=[IsAdminRole])
+    def cache_stats(self, request):
+        return Response(response_cache.stats(self.basename))
+
+
 # Custom JWT token obtain view with error handling
 class MyTokenObtainPairView(TokenObtainPairView):
     serializer_class = MyTokenObtainPairSerializer
@@ -42,17 +245,16 @@ class MyTokenObtainPairView(TokenObtainPairView):
 
 
 # User management viewset with custom actions and serializers
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(ConditionalGetMixin, SparseFieldsetViewSetMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()  # Default queryset
     permission_classes = [IsAuthenticated]  # Only authenticated users can access
     pagination_class = ForPageNumberPagination  
 
-    # Custom action to get all users without pagination
-    @action(detail=False, methods=['get'], url_path='all')
+    # Custom action to stream all users without pagination
+    @action(detail=False, methods=['get'], url_path='all', renderer_classes=STREAM_RENDERERS)
     def get_all_users(self, request):
-        users = User.objects.all()
-        serializer = self.get_serializer(users, many=True)
-        return Response(serializer.data)
+        users = self.get_queryset()
+        return stream_all(self, users)
 
     # Determine which serializer to use based on action
     def get_serializer_class(self):
@@ -86,18 +288,18 @@ class UserViewSet(viewsets.ModelViewSet):
 
 
 # Category management viewset
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(ResponseCacheMixin, ConditionalGetMixin, SparseFieldsetViewSetMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    cache_models = ('category',)  # List pages are cached until a category changes
     permission_classes = [IsUserOrAdmin]  # Custom permission class
     pagination_class = ForPageNumberPagination
 
-    # Custom action to get all categories without pagination
-    @action(detail=False, methods=['get'], url_path='all')
+    # Custom action to stream all categories without pagination
+    @action(detail=False, methods=['get'], url_path='all', renderer_classes=STREAM_RENDERERS)
     def get_all_accounts(self, request):
-        categories = Category.objects.all()
-        serializer = self.get_serializer(categories, many=True)
-        return Response(serializer.data)
+        categories = self.get_queryset()
+        return stream_all(self, categories)
 
     # Automatically set created_by and updated_by fields
     def perform_create(self, serializer):
@@ -109,18 +311,83 @@ class CategoryViewSet(viewsets.ModelViewSet):
 
 
 # Product management viewset
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(ResponseCacheMixin, ConditionalGetMixin, FastReadMixin, SparseFieldsetViewSetMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    timestamp_fields = ('updated_at', 'category__updated_at')  # ?expand=category
+    fast_serializer = ValuesSerializer(ProductSerializer)  # Used for list and /all
+    cache_models = ('product', 'category', 'inventory')
     permission_classes = [IsAuthenticatedOrReadOnly]  # More open permissions
     pagination_class = ForPageNumberPagination
 
-    # Custom action to get all products without pagination
-    @action(detail=False, methods=['get'], url_path='all')
+    # Custom action to stream all products without pagination
+    @action(detail=False, methods=['get'], url_path='all', renderer_classes=STREAM_RENDERERS)
     def get_all_accounts(self, request):
-        product = Product.objects.all()
-        serializer = self.get_serializer(product, many=True)
-        return Response(serializer.data)
+        product = self.get_queryset()
+        return stream_all(self, product)
+
+    # Versioned catalog snapshot for terminals; ?since=<version> returns only the changes
+    @action(detail=False, methods=['get'], url_path='catalog')
+    def catalog(self, request):
+        version, body, etag = catalog.get()
+
+        since = request.query_params.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return Response({"error": "since must be a catalog version."}, status=status.HTTP_400_BAD_REQUEST)
+            return Response({"version": version, "since": since, "products": catalog_delta(since)})
+
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+    # Streaming bulk import: CSV or NDJSON as the raw body or a multipart 'file',
+    # upserted by product name in chunks
+    @action(detail=False, methods=['post'], url_path='import', permission_classes=[IsAdminRole],
+            parser_classes=[CSVStreamParser, NDJSONStreamParser, MultiPartParser])
+    def import_products(self, request):
+        upload = request.data.get('file') if isinstance(request.data, dict) else request.data
+        if not upload:
+            return Response({"error": "Send CSV or NDJSON as the body or as a 'file' upload."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        name = getattr(upload, 'name', '') or ''
+        if request.content_type.startswith(NDJSONStreamParser.media_type) or name.endswith(('.ndjson', '.jsonl')):
+            records = ndjson_records(upload)
+        else:
+            records = csv_records(upload)
+        summary = import_products(records, user=request.user)
+        return Response(summary.as_dict())
+
+    # Bulk repricing: new prices per product, or a percentage/amount change for a
+    # category or product set, written with one UPDATE per chunk of products
+    @action(detail=False, methods=['post'], url_path='reprice', permission_classes=[IsAdminRole])
+    @idempotent(chunked=True)
+    def reprice(self, request):
+        serializer = RepriceSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        try:
+            if 'prices' in data:
+                prices = {item['product'].id: item['price'] for item in data['prices']}
+                result = reprice_products(prices, user=request.user, dry_run=data['dry_run'])
+            else:
+                if 'category' in data:
+                    products = Product.objects.filter(category=data['category'])
+                else:
+                    products = Product.objects.filter(pk__in=[product.pk for product in data['products']])
+                result = adjust_prices(
+                    products, percent=data.get('percent'), amount=data.get('amount'), rounding=data['rounding'],
+                    user=request.user, dry_run=data['dry_run'],
+                )
+        except DjangoValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
 
     # Automatically set created_by and updated_by fields
     def perform_create(self, serializer):
@@ -132,18 +399,32 @@ class ProductViewSet(viewsets.ModelViewSet):
 
 
 # Inventory management viewset with validation
-class InventoryViewSet(viewsets.ModelViewSet):
+class InventoryViewSet(ConditionalGetMixin, SparseFieldsetViewSetMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
     queryset = Inventory.objects.all()
     serializer_class = InventorySerializer
+    timestamp_fields = ('last_updated', 'product__updated_at')  # product_name, ?expand=product
     permission_classes = [IsAuthenticated]  # Requires authentication
-    pagination_class = ForPageNumberPagination
+    pagination_class = ForCursorPagination
+    page_size = 100
+    max_page_size = 5000  # Large pages for back-office stock sync
 
-    # Custom action to get all inventory records without pagination
-    @action(detail=False, methods=['get'], url_path='all')
+    # Custom action to stream all inventory records without pagination
+    @action(detail=False, methods=['get'], url_path='all', renderer_classes=STREAM_RENDERERS)
     def get_all_accounts(self, request):
-        inventories = Inventory.objects.all()
-        serializer = self.get_serializer(inventories, many=True)
-        return Response(serializer.data)
+        inventories = self.get_queryset()
+        return stream_all(self, inventories)
+
+    # Bulk stock take: counted quantities or deltas per product, applied in
+    # set-based chunks; the response reports the variance against the system count
+    @action(detail=False, methods=['post'], url_path='stock-take', permission_classes=[IsAdminRole])
+    @idempotent(chunked=True)
+    def stock_take(self, request):
+        items = request.data.get('items') if isinstance(request.data, dict) else None
+        if not isinstance(items, list):
+            return Response({"error": "items must be a list of {product, counted_qty} or {product, delta}."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        report = stock_take(enumerate(items), user=request.user)
+        return Response(report.as_dict())
 
     # Automatically set last_updated_by field
     def perform_create(self, serializer):
@@ -166,17 +447,19 @@ class InventoryViewSet(viewsets.ModelViewSet):
 
 
 # SaleItem management viewset (basic implementation)
-class SaleItemViewSet(viewsets.ModelViewSet):
+class SaleItemViewSet(ConditionalGetMixin, SparseFieldsetViewSetMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
     queryset = SaleItem.objects.all()
     serializer_class = SaleItemSerializer
+    timestamp_fields = ('sale__updated_at', 'product__updated_at')  # Line changes bump their sale's updated_at
     permission_classes = [IsAuthenticated]  # Requires authentication
-    pagination_class = ForPageNumberPagination
+    pagination_class = ForCursorPagination
+    page_size = 100
+    max_page_size = 5000
 
-    @action(detail=False, methods=['get'], url_path='all')
+    @action(detail=False, methods=['get'], url_path='all', renderer_classes=STREAM_RENDERERS)
     def get_all_accounts(self, request):
-        saleitem = SaleItem.objects.all()
-        serializer = self.get_serializer(saleitem, many=True)
-        return Response(serializer.data)
+        saleitem = self.get_queryset()
+        return stream_all(self, saleitem)
     
     def perform_create(self, serializer):
         serializer.save()
@@ -184,30 +467,54 @@ class SaleItemViewSet(viewsets.ModelViewSet):
     def perform_update(self, serializer):
         serializer.save()
 
+    # Stock and refund checks in SaleItem.save/delete are reported as 400s
+    def update(self, request, *args, **kwargs):
+        try:
+            return super().update(request, *args, **kwargs)
+        except DjangoValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super().destroy(request, *args, **kwargs)
+        except DjangoValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+
 
 # Sale management viewset with complex refund functionality
-class SaleViewSet(viewsets.ModelViewSet):
-    queryset = Sale.objects.all().prefetch_related('items', 'items__product')  # Optimized queryset
+class SaleViewSet(ConditionalGetMixin, FastReadMixin, SparseFieldsetViewSetMixin, EagerLoadingViewSetMixin, viewsets.ModelViewSet):
+    queryset = Sale.objects.all()  # Related rows come from SaleSerializer's eager loading
     serializer_class = SaleSerializer
+    timestamp_fields = ('updated_at', 'items__product__updated_at')  # product_name of each line
+    fast_serializer = ValuesSerializer(SaleSerializer)  # Used for list and /all
     permission_classes = [IsAuthenticated]  # Requires authentication
-    pagination_class = ForPageNumberPagination
-
-    # Custom action to get all sales without pagination
-    @action(detail=False, methods=['get'], url_path='all')
+    pagination_class = ForCursorPagination
+    cursor_ordering = ('-created_at', '-id')  # Newest first, id breaks ties
+    page_size = 50
+    max_page_size = 1000
+    bulk_max_sales = 1000  # Largest offline queue accepted in one upload
+    bulk_chunk_size = 50  # Sales committed per transaction during bulk upload
+
+    # Custom action to stream all sales without pagination
+    @action(detail=False, methods=['get'], url_path='all', renderer_classes=STREAM_RENDERERS)
     def get_all_accounts(self, request):
-        sales = Sale.objects.all()
-        serializer = self.get_serializer(sales, many=True)
-        return Response(serializer.data)
+        sales = self.get_queryset()
+        return stream_all(self, sales)
 
     # Automatically set created_by field
     def perform_create(self, serializer):
         serializer.save(created_by=self.request.user)
 
-    # Standard create method
+    # Standard create method; retries carrying an Idempotency-Key are replayed
+    @idempotent
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
+        try:
+            self.perform_create(serializer)
+        except DjangoValidationError as e:  # Out of stock
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        prefetch_related_objects([serializer.instance], *SaleSerializer.Meta.prefetch_related)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def update(self, request, *args, **kwargs):
@@ -215,65 +522,165 @@ class SaleViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
+        try:
+            self.perform_update(serializer)
+        except DjangoValidationError as e:  # Out of stock, or below a refunded quantity
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Items were prefetched before the update; reload them so the response is fresh
+        if getattr(instance, '_prefetched_objects_cache', None):
+            instance._prefetched_objects_cache = {}
+        prefetch_related_objects([instance], *SaleSerializer.Meta.prefetch_related)
         return Response(serializer.data)
 
-    # Custom refund action with transaction safety
+    # Upload of sales queued by a terminal while it was offline
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request):
+        sales = request.data.get('sales') if isinstance(request.data, dict) else request.data
+        if not isinstance(sales, list) or not sales:
+            return Response(
+                {"error": "Expected a non-empty list of sales."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(sales) > self.bulk_max_sales:
+            return Response(
+                {"error": f"At most {self.bulk_max_sales} sales can be uploaded at once."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Validate every sale up front with one list serializer, so the products
+        # of all the sales are loaded together; invalid ones are reported, not fatal
+        batch = self.get_serializer(data=sales, many=True)
+        results = [None] * len(sales)
+        valid = []
+        for index, sale_data in enumerate(sales):
+            client_ref = sale_data.get('client_ref') if isinstance(sale_data, dict) else None
+            if client_ref is not None and (not isinstance(client_ref, str) or not 0 < len(client_ref) <= 64):
+                results[index] = {"index": index, "status": "invalid",
+                                  "errors": {"client_ref": ["Expected a string of at most 64 characters."]}}
+                continue
+            try:
+                valid.append((index, client_ref, batch.child.run_validation(sale_data)))
+            except ValidationError as e:
+                results[index] = {"index": index, "status": "invalid", "errors": as_serializer_error(e)}
+
+        # Commit in chunks; each sale runs in its own savepoint so an
+        # out-of-stock sale only rolls back itself
+        for start in range(0, len(valid), self.bulk_chunk_size):
+            chunk = valid[start:start + self.bulk_chunk_size]
+            try:
+                with transaction.atomic():
+                    self._save_bulk_chunk(batch.child, chunk, results)
+            except Exception:
+                # The chunk rolled back as a whole, including sales reported created
+                for index, client_ref, _ in chunk:
+                    results[index] = {"index": index, "status": "failed",
+                                      "errors": ["Not saved because of a server error; upload it again."]}
+
+        counts = Counter(result["status"] for result in results)
+        saved = counts["created"] + counts["duplicate"]
+        return Response({
+            "created": counts["created"],
+            "duplicates": counts["duplicate"],
+            "failed": len(results) - saved,
+            "results": results,
+        }, status=status.HTTP_201_CREATED if saved == len(results) else status.HTTP_207_MULTI_STATUS)
+
+    def _save_bulk_chunk(self, serializer, chunk, results):
+        # Sales whose client_ref is already stored for this user are reported, not saved again
+        user = self.request.user
+        refs = [client_ref for _, client_ref, _ in chunk if client_ref is not None]
+        stored = {
+            sale.client_ref: sale
+            for sale in Sale.objects.filter(created_by=user, client_ref__in=refs).only('id', 'client_ref', 'total_amount')
+        } if refs else {}
+
+        for index, client_ref, data in chunk:
+            outcome = "duplicate"
+            sale = stored.get(client_ref)
+            if sale is None:
+                try:
+                    with transaction.atomic():
+                        sale = serializer.create({**data, 'created_by': user, 'client_ref': client_ref})
+                    outcome = "created"
+                except DjangoValidationError as e:
+                    results[index] = {"index": index, "status": "failed", "errors": e.messages}
+                    continue
+                except IntegrityError:
+                    # Another upload of the same queue committed this sale first
+                    sale = Sale.objects.filter(created_by=user, client_ref=client_ref).first()
+                    if client_ref is None or sale is None:
+                        raise
+                if client_ref is not None:
+                    stored[client_ref] = sale
+            results[index] = {"index": index, "status": outcome, "id": sale.id, "total_amount": str(sale.total_amount)}
+
+    # Custom refund action; the refund is recorded, the sale itself is kept as sold
     @action(detail=True, methods=['post'], url_path='refund')
+    @idempotent
     def refund(self, request, pk=None):
         sale = self.get_object()  # Get the sale being refunded
         serializer = RefundSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        refund_items = serializer.validated_data['items']
-
-        # Use transaction to ensure atomicity
-        with transaction.atomic():
-            total_refund_amount = 0
 
-            # Process each item in the refund request
-            for item_data in refund_items:
-                product = item_data['product']
-                qty_to_refund = item_data['qty']
+        # Merge repeated products into a single quantity per product
+        quantities = {}
+        for item_data in serializer.validated_data['items']:
+            product_id = item_data['product'].id
+            quantities[product_id] = quantities.get(product_id, 0) + item_data['qty']
 
-                try:
-                    # Find the original sale item
-                    sale_item = SaleItem.objects.get(sale=sale, product=product)
-                except SaleItem.DoesNotExist:
-                    return Response(
-                        {"error": f"Product {product.id} not found in this sale."},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-
-                # Validate refund quantity doesn't exceed sold quantity
-                if qty_to_refund > sale_item.qty:
-                    return Response(
-                        {"error": f"Refund quantity for product {product.id} exceeds sold quantity."},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-
-                # Update sale item quantity
-                sale_item.qty -= qty_to_refund
-                refund_value = qty_to_refund * sale_item.price
-                total_refund_amount += refund_value
-
-                # Delete item if fully refunded, otherwise save
-                if sale_item.qty == 0:
-                    sale_item.delete()
-                else:
-                    sale_item.save()
-
-                # Restock inventory
-                inventory = product.inventory
-                inventory.qty += qty_to_refund
-                inventory.save()
+        try:
+            refund = refund_sale(sale, quantities, user=request.user)
+        except DjangoValidationError as e:
+            return Response({"error": e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
 
-            # Update sale total amount
-            sale.total_amount -= total_refund_amount
-            sale.save()
+        refunded = sale.refunds.aggregate(total=Sum('amount'))['total'] or 0
 
         # Return success response with refund details
         return Response({
             "message": "Refund processed successfully",
-            "refund_amount": float(total_refund_amount),
-            "new_total": float(sale.total_amount)
-        }, status=status.HTTP_200_OK)
\ No newline at end of file
+            "refund_id": refund.id,
+            "refund_amount": float(refund.amount),
+            "new_total": float(sale.total_amount - refunded)
+        }, status=status.HTTP_200_OK)
+
+
+# Sales reports read from the hourly/daily rollup tables instead of the sale lines:
+# ?granularity=hour|day&level=total|category|product&from=&to=&category=&product=
+class SalesReportViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+    serializer_class = SalesRollupSerializer
+    permission_classes = [IsAdminRole]
+    pagination_class = ForCursorPagination
+    cursor_ordering = ('period', 'id')  # Oldest period first
+    page_size = 500
+    max_page_size = 5000
+
+    def list(self, request, *args, **kwargs):
+        params = request.query_params
+        granularity = params.get('granularity', SalesRollup.DAY)
+        level = params.get('level', SalesRollup.TOTAL)
+        if granularity not in dict(SalesRollup.GRANULARITY_CHOICES):
+            return Response({"error": "granularity must be hour or day."}, status=status.HTTP_400_BAD_REQUEST)
+        if level not in dict(SalesRollup.LEVEL_CHOICES):
+            return Response({"error": "level must be total, category or product."}, status=status.HTTP_400_BAD_REQUEST)
+
+        filters = {'granularity': granularity, 'level': level}
+        for name, lookup in (('from', 'period__gte'), ('to', 'period__lt')):
+            if name in params:
+                filters[lookup] = parse_bound(params[name], end=name == 'to')
+                if filters[lookup] is None:
+                    return Response({"error": f"{name} must be a date or a datetime."},
+                                    status=status.HTTP_400_BAD_REQUEST)
+        for name in ('product', 'category'):
+            if name in params:
+                try:
+                    filters[f'{name}_id'] = int(params[name])
+                except ValueError:
+                    return Response({"error": f"{name} must be an id."}, status=status.HTTP_400_BAD_REQUEST)
+        self.report_filters = filters
+        return super().list(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return SalesRollup.objects.filter(**getattr(self, 'report_filters', {})).annotate(
+            net_revenue=F('revenue') - F('refunded_amount')
+        )
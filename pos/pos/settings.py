@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 from datetime import timedelta
+from importlib.util import find_spec
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -59,13 +60,27 @@ MIDDLEWARE = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'polls.authentication.ClaimsJWTAuthentication',  # JWTAuthentication without the per-request user query
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
 }
 
+# MessagePack for terminals on slow links, when the optional msgpack package is installed
+if find_spec('msgpack'):
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] += ('polls.messagepack.MessagePackRenderer',)
+    REST_FRAMEWORK['DEFAULT_PARSER_CLASSES'] += ('polls.messagepack.MessagePackParser',)
+
 SWAGGER_SETTINGS = {
     "SECURITY_DEFINITIONS": {
         "bearer": {
@@ -86,8 +101,35 @@ SIMPLE_JWT = {
     'BLACKLIST_AFTER_ROTATION': True,
     'AUTH_HEADER_TYPES': ('Bearer',),
     'AUTH_HEADER_NAME': 'HTTP_AUTHORIZATION',
+    'TOKEN_OBTAIN_SERIALIZER': 'polls.serializers.MyTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'polls.serializers.MyTokenRefreshSerializer',
     # ... rest of your JWT settings ...
 }
+
+# How long a stored Idempotency-Key response is replayed for retried requests
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+
+# 'auth' holds each JWT user's is_active and role_version so requests skip
+# polls_user. It must be shared by every worker: FileBasedCache on one host,
+# Redis or Memcached across hosts. LocMemCache would miss other workers' changes
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'auth',
+        'TIMEOUT': 300,
+    },
+}
+
+# Cached category/product list pages. LocalBackend is only correct with a
+# single worker process: a change bumps the generations of the worker that
+# saw it, and the others keep serving the old pages for up to ttl seconds.
+# With several workers on one host use polls.utils.response_cache.FileBackend
+# with OPTIONS {'directory': ...}, which shares entries and invalidations
+RESPONSE_CACHE = {
+    'BACKEND': 'polls.utils.response_cache.LocalBackend',
+    'OPTIONS': {'max_size': 1000, 'ttl': 60},
+}
 ROOT_URLCONF = 'pos.urls'
 
 TEMPLATES = [